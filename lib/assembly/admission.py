@@ -0,0 +1,91 @@
+"""
+Memory and scratch space admission of jobs on a compute node.
+
+Before a worker runs a job, it reserves the job's estimated peak memory
+and scratch space (see planner.plan) in a locked file shared by all
+workers on the node.  The job is admitted only if its reservation fits
+next to those of the running jobs, in the currently free memory and in
+the disk space above the GC threshold.  Otherwise the worker hands the
+message back to the queue.  A node with no running jobs admits any job,
+so jobs larger than every node still run.
+"""
+
+import logging
+import os
+import time
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+RESERVATIONS_FILE = '.admission.json'
+
+
+class AdmissionControl:
+    def __init__(self, datapath, min_free_space, memory_fraction=0.9):
+        """ MIN_FREE_SPACE is in GB, MEMORY_FRACTION the share of RAM jobs may reserve """
+        self.datapath = datapath
+        self.index_file = os.path.join(datapath, RESERVATIONS_FILE)
+        self.min_free_space = int(float(min_free_space) * 10**9)
+        self.memory_fraction = float(memory_fraction)
+
+    def _index(self, write=True):
+        return utils.locked_json(self.index_file, {'jobs': {}}, write)
+
+    def admit(self, job, memory, scratch):
+        """ Reserves MEMORY and SCRATCH (bytes) for JOB if the node can take it now """
+        total, available = system_memory()
+        free_disk = disk_free(self.datapath)
+        with self._index() as index:
+            jobs = index['jobs']
+            for key in [k for k, r in jobs.items() if k == job or not utils.pid_alive(r['pid'])]:
+                del jobs[key]
+            reserved_memory = sum(r['memory'] for r in jobs.values())
+            reserved_scratch = sum(r['scratch'] for r in jobs.values())
+            fits = (reserved_memory + memory <= total * self.memory_fraction and
+                    memory <= available and
+                    reserved_scratch + scratch <= free_disk - self.min_free_space)
+            if jobs and not fits:
+                logger.info('Job {} deferred: needs {} B memory, {} B scratch; '
+                            '{} B memory and {} B scratch reserved by {} jobs'.format(
+                        job, memory, scratch, reserved_memory, reserved_scratch, len(jobs)))
+                return False
+            jobs[job] = {'pid': os.getpid(),
+                         'memory': memory,
+                         'scratch': scratch,
+                         'time': time.time()}
+        logger.info('Job {} admitted: {} B memory, {} B scratch'.format(job, memory, scratch))
+        return True
+
+    def release(self, job):
+        with self._index() as index:
+            index['jobs'].pop(job, None)
+
+    def memory_for(self, job):
+        """ Bytes of RAM JOB may use: what other jobs have not reserved """
+        total, _ = system_memory()
+        with self._index(write=False) as index:
+            jobs = index['jobs']
+            others = sum(r['memory'] for k, r in jobs.items() if k != job and utils.pid_alive(r['pid']))
+            own = jobs.get(job, {}).get('memory', 0)
+        return int(max(own, total * self.memory_fraction - others))
+
+
+def system_memory():
+    """ (total, available) RAM of the node in bytes """
+    info = {}
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                tokens = line.split()
+                if len(tokens) == 3:
+                    info[tokens[0].rstrip(':')] = int(tokens[1]) * 1024
+    except IOError:
+        pass
+    ## If the amount is unknown, assume 4 GiB
+    total = info.get('MemTotal', 4 * 1024**3)
+    return total, info.get('MemAvailable', info.get('MemFree', total))
+
+def disk_free(path):
+    s = os.statvfs(path)
+    return s.f_bsize * s.f_bavail
@@ -243,6 +243,10 @@ def filepaths(filesets):
 class ArastUserInterrupt(BaseException):
     pass
 
+class ArastStageCancelled(BaseException):
+    """ A stage stopped by a Wasp timeout or race """
+    pass
+
 class ArastDataInputError(Exception):
     pass
 
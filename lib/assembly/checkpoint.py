@@ -0,0 +1,114 @@
+"""
+Stage checkpoints of a running job.
+
+Every completed stage is recorded in the job directory: its output dict
+(from which the WaspLink's FileSets and info values are rebuilt), its
+outpath and the sizes of the files it produced.  When a job is delivered
+again after its worker died, stages whose recorded outputs are still in
+place are replayed from the manifest instead of being run.
+
+Stages are identified by plugin, version, settings, parameters and the
+paths and sizes of their inputs.  Replayed stages keep their original
+outpaths, so the stages that consume them get the same keys as before.
+"""
+
+import copy
+import cPickle as pickle
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = '_checkpoint'
+
+
+class Checkpoint:
+    def __init__(self, jobpath):
+        self.path = utils.verify_dir(os.path.join(jobpath, CHECKPOINT_DIR))
+
+    def key(self, module, version, settings, params, filesets):
+        """ Returns the checkpoint key of a stage, or None if its inputs are not local files """
+        try:
+            inputs = []
+            for fs in filesets:
+                inputs.append({'type': fs['type'],
+                               'insert': fs.get('insert'),
+                               'stdev': fs.get('stdev'),
+                               'tags': sorted(fs['tags']),
+                               'files': [[f, os.path.getsize(f)] for f in fs.files]})
+        except (TypeError, KeyError, AttributeError, OSError) as e:
+            logger.debug('Stage not checkpointed: {}: {}'.format(module, e))
+            return None
+        desc = {'module': module,
+                'version': version,
+                'settings': sorted([list(kv) for kv in settings]),
+                'params': sorted([list(kv) for kv in params]),
+                'inputs': inputs}
+        return hashlib.sha1(json.dumps(desc, sort_keys=True)).hexdigest()
+
+    def entry_file(self, key):
+        return os.path.join(self.path, '{}.pkl'.format(key))
+
+    def fetch(self, key):
+        """ Returns (output, outpath) of a completed stage whose files are all present """
+        try:
+            with open(self.entry_file(key), 'rb') as f:
+                entry = pickle.load(f)
+        except IOError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            logger.warning('Checkpoint {} unusable: {}'.format(key, e))
+            self.remove(key)
+            return None
+        for filename, size in entry['files'].items():
+            try:
+                if os.path.getsize(filename) != size:
+                    raise OSError('{} changed'.format(filename))
+            except OSError as e:
+                logger.info('Checkpoint of {} stale: {}'.format(entry['module'], e))
+                self.remove(key)
+                return None
+        return entry['output'], entry['outpath']
+
+    def record(self, key, outpath, output, module):
+        """ Records a completed stage, written atomically so a crash leaves no partial entry """
+        entry = {'module': module,
+                 'outpath': outpath,
+                 'output': copy.deepcopy(output),
+                 'files': {f: os.path.getsize(f) for f in output_files(output)},
+                 'timestamp': time.time()}
+        tmp = os.path.join(self.path, '.{}.{}'.format(key, uuid.uuid4()))
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.entry_file(key))
+        except (IOError, OSError, pickle.PicklingError) as e:
+            logger.warning('Could not checkpoint {} stage: {}'.format(module, e))
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def remove(self, key):
+        try:
+            os.remove(self.entry_file(key))
+        except OSError:
+            pass
+
+
+##### Helper Functions ######
+def output_files(obj):
+    """ Existing files referenced by absolute path in a nested output structure """
+    if isinstance(obj, basestring):
+        return [obj] if os.path.isabs(obj) and os.path.isfile(obj) else []
+    elif isinstance(obj, dict):
+        return [f for v in obj.values() for f in output_files(v)]
+    elif isinstance(obj, (list, tuple)):
+        return [f for v in obj for f in output_files(v)]
+    return []
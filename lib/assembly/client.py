@@ -16,6 +16,7 @@ from prettytable import PrettyTable
 import asmtypes
 import utils
 from kbase import typespec_to_assembly_data as kb_to_asm
+import shock
 from shock import Shock
 
 """ Assembly Service client library. """
@@ -238,25 +239,22 @@ class Client:
             raise Error("Invalid shock handle: {}".format(handle))
         url = "{}/node/{}?download".format(shock_url, shock_id)
         if stdout:
-            filename = None
-        else:
-            outdir = utils.verify_dir(outdir) if outdir else None
-            filename = handle.get('filename') or handle.get('local_file') or shock_id
-            filename = prefix + filename.split('/')[-1]
-            filename = os.path.join(outdir, filename) if outdir else filename
-        headers = {'Authorization': 'OAuth {}'.format(self.token)}
-        r = requests.get(url, stream=True, headers=headers)
-        with self.smart_open(filename) as f:
-            for chunk in r.iter_content(chunk_size=1024):
+            session = shock.get_session(url)
+            r = session.get(url, stream=True, headers=shock.token_to_req_headers(self.token))
+            for chunk in r.iter_content(chunk_size=shock.CHUNK_SIZE):
                 if chunk: # filter out keep-alive new chunks
-                    f.write(chunk)
-                    f.flush()
-        if filename:
-            if not os.path.exists(filename):
-                raise Error('Data exists but file not properly saved')
-            else:
-                sys.stderr.write("File downloaded: {}\n".format(filename))
-                return filename
+                    sys.stdout.write(chunk)
+            sys.stdout.flush()
+            return
+        outdir = utils.verify_dir(outdir) if outdir else None
+        filename = handle.get('filename') or handle.get('local_file') or shock_id
+        filename = prefix + filename.split('/')[-1]
+        fileinfo = shock.get_node(shock_url, shock_id, self.token).get('file') or {}
+        filename = shock.download_url(url, outdir, filename, self.token,
+                                      size=fileinfo.get('size'),
+                                      md5=(fileinfo.get('checksum') or {}).get('md5'))
+        sys.stderr.write("File downloaded: {}\n".format(filename))
+        return filename
 
 
 class AssemblyData(dict):
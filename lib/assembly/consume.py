@@ -4,7 +4,6 @@ Consumes a job from the queue
 
 import copy
 import errno
-import glob
 import logging
 import pika
 import sys
@@ -16,23 +15,33 @@ import time
 import datetime
 import socket
 import multiprocessing
-import re
 import threading
 import subprocess
 from multiprocessing import current_process as proc
+from multiprocessing.pool import ThreadPool
 from traceback import format_tb, format_exc
 
 import assembly as asm
 import metadata as meta
+import planner
 import asmtypes
+import extract
 import shock
+import stage_log
+import subjobs
+import supervisor
 import wasp
-import recipes
 import utils
+from admission import AdmissionControl
 from assembly import ignored
+from checkpoint import Checkpoint
+from cores import CoreBroker
 from job import ArastJob
 from kbase import typespec_to_assembly_data as kb_to_asm
 from plugins import ModuleManager
+from publisher import PublisherPool
+from stage_cache import StageCache, CACHE_DIR
+from disk_index import DiskIndex, DiskCollector
 
 from ConfigParser import SafeConfigParser
 
@@ -53,135 +62,83 @@ class ArastConsumer:
         self.threads = threads
         self.binpath = binpath
         self.modulebin = modulebin
-        self.pmanager = ModuleManager(threads, kill_list, kill_list_lock, job_list, binpath, modulebin)
+        self.datapath = datapath
+        cache_size = 0
+        if self.parser.has_option('compute', 'stage_cache_size'):
+            cache_size = self.parser.get('compute', 'stage_cache_size')
+        self.stage_cache = StageCache(datapath, cache_size)
+        self.core_broker = CoreBroker(datapath, threads)
+        self.min_free_space = float(self.parser.get('compute','min_free_space'))
+        memory_fraction = 0.9
+        if self.parser.has_option('compute', 'admission_memory_fraction'):
+            memory_fraction = float(self.parser.get('compute', 'admission_memory_fraction'))
+        self.admission = AdmissionControl(datapath, self.min_free_space, memory_fraction)
+        self.admission_retry = 15
+        if self.parser.has_option('compute', 'admission_retry'):
+            self.admission_retry = float(self.parser.get('compute', 'admission_retry'))
+        self.catalog = planner.Catalog(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                    'ar_modules.json'))
+        self.kill_switch = supervisor.KillSwitch()
+        log_head, log_tail, log_compress = 4, 1, False
+        if self.parser.has_option('compute', 'stage_log_head'):
+            log_head = self.parser.get('compute', 'stage_log_head')
+        if self.parser.has_option('compute', 'stage_log_tail'):
+            log_tail = self.parser.get('compute', 'stage_log_tail')
+        if self.parser.has_option('compute', 'stage_log_compress'):
+            log_compress = self.parser.getboolean('compute', 'stage_log_compress')
+        self.stage_logs = stage_log.StageLogs(log_head, log_tail, log_compress)
+        self.pmanager = ModuleManager(threads, kill_list, kill_list_lock, job_list, binpath, modulebin,
+                                      self.stage_cache, self.core_broker, self.admission,
+                                      self.kill_switch, self.stage_logs)
 
         # Set up environment
         self.shockurl = shockurl
-        self.datapath = datapath
         self.rmq_host = rmq_host
         self.rmq_port = rmq_port
         self.mongo_host = mongo_host
         self.mongo_port = mongo_port
         self.queues = queues
-        self.min_free_space = float(self.parser.get('compute','min_free_space'))
+        self.staging_threads = 4
+        if self.parser.has_option('compute', 'staging_threads'):
+            self.staging_threads = int(self.parser.get('compute', 'staging_threads'))
         self.data_expiration_days = float(self.parser.get('compute','data_expiration_days'))
+        self.distribute_pipelines = True
+        if self.parser.has_option('compute', 'distribute_pipelines'):
+            self.distribute_pipelines = self.parser.getboolean('compute', 'distribute_pipelines')
+        max_priority = ctrl_conf['rabbitmq'].get('max_priority')
+        self.publisher = PublisherPool(rmq_host, rmq_port, size=1,
+                                       max_priority=max_priority and int(max_priority))
         m = ctrl_conf['meta']
         a = ctrl_conf['assembly']
 
         collections = {'jobs': m.get('mongo.collection', 'jobs'),
                        'auth': m.get('mongo.collection.auth', 'auth'),
                        'data': m.get('mongo.collection.data', 'data'),
-                       'running': m.get('mongo.collection.running', 'running_jobs')}
+                       'running': m.get('mongo.collection.running', 'running_jobs'),
+                       'stats': m.get('mongo.collection.stats', 'stage_stats')}
 
         ###### TODO Use REST API
+        write_interval = 5
+        if self.parser.has_option('compute', 'metadata_write_interval'):
+            write_interval = float(self.parser.get('compute', 'metadata_write_interval'))
         self.metadata = meta.MetadataConnection(self.mongo_host, self.mongo_port, m['mongo.db'],
-                                                collections)
-        self.gc_lock = multiprocessing.Lock()
-
-    def garbage_collect(self, datapath, required_space, user, job_id, data_id):
-        """ Monitor space of disk containing DATAPATH and delete files if necessary."""
-        datapath = self.datapath
-        required_space = self.min_free_space
-        expiration = self.data_expiration_days
-
-        ### Remove expired directories
-        def can_remove(d, user, job_id, data_id):
-            u, data, j = d.split('/')[-4:-1]
-            if u == user and j == str(job_id):
-                return False
-            if data == str(data_id) and j == 'raw':
-                return False
-            if os.path.isdir(d):
-                return True
-            return False
-
-        dir_depth = 3
-        dirs = filter(lambda f: can_remove(f, user, job_id, data_id), glob.glob(datapath + '/' + '*/' * dir_depth))
-        removed = []
-        logger.info('Searching for directories older than {} days'.format(expiration))
-        for d in dirs:
-            file_modified = None
-            try:
-                file_modified = datetime.datetime.fromtimestamp(os.path.getmtime(d))
-            except os.error as e:
-                logger.warning('GC ignored "{}": could not get timestamp: {}'.format(d, e))
-                continue
-            tdiff = datetime.datetime.now() - file_modified
-            if tdiff > datetime.timedelta(days=expiration):
-                logger.info('GC: removing expired directory: {} (modified {} ago)'.format(d, tdiff))
-                removed.append(d)
-                shutil.rmtree(d, ignore_errors=True)
-            else:
-                logger.debug('GC: not removing: {} (modified {} ago)'.format(d, tdiff))
-        for r in removed:
-            dirs.remove(r)
-
-        ### Check free space and remove old directories
-        free_space = free_space_in_path(datapath)
-        logger.info("Required space in GB: {} (free = {})".format(required_space, free_space))
-
-        times = []
-        for d in dirs:
-            try:
-                t = os.path.getmtime(d)
-                times.append([t, d])
-            except:
-                pass
-        times.sort()
-        logger.debug("Directories sorted by time: {}".format(times))
-        dirs = [x[1] for x in times]
-
-        busy_dirs = []
-        while free_space < self.min_free_space and len(dirs) > 0:
-            d = dirs.pop(0)
-            if is_dir_busy(d):
-                busy_dirs.append(d)
-            else:
-                free_space = self.remove_dir(d)
-
-        while free_space < self.min_free_space:
-            if len(busy_dirs) == 0:
-                logger.error("GC: free space {} < {} GB; waiting for system space to be available...".format(free_space, self.min_free_space))
-                time.sleep(60)
-            else:
-                logger.warning("GC: free space {} < {} GB; waiting for jobs to complete to reclaim space: {} busy directories..."
-                               .format(free_space, self.min_free_space, len(busy_dirs)))
-                checked_dirs = []
-                while free_space < self.min_free_space and len(busy_dirs) > 0:
-                    bd = busy_dirs.pop(0)
-                    if is_dir_busy(bd):
-                        checked_dirs.append(bd)
-                        continue
-                    free_space = self.remove_dir(bd)
-                    # self.remove_empty_dirs()
-                if free_space < self.min_free_space:
-                    busy_dirs = checked_dirs
-                    time.sleep(20)
-            free_space = free_space_in_path(self.datapath)
-
-        self.remove_empty_dirs()
-
-
-    def remove_dir(self, d):
-        shutil.rmtree(d, ignore_errors=True)
-        logger.info("GC: space required; %s removed." % d)
-        return free_space_in_path(self.datapath)
-
-    def remove_empty_dirs(self):
-        data_dirs = filter(lambda f: os.path.isdir(f), glob.glob(self.datapath + '/' + '*/' * 2))
-        for dd in data_dirs:
-            if not os.listdir(dd):
-                logger.info('GC: removing empty directory: {}'.format(dd))
-                try:
-                    os.rmdir(dd)
-                except os.error as e:
-                    logger.warning('GC: could not remove empty dir "{}": {}'.format(dd, e))
+                                                collections, write_interval=write_interval)
+        gc_target_space = self.min_free_space
+        if self.parser.has_option('compute', 'gc_target_space'):
+            gc_target_space = float(self.parser.get('compute', 'gc_target_space'))
+        gc_interval = 600
+        if self.parser.has_option('compute', 'gc_interval'):
+            gc_interval = int(self.parser.get('compute', 'gc_interval'))
+        self.disk_index = DiskIndex(datapath, skip=[CACHE_DIR])
+        self.collector = DiskCollector(self.disk_index, self.stage_cache, self.min_free_space,
+                                       gc_target_space, self.data_expiration_days, gc_interval)
 
     def get_data(self, body):
         """Get data from cache or Shock server."""
         params = json.loads(body)
         logger.debug('New Data Format')
-        return self._get_data(body)
+        ## Child jobs reuse the files staged by their parent on this node
+        return self._get_data(body, try_local=bool(params.get('parent')))
 
     def _get_data(self, body, try_local=False):
         params = json.loads(body)
@@ -189,21 +146,15 @@ class ArastConsumer:
                                 str(params['data_id']))
         datapath = filepath
         filepath += "/raw/"
-        all_files = []
         user = params['ARASTUSER']
         job_id = params['job_id']
         data_id = params['data_id']
         token = params['oauth_token']
         uid = params['_id']
 
-        self.gc_lock.acquire()
-        try:
-            self.garbage_collect(self.datapath, self.min_free_space, user, job_id, data_id)
-        except:
-            logger.error('Unexpected error in GC.')
-            raise
-        finally:
-            self.gc_lock.release()
+        ### Protect job directories from GC, wait for space if the disk is full
+        self.disk_index.job_started(user, data_id, job_id)
+        self.collector.ensure_space()
 
         ##### Get data from ID #####
         data_doc = self.metadata.get_data_docs(params['ARASTUSER'], params['data_id'])
@@ -222,6 +173,7 @@ class ArastConsumer:
             touch(filepath)
 
         file_sets = params['assembly_data']['file_sets']
+        staging = []
         for file_set in file_sets:
             if file_set['type'] == 'paired_url':
                 file_set['type'] = 'paired'
@@ -231,33 +183,53 @@ class ArastConsumer:
                 file_set['type'] = 'reference'
             file_set['files'] = [] #legacy
             for file_info in file_set['file_infos']:
-                #### File is stored on Shock
-                if file_info['filename']:
-                    local_file = os.path.join(filepath, file_info['filename'])
-                    if try_local and os.path.exists(local_file):
-                        local_file = self.extract_file(local_file)
-                        logger.info("Requested data exists on node: {}".format(local_file))
-                    else:
-                        local_file = self.download_shock(file_info['shock_url'], user, token,
-                                                         file_info['shock_id'], filepath)
-
-                elif file_info['direct_url']:
-                    local_file = os.path.join(filepath, os.path.basename(file_info['direct_url']))
-                    if try_local and os.path.exists(local_file):
-                        local_file = self.extract_file(local_file)
-                        logger.info("Requested data exists on node: {}".format(local_file))
-                    else:
-                        local_file = self.download_url(file_info['direct_url'], filepath, token=token)
-                file_info['local_file'] = local_file
-                if file_set['type'] == 'single' and asm.is_long_read_file(local_file):
-                    if not 'tags' in file_set:
-                        file_set['tags'] = []
-                    if not 'long_read' in file_set['tags']:
-                        file_set['tags'].append('long_read') # pacbio or nanopore reads
-                file_set['files'].append(local_file) #legacy
-            all_files.append(file_set)
+                staging.append((file_set, file_info))
+
+        #### Download, extract and inspect files concurrently
+        def stage(item):
+            file_set, file_info = item
+            local_file = self.stage_file(file_info, filepath, user, token, try_local)
+            long_read = file_set['type'] == 'single' and asm.is_long_read_file(local_file)
+            return local_file, long_read
+
+        pool = ThreadPool(max(1, min(self.staging_threads, len(staging))))
+        try:
+            staged = pool.map(stage, staging)
+        finally:
+            pool.terminate()
+
+        for (file_set, file_info), (local_file, long_read) in zip(staging, staged):
+            file_info['local_file'] = local_file
+            if long_read:
+                if not 'tags' in file_set:
+                    file_set['tags'] = []
+                if not 'long_read' in file_set['tags']:
+                    file_set['tags'].append('long_read') # pacbio or nanopore reads
+            file_set['files'].append(local_file) #legacy
+        all_files = list(file_sets)
         return datapath, all_files
 
+    def stage_file(self, file_info, filepath, user, token, try_local=False):
+        """ Returns the local, extracted copy of a FILE_INFO """
+        #### File is stored on Shock
+        if file_info['filename']:
+            local_file = os.path.join(filepath, file_info['filename'])
+            if try_local and os.path.exists(local_file):
+                local_file = self.extract_file(local_file)
+                logger.info("Requested data exists on node: {}".format(local_file))
+            else:
+                local_file = self.download_shock(file_info['shock_url'], user, token,
+                                                 file_info['shock_id'], filepath)
+
+        elif file_info['direct_url']:
+            local_file = os.path.join(filepath, os.path.basename(file_info['direct_url']))
+            if try_local and os.path.exists(local_file):
+                local_file = self.extract_file(local_file)
+                logger.info("Requested data exists on node: {}".format(local_file))
+            else:
+                local_file = self.download_url(file_info['direct_url'], filepath, token=token)
+        return local_file
+
 
     def prepare_job_data(self, body):
         params = json.loads(body)
@@ -309,7 +281,10 @@ class ArastConsumer:
                     'params': [],
                     'exceptions': [],
                     'pipeline_data': {},
+                    'stage_stats': [],
+                    'input_size': planner.input_size(all_files),
                     'datapath': datapath,
+                    'checkpoint': Checkpoint(jobpath),
                     'out_report' : self.out_report})
 
         self.out_report.write("Arast Pipeline: Job {}\n".format(job_id))
@@ -322,6 +297,7 @@ class ArastConsumer:
         try:
             job_data = self.prepare_job_data(body)
             self.job_list.append(job_data)
+            self.kill_switch.start(job_data['user'], job_data['job_id'])
         except:
             logger.error("Error in adding new job to job_list")
             raise
@@ -337,9 +313,6 @@ class ArastConsumer:
         uid = params['_id']
         user = params['ARASTUSER']
         token = params['oauth_token']
-        pipelines = params.get('pipeline')
-        recipe = params.get('recipe')
-        wasp_in = params.get('wasp')
         jobpath = os.path.join(self.datapath, user, str(data_id), str(job_id))
 
         url = shock.verify_shock_url(self.shockurl)
@@ -350,31 +323,25 @@ class ArastConsumer:
         timer_thread.start()
 
         #### Parse pipeline to wasp exp
-        reload(recipes)
-        if recipe:
-            try: wasp_exp = recipes.get(recipe[0], job_id)
-            except AttributeError: raise Exception('"{}" recipe not found.'.format(recipe[0]))
-        elif wasp_in:
-            wasp_exp = wasp_in[0]
-        elif not pipelines:
-            wasp_exp = recipes.get('auto', job_id)
-        elif pipelines:
-            ## Legacy client
-            if pipelines[0] == 'auto':
-                wasp_exp = recipes.get('auto', job_id)
-            ##########
-            else:
-                if type(pipelines[0]) is not list: # --assemblers
-                    pipelines = [pipelines]
-                all_pipes = []
-                for p in pipelines:
-                    all_pipes += self.pmanager.parse_input(p)
-                logger.debug("pipelines = {}".format(all_pipes))
-                wasp_exp = wasp.pipelines_to_exp(all_pipes, params['job_id'])
-        else:
-            raise asmtypes.ArastClientRequestError('Malformed job request.')
-        logger.debug('Wasp Expression: {}'.format(wasp_exp))
-        w_engine = wasp.WaspEngine(self.pmanager, job_data, self.metadata)
+        distribute = self.distribute_pipelines and not params.get('parent')
+        wasp_exp = planner.job_expression(params, subjobs=distribute)
+        logger.debug('Wasp Expression: {}'.format(wasp.to_string(wasp_exp)))
+        download = lambda fi, outdir: self.download_shock(fi['shock_url'], user, token,
+                                                          fi['shock_id'], outdir)
+        dispatcher = None
+        if distribute:
+            upload = lambda path: asmtypes.FileInfo(path, shock_url=url,
+                                                    shock_id=self.upload(url, user, token, path)['data']['id'])
+            killed = lambda pmanager=self.pmanager: pmanager.job_killed(user, job_id)
+            dispatcher = subjobs.SubJobs(self.metadata, self.publisher, params,
+                                         params.get('queue') or self.queues[0],
+                                         download, upload, killed)
+        ## Shared stages run by the parent of a child job
+        bindings = None
+        if params.get('bindings'):
+            bindings = subjobs.bound_links(params['bindings'], download,
+                                           os.path.join(jobpath, 'bindings'))
+        w_engine = wasp.WaspEngine(self.pmanager, job_data, self.metadata, dispatcher, bindings)
 
         ###### Run Job
         try:
@@ -382,46 +349,47 @@ class ArastConsumer:
             ###### Upload all result files and place them into appropriate tags
             uploaded_fsets = job_data.upload_results(url, token)
 
-            # Format report
-            new_report = open('{}.tmp'.format(self.out_report_name), 'w')
-
-            ### Log errors
-            if len(job_data['errors']) > 0:
-                new_report.write('PIPELINE ERRORS\n')
-                for i,e in enumerate(job_data['errors']):
-                    new_report.write('{}: {}\n'.format(i, e))
-            try: ## Get Quast output
-                quast_report = job_data['wasp_chain'].find_module('quast')['data'].find_type('report')[0].files[0]
-                with open(quast_report) as q:
-                    new_report.write(q.read())
-            except:
-                new_report.write('No Summary File Generated!\n\n\n')
-            self.out_report.close()
-            with open(self.out_report_name) as old:
-                new_report.write(old.read())
-
-            for log in job_data['logfiles']:
-                new_report.write('\n{1} {0} {1}\n'.format(os.path.basename(log), '='*20))
-                with open(log) as l:
-                    new_report.write(l.read())
-
-            ### Log tracebacks
-            if len(job_data['tracebacks']) > 0:
-                new_report.write('EXCEPTION TRACEBACKS\n')
-                for i,e in enumerate(job_data['tracebacks']):
-                    new_report.write('{}: {}\n'.format(i, e))
-
-            new_report.close()
+            # Format report, streaming the summary, job log and stage logs
+            with open('{}.tmp'.format(self.out_report_name), 'w') as new_report:
+                report = stage_log.ReportWriter(new_report)
+
+                ### Log errors
+                if len(job_data['errors']) > 0:
+                    report.write('PIPELINE ERRORS\n')
+                    for i,e in enumerate(job_data['errors']):
+                        report.write('{}: {}\n'.format(i, e))
+                try: ## Get Quast output
+                    quast_report = job_data['wasp_chain'].find_module('quast')['data'].find_type('report')[0].files[0]
+                    with open(quast_report) as q:
+                        report.copy(q)
+                except:
+                    report.write('No Summary File Generated!\n\n\n')
+                self.out_report.close()
+                with open(self.out_report_name) as old:
+                    report.copy(old)
+
+                for log in job_data['logfiles']:
+                    report.add_log(log)
+
+                ### Log tracebacks
+                if len(job_data['tracebacks']) > 0:
+                    report.write('EXCEPTION TRACEBACKS\n')
+                    for i,e in enumerate(job_data['tracebacks']):
+                        report.write('{}: {}\n'.format(i, e))
+                report_index = report.write_index()
+
             os.remove(self.out_report_name)
             shutil.move(new_report.name, self.out_report_name)
             res = self.upload(url, user, token, self.out_report_name)
             report_info = asmtypes.FileInfo(self.out_report_name, shock_url=url, shock_id=res['data']['id'])
 
             self.metadata.update_job(uid, 'report', [asmtypes.set_factory('report', [report_info])])
+            self.metadata.update_job(uid, 'report_index', report_index)
             status = 'Complete with errors' if job_data.get('errors') else 'Complete'
 
             ## Make compatible with JSON dumps()
             del job_data['out_report']
+            del job_data['checkpoint']
             del job_data['initial_reads']
             del job_data['raw_reads']
             self.metadata.update_job(uid, 'data', job_data)
@@ -446,14 +414,22 @@ class ArastConsumer:
             logger.info('============== JOB KILLED ===============')
 
         finally:
+            try:
+                self.metadata.insert_stage_stats(job_data.get('stage_stats'))
+            except Exception as e:
+                logger.error('Could not record stage statistics: {}'.format(e))
             self.remove_job_from_lists(job_data)
-            logger.debug('Reinitialize plugin manager...') # Reinitialize to get live changes
-            self.pmanager = ModuleManager(self.threads, self.kill_list, self.kill_list_lock, self.job_list, self.binpath, self.modulebin)
+            self.pmanager.job_finished(job_data['user'], job_data['job_id'])
+            try:
+                self.pmanager.refresh() # Reload plugins changed on disk
+            except Exception as e:
+                logger.error('Could not reload plugins: {}'.format(e))
 
         self.metadata.update_job(uid, 'status', status)
 
 
     def remove_job_from_lists(self, job_data):
+        self.kill_switch.finish(job_data['user'], job_data['job_id'])
         self.job_list_lock.acquire()
         try:
             for i, job in enumerate(self.job_list):
@@ -486,16 +462,16 @@ class ArastConsumer:
         if filetype == 'contigs' or filetype == 'scaffolds':
             res = sclient.upload_contigs(file)
         else:
-            res = sclient.upload_file(file, filetype, curl=True)
+            res = sclient.upload_file(file, filetype)
         return res
 
     def download_shock(self, url, user, token, node_id, outdir):
         sclient = shock.Shock(url, user, token)
-        downloaded = sclient.curl_download_file(node_id, outdir=outdir)
+        downloaded = sclient.download_file(node_id, outdir=outdir, inflate=True)
         return self.extract_file(downloaded)
 
     def download_url(self, url, outdir, token=None):
-        downloaded = shock.curl_download_url(url, outdir=outdir, token=token)
+        downloaded = shock.download_url(url, outdir=outdir, token=token, inflate=True)
         return self.extract_file(downloaded)
 
     def fetch_job(self):
@@ -509,12 +485,23 @@ class ArastConsumer:
         logger.info('Fetching job...')
 
         channel.basic_qos(prefetch_count=1)
+        self.consume(channel)
+        channel.start_consuming()
+
+    def consume(self, channel):
+        self.consumer_tags = []
         for queue in self.queues:
             print 'Using queue: {}'.format(queue)
-            channel.basic_consume(self.callback,
-                              queue=queue)
+            self.consumer_tags.append(channel.basic_consume(self.callback,
+                                                            queue=queue))
 
-        channel.start_consuming()
+    def pause(self, channel):
+        """ Stops taking jobs for admission_retry seconds, without blocking
+        the connection, so the jobs go to other nodes meanwhile """
+        for tag in self.consumer_tags:
+            channel.basic_cancel(tag)
+        self.consumer_tags = []
+        channel.connection.add_timeout(self.admission_retry, lambda: self.consume(channel))
 
     def callback(self, ch, method, properties, body):
         params = json.loads(body)
@@ -528,10 +515,21 @@ class ArastConsumer:
             logger.error('Error: no job_doc found for {}'.format(params.get('job_id')))
             return
 
+        self.done_flag = threading.Event()
+        job = '{}/{}'.format(params['ARASTUSER'], params['job_id'])
         if job_doc.get('status') == 'Terminated by user':
             logger.warn('Job {} was killed, skipping'.format(params.get('job_id')))
+        elif not self.admission.admit(job, *self.job_estimate(params, job_doc)):
+            ## Hand the job back to the queue, for another node or this one later
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            self.done_flag.set()
+            self.pause(ch)
+            return
+        elif job_doc.get('parent') and not self.metadata.claim_job(job_doc['_id'], subjobs.WORKER):
+            self.admission.release(job)
+            logger.info('Job {} was taken by {}, skipping'.format(params.get('job_id'),
+                                                                 job_doc.get('claimed_by')))
         else:
-            self.done_flag = threading.Event()
             uid = None
             try:
                 uid = job_doc['_id']
@@ -541,10 +539,32 @@ class ArastConsumer:
                 status = "[FAIL] {}".format(e)
                 logger.error("{}\n{}".format(status, tb))
                 self.metadata.update_job(uid, 'status', status)
+            finally:
+                self.admission.release(job)
+                self.disk_index.job_finished(params['ARASTUSER'], params['data_id'],
+                                             params['job_id'])
+                self.collector.wakeup.set()
         ch.basic_ack(delivery_tag=method.delivery_tag)
         self.done_flag.set()
 
+    def job_estimate(self, params, job_doc):
+        """ (peak memory, scratch) in bytes of a job, from its plan """
+        estimate = (job_doc.get('plan') or {}).get('estimate')
+        if not estimate:
+            ## Child jobs and jobs submitted without a plan are planned here
+            try:
+                exp = planner.job_expression(params)
+                size = planner.input_size(params['assembly_data']['file_sets'])
+                estimate = planner.plan(exp, self.catalog.get(), size,
+                                        self.metadata.stage_history)['estimate']
+            except Exception as e:
+                logger.warning('Could not estimate job {}: {}'.format(params.get('job_id'), e))
+                return 0, 0
+        return int(estimate.get('peak_memory') or 0), int(estimate.get('scratch') or 0)
+
     def start(self):
+        self.collector.start()
+        KillListener(self.rmq_host, self.rmq_port, self.kill_switch).start()
         self.fetch_job()
 
     def extract_file(self, filename):
@@ -553,20 +573,26 @@ class ArastConsumer:
 
         filepath = os.path.dirname(filename)
         uncompressed = ['fasta', 'fa', 'fastq', 'fq', 'fna', 'h5' ]
-        supported = ['tar.gz', 'tar.bz2', 'bz2', 'gz', 'lz',
-                     'rar', 'tar', 'tgz','zip']
+        unp_supported = ['lz', 'rar', 'xz']
         for ext in uncompressed:
             if filename.endswith('.'+ext):
                 return filename
-        for ext in supported:
+        if extract.compressed_ext(filename):
+            extracted_file = extract.extracted_path(filename)
+            if os.path.exists(extracted_file): # Check extracted already
+                return extracted_file
+            logger.info("Extracting {}...".format(filename))
+            try:
+                return extract.inflate_file(filename)
+            except Exception as e:
+                logger.error("Extraction of {} failed: {}".format(filename, e))
+                raise Exception('Archive structure error')
+        for ext in unp_supported:
             if filename.endswith('.'+ext):
                 extracted_file = filename[:filename.index(ext)-1]
                 if os.path.exists(extracted_file): # Check extracted already
                     return extracted_file
                 logger.info("Extracting {}...".format(filename))
-                # p = subprocess.Popen([unp_bin, filename],
-                #                      cwd=filepath, stderr=subprocess.STDOUT)
-                # p.wait()
                 # Hide the "broken pipe" message from unp
                 out = subprocess.Popen([unp_bin, filename],
                                        cwd=filepath,
@@ -596,29 +622,35 @@ def touch(path):
 def is_filename(word):
     return word.find('.') != -1 and word.find('=') == -1
 
-def is_dir_busy(d):
-    busy = False
-    if not os.path.exists(d):
-        logger.info("GC: directory not longer exists: {}".format(d))
-        return False
-    if re.search(r'raw/*$', d): # data path: check if no job directories exist
-        fname = os.path.join(d, "_READY_")
-        dirs = glob.glob(d + '/../*/')
-        logger.debug("GC: data directory {} contains {} jobs".format(d, len(dirs)-1))
-        busy = len(dirs) > 1 or not os.path.exists(fname)
-    else:                       # job path
-        fname1 = os.path.join(d, '_DONE_')
-        fname2 = os.path.join(d, '_CANCELLED_')
-        busy = not (os.path.exists(fname1) or os.path.exists(fname2))
-    if busy:
-        logger.debug("GC: directory is busy: {}".format(d))
-    return busy
-
-def free_space_in_path(path):
-    s = os.statvfs(path)
-    free_space = float(s.f_bsize * s.f_bavail / (10**9))
-    logger.debug("Free space in {}: {} GB".format(path, free_space))
-    return free_space
+class KillListener(threading.Thread):
+    """ Thread passing kill requests to the jobs of this worker as they arrive """
+    def __init__(self, rmq_host, rmq_port, kill_switch):
+        self.rmq_host = rmq_host
+        self.rmq_port = rmq_port
+        self.kill_switch = kill_switch
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def run(self):
+        while True:
+            try:
+                connection = pika.BlockingConnection(pika.ConnectionParameters(
+                        host=self.rmq_host, port=self.rmq_port))
+                channel = connection.channel()
+                channel.exchange_declare(exchange='kill', type='fanout')
+                queue_name = channel.queue_declare(exclusive=True).method.queue
+                channel.queue_bind(exchange='kill', queue=queue_name)
+                channel.basic_consume(self.callback, queue=queue_name, no_ack=True)
+                channel.start_consuming()
+            except Exception as e:
+                logger.error('Kill listener disconnected, reconnecting: {}'.format(e))
+                time.sleep(5)
+
+    def callback(self, ch, method, properties, body):
+        request = json.loads(body)
+        if self.kill_switch.kill(request['user'], request['job_id']):
+            logger.warning('Killing job {} of {}'.format(request['job_id'], request['user']))
+
 
 class UpdateTimer(threading.Thread):
     """ Thread for updating time in the mongodb record (for arast stat). """
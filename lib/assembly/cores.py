@@ -0,0 +1,72 @@
+"""
+Core broker of a compute node.
+
+All workers on a node draw the cores of their plugin stages from one
+pool, recorded in a locked file in the data path.  A stage declares the
+threads its tool can use in the [Resources] section of its .asm-plugin:
+
+    [Resources]
+    threads = all     # scales with cores
+    threads = 1       # single-threaded (or any fixed maximum)
+
+At launch it is granted what it can use of the free cores, and never
+less than the static share (cores / workers) that every stage used to
+get.  Grants are returned when the stage exits; grants of processes
+that died are reclaimed.
+"""
+
+import logging
+import multiprocessing
+import os
+import time
+import uuid
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+CORES_FILE = '.cores.json'
+
+
+class CoreBroker:
+    def __init__(self, datapath, workers, cores=None):
+        """ WORKERS is the number of consumers sharing the node """
+        self.index_file = os.path.join(datapath, CORES_FILE)
+        self.cores = cores or multiprocessing.cpu_count()
+        self.workers = max(1, int(workers))
+
+    @property
+    def fair_share(self):
+        return max(1, self.cores / self.workers)
+
+    def _index(self):
+        return utils.locked_json(self.index_file, {'grants': {}})
+
+    def acquire(self, threads, label=''):
+        """
+        Grants cores for a stage that can use THREADS (a number, 'all', or
+        None if undeclared).  Returns (grant id, number of cores).
+        """
+        if threads is None:
+            want = self.fair_share
+        elif str(threads).lower() == 'all':
+            want = self.cores
+        else:
+            want = min(int(threads), self.cores)
+        grant_id = str(uuid.uuid4())
+        with self._index() as index:
+            grants = index['grants']
+            for gid in [gid for gid, g in grants.items() if not utils.pid_alive(g['pid'])]:
+                del grants[gid]
+            free = self.cores - sum(g['cores'] for g in grants.values())
+            cores = max(1, min(want, max(self.fair_share, free)))
+            grants[grant_id] = {'pid': os.getpid(),
+                                'cores': cores,
+                                'label': label,
+                                'time': time.time()}
+        logger.info('Granted {} of {} cores to {} ({} free)'.format(cores, self.cores, label, free))
+        return grant_id, cores
+
+    def release(self, grant_id):
+        with self._index() as index:
+            index['grants'].pop(grant_id, None)
@@ -0,0 +1,207 @@
+"""
+Disk usage index and garbage collector for a compute node's data path.
+
+The index records the size, last access, busy state and owning jobs of
+every data (user/data_id/raw) and job (user/data_id/job_id) directory.
+It is updated as jobs start and finish, so eviction candidates are
+picked without walking the filesystem.  The index is shared by all
+workers on the node; one collector at a time evicts in LRU order until
+free space reaches the target watermark.
+"""
+
+import errno
+import fcntl
+import glob
+import logging
+import os
+import shutil
+import threading
+import time
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = '.disk_index.json'
+GC_LOCK = '.gc.lock'
+
+
+class DiskIndex:
+    def __init__(self, datapath, skip=()):
+        """ SKIP lists top level directories of DATAPATH that are not indexed """
+        self.datapath = datapath
+        self.index_file = os.path.join(datapath, INDEX_FILE)
+        self.skip = set(skip)
+
+    def _index(self, write=True):
+        return utils.locked_json(self.index_file, {'dirs': {}, 'built': False}, write)
+
+    def _job_dirs(self, user, data_id, job_id):
+        base = '{}/{}'.format(user, data_id)
+        return [(base + '/raw', 'data'), ('{}/{}'.format(base, job_id), 'job')]
+
+    def job_started(self, user, data_id, job_id):
+        """ Marks the data and job directories of a job as busy """
+        owner = '{}/{}'.format(user, job_id)
+        with self._index() as index:
+            for path, kind in self._job_dirs(user, data_id, job_id):
+                entry = index['dirs'].setdefault(path, {'kind': kind, 'size': 0, 'jobs': {}})
+                entry['jobs'][owner] = os.getpid()
+                entry['atime'] = time.time()
+
+    def job_finished(self, user, data_id, job_id):
+        """ Releases the directories of a job and records their sizes """
+        owner = '{}/{}'.format(user, job_id)
+        sizes = {}
+        for path, _ in self._job_dirs(user, data_id, job_id):
+            sizes[path] = utils.tree_size(os.path.join(self.datapath, path))
+        with self._index() as index:
+            for path, size in sizes.items():
+                entry = index['dirs'].get(path)
+                if entry:
+                    entry['jobs'].pop(owner, None)
+                    entry['size'] = size
+                    entry['atime'] = time.time()
+
+    def candidates(self):
+        """ Idle directories, least recently used (then largest) first """
+        with self._index(write=False) as index:
+            dirs = index['dirs']
+        in_use = set(p.rsplit('/', 1)[0] for p, e in dirs.items() if e['kind'] == 'job')
+        idle = []
+        for path, entry in dirs.items():
+            if is_busy(entry):
+                continue
+            ## Data directories go only after all of their jobs
+            if entry['kind'] == 'data' and path.rsplit('/', 1)[0] in in_use:
+                continue
+            idle.append((entry['atime'], -entry['size'], path))
+        idle.sort()
+        return [(path, -neg_size, atime) for atime, neg_size, path in idle]
+
+    def remove(self, path):
+        """ Deletes an idle directory; returns False if it became busy """
+        with self._index() as index:
+            entry = index['dirs'].get(path)
+            if entry and is_busy(entry):
+                return False
+            index['dirs'].pop(path, None)
+        full = os.path.join(self.datapath, path)
+        shutil.rmtree(full, ignore_errors=True)
+        parent = os.path.dirname(full)
+        try:
+            os.rmdir(parent)
+            logger.info('GC: removing empty directory: {}'.format(parent))
+        except OSError:
+            pass
+        return True
+
+    def build(self):
+        """ Indexes existing directories once per node """
+        with self._index(write=False) as index:
+            if index['built']:
+                return
+        logger.info('GC: indexing {}'.format(self.datapath))
+        found = {}
+        for d in glob.glob(os.path.join(self.datapath, '*/*/*/')):
+            path = os.path.relpath(d, self.datapath)
+            if path.split('/')[0] in self.skip:
+                continue
+            try:
+                atime = os.path.getmtime(d)
+            except OSError:
+                continue
+            found[path] = {'kind': 'data' if path.endswith('/raw') else 'job',
+                           'size': utils.tree_size(d), 'jobs': {}, 'atime': atime}
+        with self._index() as index:
+            for path, entry in found.items():
+                index['dirs'].setdefault(path, entry)
+            index['built'] = True
+        logger.info('GC: indexed {} directories'.format(len(found)))
+
+
+class DiskCollector(threading.Thread):
+    """ Evicts idle directories when free space drops below MIN_FREE (GB),
+    until TARGET_FREE is available, and expires old directories. """
+    def __init__(self, index, stage_cache, min_free, target_free, expiration_days, interval):
+        threading.Thread.__init__(self, name='gc')
+        self.daemon = True
+        self.index = index
+        self.stage_cache = stage_cache
+        self.min_free = min_free
+        self.target_free = max(target_free, min_free)
+        self.expiration = expiration_days * 86400
+        self.interval = interval
+        self.wakeup = threading.Event()
+
+    def run(self):
+        try:
+            self.index.build()
+        except Exception as e:
+            logger.error('GC: could not index data path: {}'.format(e))
+        while True:
+            try:
+                self.collect()
+            except Exception as e:
+                logger.error('GC: unexpected error: {}'.format(e))
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def collect(self, block=False):
+        """ One eviction pass, skipped if another worker is collecting
+        unless BLOCK.  Returns the free space in GB. """
+        with open(os.path.join(self.index.datapath, GC_LOCK), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | (0 if block else fcntl.LOCK_NB))
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return free_space_in_path(self.index.datapath)
+            try:
+                return self._collect()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _collect(self):
+        datapath = self.index.datapath
+        now = time.time()
+        free_space = free_space_in_path(datapath)
+        ## Cached stages hold hard links to job data, drop them first
+        while free_space < self.target_free and self.stage_cache.pop_lru():
+            free_space = free_space_in_path(datapath)
+        for path, size, atime in self.index.candidates():
+            expired = now - atime > self.expiration
+            if not expired and free_space >= self.target_free:
+                break
+            if self.index.remove(path):
+                if expired:
+                    logger.info('GC: removing expired directory: {} (last used {:.1f} days ago)'
+                                .format(path, (now - atime) / 86400))
+                else:
+                    logger.info('GC: space required; {} removed ({} bytes)'.format(path, size))
+                free_space = free_space_in_path(datapath)
+        return free_space
+
+    def ensure_space(self):
+        """ Blocks until at least MIN_FREE GB are available """
+        free_space = free_space_in_path(self.index.datapath)
+        while free_space < self.min_free:
+            free_space = self.collect(block=True)
+            if free_space < self.min_free:
+                logger.warning('GC: free space {} < {} GB; waiting for jobs to complete to reclaim space...'
+                               .format(free_space, self.min_free))
+                time.sleep(20)
+        if free_space < self.target_free:
+            self.wakeup.set()
+        return free_space
+
+
+def is_busy(entry):
+    """ True if a live process still uses the directory """
+    return any(utils.pid_alive(pid) for pid in entry['jobs'].values())
+
+def free_space_in_path(path):
+    s = os.statvfs(path)
+    free_space = float(s.f_bsize * s.f_bavail / (10**9))
+    logger.debug("Free space in {}: {} GB".format(path, free_space))
+    return free_space
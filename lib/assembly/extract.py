@@ -0,0 +1,208 @@
+"""
+In-process decompression of gz, bz2, xz, zip and tar inputs.
+
+Compressed data can be inflated while it is being downloaded, so the
+archive never lands on disk next to its inflated copy.
+"""
+
+import bz2
+import hashlib
+import logging
+import os
+import tarfile
+import zipfile
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 20
+
+TAR_EXTS = ['tar.gz', 'tar.bz2', 'tar.xz', 'tgz', 'tar']
+STREAM_EXTS = ['gz', 'bz2', 'xz']
+## Longest suffix first
+EXTS = TAR_EXTS + STREAM_EXTS + ['zip']
+
+
+class Error(Exception):
+    """Base class for exceptions in this module"""
+    pass
+
+
+def compressed_ext(filename):
+    """ Returns the supported archive extension of FILENAME, or None """
+    for ext in EXTS:
+        if filename.endswith('.' + ext):
+            if ext.endswith('xz') and lzma is None:
+                return None
+            return ext
+    return None
+
+def streamable(filename):
+    """ True if FILENAME can be inflated from a sequential stream """
+    ext = compressed_ext(filename)
+    return ext is not None and ext != 'zip'
+
+def extracted_path(filename):
+    """ Name of the file an archive is expected to inflate to """
+    ext = compressed_ext(filename)
+    return filename[:-(len(ext) + 1)] if ext else filename
+
+
+class MultiStreamDecompressor(object):
+    """ Incremental decompressor that handles concatenated streams (bgzip, pbzip2) """
+    def __init__(self, factory):
+        self.factory = factory
+        self.d = factory()
+
+    def decompress(self, data):
+        out = []
+        while data:
+            try:
+                out.append(self.d.decompress(data))
+            except EOFError: # bz2/lzma: previous stream ended on a chunk boundary
+                self.d = self.factory()
+                continue
+            data = self.d.unused_data
+            if data:
+                self.d = self.factory()
+        return b''.join(out)
+
+    def flush(self):
+        if hasattr(self.d, 'flush'):
+            return self.d.flush()
+        return b''
+
+
+def decompressor(ext):
+    if ext == 'gz':
+        return MultiStreamDecompressor(lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+    elif ext == 'bz2':
+        return MultiStreamDecompressor(bz2.BZ2Decompressor)
+    elif ext == 'xz' and lzma is not None:
+        return MultiStreamDecompressor(lzma.LZMADecompressor)
+    raise Error('No stream decompressor for .{}'.format(ext))
+
+
+class ChunkReader(object):
+    """ File-like object over an iterator of byte chunks, hashing what it reads """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = b''
+        self.pos = 0
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.pos >= len(self.buf):
+                try:
+                    self.buf = next(self.chunks)
+                except StopIteration:
+                    break
+                self.pos = 0
+                self.md5.update(self.buf)
+            end = len(self.buf) if size < 0 else min(len(self.buf), self.pos + size)
+            parts.append(self.buf[self.pos:end])
+            if size > 0:
+                size -= end - self.pos
+            self.pos = end
+        return b''.join(parts)
+
+
+class InflatingReader(object):
+    """ File-like object yielding the decompressed content of a reader """
+    def __init__(self, reader, ext):
+        self.reader = reader
+        self.inflater = decompressor(ext)
+        self.chunks = ChunkReader(self._inflate())
+
+    def _inflate(self):
+        for chunk in iter(lambda: self.reader.read(CHUNK_SIZE), b''):
+            data = self.inflater.decompress(chunk)
+            if data:
+                yield data
+        yield self.inflater.flush()
+
+    def read(self, size=-1):
+        return self.chunks.read(size)
+
+
+def inflate_stream(stream, archive, outdir):
+    """
+    Decompresses STREAM, the content of ARCHIVE, into OUTDIR.
+    Returns the path of the inflated file.
+    """
+    ext = compressed_ext(archive)
+    target = os.path.join(outdir, os.path.basename(extracted_path(archive)))
+    if ext in TAR_EXTS:
+        if ext == 'tar.xz':
+            stream, mode = InflatingReader(stream, 'xz'), 'r|'
+        else:
+            mode = 'r|*'
+        tar = tarfile.open(fileobj=stream, mode=mode)
+        try:
+            for member in tar:
+                if not safe_member(member, outdir):
+                    logger.warning('Skipping unsafe archive member: {}'.format(member.name))
+                    continue
+                tar.extract(member, outdir)
+        finally:
+            tar.close()
+    elif ext in STREAM_EXTS:
+        inflater = decompressor(ext)
+        part = target + '.part'
+        with open(part, 'wb') as out:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                out.write(inflater.decompress(chunk))
+            out.write(inflater.flush())
+        os.rename(part, target)
+    else:
+        raise Error('Cannot stream archive: {}'.format(archive))
+    if not os.path.exists(target):
+        raise Error('Archive structure error: {} not in {}'.format(
+                os.path.basename(target), os.path.basename(archive)))
+    return target
+
+
+def safe_member(member, outdir):
+    """ True if the tar MEMBER, and the target of a link member, stay in OUTDIR """
+    root = os.path.realpath(outdir)
+    def inside(path):
+        path = os.path.realpath(os.path.join(root, path))
+        return path == root or path.startswith(root + os.sep)
+    if os.path.isabs(member.name) or '..' in member.name.split('/') or not inside(member.name):
+        return False
+    if member.issym():
+        return inside(os.path.join(os.path.dirname(member.name), member.linkname))
+    if member.islnk():
+        return inside(member.linkname)
+    return member.isfile() or member.isdir()
+
+
+def inflate_file(archive, remove=True):
+    """
+    Decompresses ARCHIVE next to itself and returns the inflated path.
+    The archive is removed afterwards unless REMOVE is False.
+    """
+    outdir = os.path.dirname(archive)
+    if compressed_ext(archive) == 'zip':
+        with zipfile.ZipFile(archive) as z:
+            z.extractall(outdir)
+        target = extracted_path(archive)
+        if not os.path.exists(target):
+            raise Error('Archive structure error: {}'.format(archive))
+    else:
+        with open(archive, 'rb') as f:
+            target = inflate_stream(f, archive, outdir)
+    if remove:
+        os.remove(archive)
+    return target
+
@@ -0,0 +1,121 @@
+"""
+Single-pass statistics of FASTA files.
+
+A file is memory-mapped and scanned record by record in bounded chunks,
+collecting sequence lengths, GC and N counts at once.  Results are
+memoized by file identity (path, size and mtime), so ranking several
+assemblies on N50 and ambiguity reads each contig file only once.
+"""
+
+import collections
+import logging
+import mmap
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 22
+CACHE_ENTRIES = 256
+WHITESPACE = ' \t\r\n'
+
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def stats(fasta):
+    """
+    Statistics of the sequences in FASTA:
+      lengths  sequence lengths, longest first
+      count    number of sequences
+      total    total sequence length
+      gc       G and C bases
+      n_count  ambiguous (N) bases
+      gc_ratio, n50, l50
+    The returned dict is shared between callers and must not be modified.
+    """
+    path = os.path.abspath(fasta)
+    st = os.stat(path)
+    ident = (path, st.st_size, st.st_mtime)
+    with _cache_lock:
+        if ident in _cache:
+            result = _cache.pop(ident)
+            _cache[ident] = result
+            return result
+    result = scan(path, st.st_size)
+    with _cache_lock:
+        _cache[ident] = result
+        while len(_cache) > CACHE_ENTRIES:
+            _cache.popitem(last=False)
+    return result
+
+def scan(path, size):
+    lengths = []
+    gc = 0
+    n_count = 0
+    if size:
+        with open(path, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            ## Text before the first header is not part of any record
+            pos = 0 if m[:1] == '>' else m.find('\n>')
+            if pos > 0:
+                pos += 1
+            while pos != -1:
+                eol = m.find('\n', pos)
+                if eol == -1:
+                    lengths.append(0)
+                    break
+                nxt = m.find('\n>', eol)
+                end = size if nxt == -1 else nxt
+                length = 0
+                for start in xrange(eol, end, CHUNK_SIZE):
+                    chunk = m[start:min(start + CHUNK_SIZE, end)].translate(None, WHITESPACE)
+                    length += len(chunk)
+                    gc += (chunk.count('G') + chunk.count('C') +
+                           chunk.count('g') + chunk.count('c'))
+                    n_count += chunk.count('N') # Soft-masked 'n' is not counted
+                lengths.append(length)
+                pos = nxt + 1 if nxt != -1 else -1
+        finally:
+            m.close()
+    lengths.sort(reverse=True)
+    total = sum(lengths)
+    n50, l50 = nx(lengths, total)
+    return {'lengths': lengths,
+            'count': len(lengths),
+            'total': total,
+            'gc': gc,
+            'n_count': n_count,
+            'gc_ratio': float(gc) / total if total else 0.0,
+            'n50': n50,
+            'l50': l50}
+
+def nx(lengths, size, fraction=0.5):
+    """
+    (Nx, Lx) of LENGTHS (longest first): the length of, and the number
+    of, the longest sequences that together exceed FRACTION of SIZE.
+    (0, 0) if they never do.
+    """
+    target = size * fraction
+    covered = 0
+    for i, length in enumerate(lengths):
+        covered += length
+        if covered > target:
+            return length, i + 1
+    return 0, 0
+
+def n50(fasta):
+    return stats(fasta)['n50']
+
+def ng50(fasta, genome_size):
+    """ N50 relative to an expected GENOME_SIZE rather than the assembly size """
+    return nx(stats(fasta)['lengths'], genome_size)[0]
+
+def ambig_ratio(fasta):
+    """ Number of N's per 100 Kbp """
+    s = stats(fasta)
+    return 100000.0 * s['n_count'] / s['total'] if s['total'] else 0
+
+def total_length(fasta):
+    return stats(fasta)['total']
@@ -145,10 +145,8 @@ class ArastJob(dict):
         return new_sets
 
     def upload_file(self, url, user, token, file, filetype='default'):
-        files = {}
-        files["file"] = (os.path.basename(file), open(file, 'rb'))
         sclient = shock.Shock(url, user, token)
-        res = sclient.upload_file(file, filetype, curl=True)
+        res = sclient.upload_file(file, filetype)
         return res
 
     def wasp_data(self):
@@ -2,19 +2,32 @@
 Handles metadata and MongoDB
 """
 
+import atexit
 import config
+import copy
 import logging
+import os
 import pymongo
+import threading
 import uuid
 import time
 import json
 import re
+import socket
+from collections import OrderedDict
 from ConfigParser import SafeConfigParser
 
+try:
+    from pymongo import UpdateOne
+except ImportError: # pymongo < 3
+    UpdateOne = None
+
 logger = logging.getLogger(__name__)
 
 class MetadataConnection:
-    def __init__(self, host, port, db, collections):
+    def __init__(self, host, port, db, collections, write_interval=None):
+        """ With WRITE_INTERVAL (seconds), job updates are buffered by a
+        MetadataWriter instead of being written one at a time """
         self.host = host
         self.port = port
         self.db = db
@@ -22,6 +35,7 @@ class MetadataConnection:
         self.auth_collection = collections.get('auth')
         self.data_collection = collections.get('data')
         self.rjobs_collection = collections.get('running')
+        self.stats_collection = collections.get('stats', 'stage_stats')
 
         # Connect
         self.connection = pymongo.mongo_client.MongoClient(self.host, self.port)
@@ -34,6 +48,11 @@ class MetadataConnection:
         self.jobs.ensure_index([("ARASTUSER", pymongo.ASCENDING), ("job_id", pymongo.ASCENDING)])
 
         self.data_collection = self.get_data()
+        self.database[self.stats_collection].ensure_index([("module", pymongo.ASCENDING),
+                                                           ("input_size", pymongo.ASCENDING)])
+
+        self.write_interval = write_interval
+        self._writer = None
 
     def get_jobs(self):
         """Fetch approriate database and collection for jobs."""
@@ -99,26 +118,50 @@ class MetadataConnection:
         return self.get_next_id(user, 'ids')
 
     def update_job(self, job_id, field, value):
-        jobs = self.get_jobs()
-        jobs.update({'_id' : job_id},
-                    {'$set' : {field : value}})
-
-        if jobs.find_one({'_id' : job_id}) is not None:
-            if re.search(r'(status|contig_ids)', field):
-                logger.info("Job updated: %s - %s - %s" % (job_id, field, value))
-            else:
-                logger.debug("Job updated: %s - %s - %s" % (job_id, field, value))
+        if re.search(r'(status|contig_ids)', field):
+            logger.info("Job updated: %s - %s - %s" % (job_id, field, value))
         else:
-            logger.warning("Job %s not updated!" % job_id)
-
-    def list_jobs(self, user):
-        r = []
-        jobs = self.get_jobs()
-        for j in jobs.find({'ARASTUSER':user}).sort('job_id', 1):
-            r.append(j)
-        return r
+            logger.debug("Job updated: %s - %s - %s" % (job_id, field, value))
+
+        writer = self.writer()
+        if writer is None:
+            self.get_jobs().update({'_id' : job_id},
+                                   {'$set' : {field : value}})
+            return
+        writer.set(job_id, field, value)
+        if field == 'status':
+            writer.flush()
+
+    def writer(self):
+        """ The write-behind buffer of this process, if enabled """
+        if not self.write_interval:
+            return None
+        if self._writer is None or self._writer.pid != os.getpid():
+            self._writer = MetadataWriter(self.get_jobs(), self.write_interval)
+            self._writer.start()
+            atexit.register(self._writer.flush)
+        return self._writer
+
+    def flush(self):
+        """ Writes buffered job updates """
+        if self._writer is not None and self._writer.pid == os.getpid():
+            self._writer.flush()
+
+    def list_jobs(self, user, records=None, before=None, fields=None):
+        """ Cursor over the jobs of USER, newest first.  RECORDS limits the
+        count, BEFORE (a job_id) continues from a previous page and FIELDS
+        is a projection.  Served by the (ARASTUSER, job_id) index. """
+        self.flush()
+        query = {'ARASTUSER': user}
+        if before:
+            query['job_id'] = {'$lt': int(before)}
+        cursor = self.get_jobs().find(query, fields).sort('job_id', pymongo.DESCENDING)
+        if records:
+            cursor = cursor.limit(int(records))
+        return cursor
 
     def get_job(self, user, job_id):
+        self.flush()
         try:
             job = self.get_jobs().find({'ARASTUSER':user, 'job_id':int(job_id)})[0]
         except:
@@ -127,12 +170,27 @@ class MetadataConnection:
         return job
 
     def get_job_by_uid(self, uid):
+        self.flush()
         try:
             job = self.get_jobs().find({'_id': uid})[0]
         except:
             job = None
         return job
 
+    def claim_job(self, uid, owner):
+        """ Takes job UID for OWNER unless another owner already holds it.
+        Returns the job document, or None if it was claimed by someone else """
+        self.flush()
+        return self.get_jobs().find_and_modify(query={'_id': uid,
+                                                      'claimed_by': {'$in': [None, owner]}},
+                                               update={'$set': {'claimed_by': owner}},
+                                               new=True)
+
+    def list_subjobs(self, user, job_id):
+        """ Child jobs of job JOB_ID, see subjobs.SubJobs """
+        self.flush()
+        return list(self.get_jobs().find({'ARASTUSER': user, 'parent': int(job_id)}))
+
     def job_is_complete(self, user, job_id):
         job = self.get_job(user, job_id)
         return job['status'].find('success') != -1
@@ -179,6 +237,33 @@ class MetadataConnection:
         return doc
 
 
+######## STAGE STATISTICS ############
+    def insert_stage_stats(self, records):
+        """ Records the resource usage of finished stages """
+        if records:
+            self.database[self.stats_collection].insert([dict(r) for r in records])
+
+    def stage_history(self, module, input_size=None, limit=20):
+        """ Latest resource records of MODULE, preferably of runs on
+        inputs within a factor of two of INPUT_SIZE """
+        stats = self.database[self.stats_collection]
+        query = {'module': module}
+        docs = []
+        if input_size:
+            similar = dict(query, input_size={'$gte': input_size / 2, '$lte': input_size * 2})
+            docs = list(stats.find(similar).sort('timestamp', pymongo.DESCENDING).limit(limit))
+        if not docs:
+            docs = list(stats.find(query).sort('timestamp', pymongo.DESCENDING).limit(limit))
+        return docs
+
+    def user_usage(self, user, since):
+        """ Core-seconds used by the stages of USER's jobs that finished after SINCE """
+        stats = self.database[self.stats_collection]
+        docs = stats.find({'user': user, 'timestamp': {'$gte': since}},
+                          {'wall': True, 'cores': True})
+        return sum((d.get('wall') or 0) * (d.get('cores') or 1) for d in docs)
+
+
 ####### Running jobs ########
     def rjob_insert(self, uid, data):
         fields = ['job_id', 'ARASTUSER', 'pipeline']
@@ -222,3 +307,75 @@ class MetadataConnection:
             elif rjob['status'] == 'queued':
                 d[rjob['ARASTUSER']]['queued'] += 1
         return json.dumps(d)
+
+
+class MetadataWriter(threading.Thread):
+    """ Write-behind buffer for job documents.  $set fields are merged per
+    job and flushed as one bulk write every INTERVAL seconds. """
+    def __init__(self, collection, interval):
+        threading.Thread.__init__(self, name='metadata-writer')
+        self.daemon = True
+        self.collection = collection
+        self.interval = interval
+        self.pid = os.getpid()
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def set(self, uid, field, value):
+        ## Snapshot: callers may keep mutating VALUE until the flush
+        value = copy.deepcopy(value)
+        with self.lock:
+            self.pending.setdefault(uid, {})[field] = value
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e: # Keep the writer alive, flush() requeued the updates
+                logger.error("Job updates not written: {}".format(e))
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, OrderedDict()
+            if not pending:
+                return
+            try:
+                bulk_set(self.collection, pending)
+            except (pymongo.errors.PyMongoError, socket.error) as e:
+                logger.error("Job updates not written, will retry: {}".format(e))
+                self.requeue(pending)
+            except Exception as e:
+                ## A bad document (e.g. not BSON encodable) fails the whole
+                ## batch: write the jobs one by one and drop only its update
+                logger.error("Job updates not written in bulk: {}".format(e))
+                failed = OrderedDict()
+                for uid, fields in pending.items():
+                    try:
+                        bulk_set(self.collection, {uid: fields})
+                    except (pymongo.errors.PyMongoError, socket.error):
+                        failed[uid] = fields
+                    except Exception as e:
+                        logger.error("Update of job {} dropped: {}: {}".format(uid, fields.keys(), e))
+                self.requeue(failed)
+
+    def requeue(self, pending):
+        """ Puts back the unwritten PENDING updates, under newer ones """
+        with self.lock:
+            for uid, fields in self.pending.items():
+                pending.setdefault(uid, {}).update(fields)
+            self.pending = pending
+
+
+def bulk_set(collection, updates):
+    """ Applies {uid: {field: value}} as one unordered bulk write """
+    if UpdateOne is not None:
+        collection.bulk_write([UpdateOne({'_id': uid}, {'$set': fields})
+                               for uid, fields in updates.items()], ordered=False)
+    else:
+        bulk = collection.initialize_unordered_bulk_op()
+        for uid, fields in updates.items():
+            bulk.find({'_id': uid}).update_one({'$set': fields})
+        bulk.execute()
@@ -0,0 +1,437 @@
+"""
+Static planning of Wasp expressions.
+
+A plan walks an expression without running it: every plugin call is
+resolved against the input and output types of the module catalog
+(ar_modules.json), the stages are counted, and the wall time, peak
+memory and scratch disk of each stage are estimated from the recorded
+history of earlier runs on inputs of a similar size.  Modules without a
+history fall back to the memory and scratch declared in the [Resources]
+section of their plugin, as a multiple of the input size ("4x") or an
+absolute size ("8G").
+"""
+
+import json
+import logging
+import os
+import threading
+
+import asmtypes
+import pipe
+import recipes
+import wasp
+
+logger = logging.getLogger(__name__)
+
+ESTIMATED = ('wall', 'peak_memory', 'scratch')
+BUILTINS = set(wasp.add_globals({})) | set(wasp.functions) | set(['READS', 'CONTIGS'])
+
+
+class PlanError(Exception):
+    pass
+
+
+class Catalog:
+    """ Modules of an ar_modules.json file, reloaded when it changes """
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.modules = {}
+        self.lock = threading.Lock()
+
+    def get(self):
+        mtime = os.path.getmtime(self.path)
+        with self.lock:
+            if mtime != self.mtime:
+                with open(self.path) as f:
+                    self.modules = {m['module']: m for m in json.load(f)}
+                self.mtime = mtime
+            return self.modules
+
+
+class Definition:
+    """ A lazy definition, planned when its value is first needed """
+    def __init__(self, name, exp, scope, conditional):
+        self.name = name
+        self.exp = exp
+        self.scope = Scope(scope)
+        for var in wasp.symbols(exp):
+            env = scope.find(var)
+            if env is not None:
+                self.scope[var] = env[var]
+        self.conditional = conditional
+        self.forced = False
+        self.value = []
+
+
+class Lambda:
+    def __init__(self, params, body, scope):
+        self.params = params
+        self.body = body
+        self.scope = scope
+
+
+class Scope(dict):
+    def __init__(self, outer=None):
+        self.outer = outer
+
+    def find(self, var):
+        if var in self:
+            return self
+        if self.outer is None:
+            return None
+        return self.outer.find(var)
+
+
+class Planner:
+    """
+    Symbolic evaluator of Wasp expressions.  Values are the lists of
+    plugins whose outputs an expression may return: both branches of an
+    'if' are planned, and their stages are marked conditional.  As in
+    wasp.eval, definitions are planned only once they are used.
+    """
+    def __init__(self, modules, input_size=None, history=None):
+        self.modules = modules
+        self.input_size = input_size
+        self.history = history
+        self.stages = []
+        self.errors = []
+        self.conditional = 0
+        self.estimates = {}
+        self.definitions = []
+
+    def plan(self, exp):
+        top = Scope()
+        top.update((name, []) for name in BUILTINS)
+        self.eval(exp, top)
+        total = {'wall': 0, 'peak_memory': 0, 'scratch': 0, 'unknown': 0}
+        for stage in self.stages:
+            est = stage['estimate']
+            if not est:
+                total['unknown'] += 1
+                continue
+            total['wall'] += est['wall'] or 0
+            total['peak_memory'] = max(total['peak_memory'], est['peak_memory'] or 0)
+            total['scratch'] += est['scratch'] or 0
+        return {'stages': self.stages,
+                'stage_count': len(self.stages),
+                'input_size': self.input_size,
+                'estimate': total,
+                'skipped': [d.name for d in self.definitions if not d.forced],
+                'errors': self.errors}
+
+    def error(self, msg):
+        if msg not in self.errors:
+            self.errors.append(msg)
+
+    def eval(self, x, scope):
+        if isinstance(x, wasp.Symbol):
+            env = scope.find(x)
+            if env is not None:
+                return self.force(env[x])
+            if x not in self.modules and not x.startswith(':'):
+                self.error('Module "{}" not found'.format(x))
+            return []
+        elif not isinstance(x, list) or not x:
+            return []
+        head = x[0]
+        if head == 'quote':
+            return []
+        elif head in ['contigs', 'paired', 'single', 'reference']:
+            ## Casts replace the link, so their inputs are not type checked
+            for exp in x[1:]:
+                self.eval(exp, scope)
+            return []
+        elif head == 'if':
+            return self.eval_if(x, scope)
+        elif head == 'set!':
+            (_, var, exp) = self.form(x, 3)
+            value = self.eval(exp, scope)
+            (scope.find(var) or scope)[var] = value
+            return []
+        elif head == 'setparam':
+            (_, param, value) = self.form(x, 3)
+            if isinstance(value, wasp.Symbol) and scope.find(value) is not None:
+                self.eval(value, scope)
+            return []
+        elif head == 'define':
+            (_, var, exp) = self.form(x, 3)
+            if wasp.mutates_env(exp):
+                scope[var] = self.eval(exp, scope)
+            else:
+                scope[var] = Definition(var, exp, scope, self.conditional > 0)
+                self.definitions.append(scope[var])
+            return []
+        elif head == 'sort':
+            seq = self.eval(x[1], scope)
+            if len(x) > 4 and x[3] == ':key':
+                fn = self.eval(x[4], scope)
+                for producer in seq or [None]:
+                    self.call(fn, [[producer] if producer else []])
+            return seq
+        elif head == 'lambda':
+            (_, params, body) = self.form(x, 3)
+            return Lambda(params, body, scope)
+        elif head in ['upload', 'all_files']:
+            (_, exp) = self.form(x, 2)
+            return self.eval(exp, scope)
+        elif head == 'get':
+            (_, key, exp) = self.form(x, 3)
+            return self.eval(exp, scope)
+        elif head == 'tar':
+            bare_exp, kwargs = wasp.extract_kwargs(x)
+            for exp in bare_exp[1:]:
+                self.eval(exp, scope)
+            return ['tar']
+        elif head == 'with-timeout':
+            value = self.eval(x[2], scope) if len(x) > 2 else []
+            if len(x) > 3:
+                self.conditional += 1
+                try:
+                    value = merge(value, self.eval(x[3], scope))
+                finally:
+                    self.conditional -= 1
+            return value
+        elif head == 'race':
+            value = []
+            for exp in x[2:]:
+                value = merge(value, self.eval(exp, scope))
+            return value
+        elif head == 'gather':
+            value = []
+            for exp in x[1:]:
+                value = merge(value, self.eval(exp, scope))
+            return value
+        elif head == 'begin':
+            return self.eval_body(x[1:], Scope(scope))
+        elif head == 'prog':
+            return self.eval_body(x[1:], scope)
+        elif head == 'print':
+            self.eval_body(x[1:], scope)
+            return []
+
+        if head in wasp.TYPE_PREDICATES and x[1:] and all(self.pending_call(e, scope) for e in x[1:]):
+            return []
+        args = [self.eval(exp, scope) for exp in x[1:]]
+        if isinstance(head, wasp.Symbol) and scope.find(head) is None and head in self.modules:
+            return self.plugin_call(head, args)
+        return self.call(self.eval(head, scope), args)
+
+    def force(self, value):
+        if not isinstance(value, Definition):
+            return value
+        if not value.forced:
+            value.forced = True
+            self.conditional += value.conditional
+            try:
+                value.value = self.eval(value.exp, value.scope)
+            finally:
+                self.conditional -= value.conditional
+        return value.value
+
+    def pending_call(self, x, scope):
+        """ True if X names a definition not planned yet that calls a plugin """
+        env = isinstance(x, wasp.Symbol) and scope.find(x)
+        if not env or not isinstance(env[x], Definition) or env[x].forced:
+            return False
+        exp = env[x].exp
+        return isinstance(exp, list) and bool(exp) and exp[0] in self.modules
+
+    def form(self, x, length):
+        if len(x) != length:
+            self.error('Malformed expression: {}'.format(wasp.to_string(x)))
+            x = (list(x) + [[]] * length)[:length]
+        return x
+
+    def eval_body(self, body, scope):
+        value = []
+        for exp in body:
+            value = self.eval(exp, scope)
+        return value
+
+    def eval_if(self, x, scope):
+        test, branches = x[1], x[2:4]
+        self.eval(test, scope)
+        before = dict(scope)
+        results = []
+        values = []
+        self.conditional += 1
+        try:
+            for branch in branches:
+                scope.clear()
+                scope.update(before)
+                values.append(self.eval(branch, scope))
+                results.append(dict(scope))
+            ## Either branch's definitions may be live after the 'if'
+            scope.clear()
+            scope.update(before)
+            for result in results:
+                for var, value in result.items():
+                    if var in scope and scope[var] is not value:
+                        value = merge(self.force(scope[var]), self.force(value))
+                    scope[var] = value
+        finally:
+            self.conditional -= 1
+        merged = []
+        for value in values:
+            merged = merge(merged, value)
+        return merged
+
+    def call(self, fn, args):
+        """ Calls a Lambda, or a built-in that returns the producers of its arguments """
+        if isinstance(fn, Lambda):
+            scope = Scope(fn.scope)
+            scope.update(zip(fn.params, args))
+            return self.eval(fn.body, scope)
+        value = []
+        for arg in args:
+            value = merge(value, arg)
+        return value
+
+    def plugin_call(self, module, args):
+        input_type = self.modules[module].get('input_type')
+        inputs = []
+        for arg in args:
+            inputs = merge(inputs, arg)
+        for producer in inputs:
+            output_type = (self.modules.get(producer) or {}).get('output_type')
+            if not compatible(output_type, input_type):
+                self.error('{} and {} have mismatched input/output types'.format(module, producer))
+        self.stages.append({'stage': len(self.stages) + 1,
+                            'module': module,
+                            'inputs': inputs,
+                            'conditional': self.conditional > 0,
+                            'estimate': self.estimate(module)})
+        return [module]
+
+    def estimate(self, module):
+        """ Medians of the recorded resources of MODULE, scaled to the input size """
+        if module in self.estimates:
+            return self.estimates[module]
+        records = []
+        if self.history:
+            try:
+                records = self.history(module, self.input_size)
+            except Exception as e:
+                logger.warning('Could not read stage history of {}: {}'.format(module, e))
+        est = None
+        if records:
+            est = {'samples': len(records)}
+            for key in ESTIMATED:
+                values = []
+                for r in records:
+                    if r.get(key) is None:
+                        continue
+                    scale = 1.0
+                    if self.input_size and r.get('input_size'):
+                        scale = float(self.input_size) / r['input_size']
+                    values.append(r[key] * scale)
+                est[key] = median(values)
+        else:
+            est = self.declared(module)
+        self.estimates[module] = est
+        return est
+
+    def declared(self, module):
+        """ Memory and scratch declared by the plugin of MODULE, or None """
+        entry = self.modules.get(module) or {}
+        est = {'samples': 0, 'wall': None}
+        for key, field in [('peak_memory', 'memory'), ('scratch', 'scratch')]:
+            try:
+                est[key] = declared_size(entry.get(field), self.input_size)
+            except ValueError:
+                logger.warning('Invalid {} declaration of {}: {}'.format(field, module, entry[field]))
+                est[key] = None
+        if est['peak_memory'] is None and est['scratch'] is None:
+            return None
+        return est
+
+
+def plan(exp, modules, input_size=None, history=None):
+    """
+    Plans the Wasp expression EXP (source or compiled) against MODULES,
+    the catalog entries by module name.  HISTORY(module, input_size)
+    returns resource records of earlier runs of a module.
+    """
+    if isinstance(exp, basestring):
+        exp = wasp.compile(exp)
+    return Planner(modules, input_size, history).plan(exp)
+
+
+def input_size(file_sets):
+    """ Total size in bytes of the files of FILE_SETS, as submitted """
+    return sum(fi.get('filesize') or 0 for fs in file_sets for fi in fs.get('file_infos', []))
+
+def declared_size(value, input_size):
+    """
+    Bytes of a resource declaration VALUE: a multiple of INPUT_SIZE
+    ("4x"), or a size with an optional K/M/G/T suffix ("8G").
+    """
+    if value is None:
+        return None
+    value = str(value).strip().upper()
+    if value.endswith('X'):
+        if not input_size:
+            return None
+        return int(float(value[:-1]) * input_size)
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+def compatible(output_type, input_type):
+    """ The check of ModuleManager.run_proc; unknown types pass """
+    if output_type is None or input_type is None:
+        return True
+    return output_type == input_type or output_type in input_type
+
+def merge(a, b):
+    if not isinstance(a, list) or not isinstance(b, list):
+        return b if a is None or a == [] else a
+    return a + [p for p in b if p not in a]
+
+def median(values):
+    if not values:
+        return None
+    values = sorted(values)
+    mid = len(values) / 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+###### Job expressions
+
+def recipe_exp(rname, job_id):
+    """ Compiled recipe RNAME, its :name prefixed with JOB_ID """
+    return wasp.prefix_name(wasp.compile(recipes.get(rname)), str(job_id))
+
+def job_expression(params, subjobs=False):
+    """ The Wasp expression a job request runs: its recipe, Wasp source or pipelines.
+    With SUBJOBS, pipelines are gathered from child jobs """
+    job_id = params['job_id']
+    pipelines = params.get('pipeline')
+    recipe = params.get('recipe')
+    wasp_in = params.get('wasp')
+    recipes.refresh()
+    if recipe:
+        try: return recipe_exp(recipe[0], job_id)
+        except (KeyError, AttributeError): raise PlanError('"{}" recipe not found.'.format(recipe[0]))
+    elif wasp_in:
+        return wasp_in[0]
+    elif not pipelines:
+        return recipe_exp('auto', job_id)
+    elif pipelines:
+        ## Legacy client
+        if pipelines[0] == 'auto':
+            return recipe_exp('auto', job_id)
+        ##########
+        if type(pipelines[0]) is not list: # --assemblers
+            pipelines = [pipelines]
+        all_pipes = []
+        for p in pipelines:
+            all_pipes += pipe.parse_branches(p)
+        logger.debug("pipelines = {}".format(all_pipes))
+        return wasp.pipelines_to_exp(all_pipes, job_id, subjobs)
+    else:
+        raise asmtypes.ArastClientRequestError('Malformed job request.')
@@ -7,26 +7,29 @@ import uuid
 import sys
 import time
 import datetime
-import signal
 import subprocess
 import re
 import multiprocessing
-import signal
 from yapsy.PluginManager import PluginManager
 from yapsy.IPluginLocator import IPluginLocator
-from threading  import Thread
-from Queue import Queue, Empty
 import ConfigParser
 import traceback
 
+import admission
 import assembly
 import asmtypes
+import fasta_stats
 import pipe as phelper
+import stage_log
+import supervisor
+import utils
 import wasp
 
 
 logger = logging.getLogger(__name__)
 
+BINARY_CHECK_INTERVAL = 300 # Seconds a check for a third-party binary is trusted
+
 
 class BasePlugin(object):
     """
@@ -43,6 +46,18 @@ class BasePlugin(object):
     - self.PARAM_IN_CONFIG_FILE
         eg. self.k = 29
     """
+    # Stage outputs may be reused across jobs (see stage_cache) and replayed
+    # when a job resumes (see checkpoint).  Plugins with side effects outside
+    # of their outpath should set this to False.
+    cacheable = True
+    # Plugins reading the job's initial reads (self.initial_data, job_data's
+    # initial_reads) besides their inputs set this, so the stage cache and
+    # checkpoint keys cover them
+    uses_initial_data = False
+    # Wasp cancel scopes of the running stage, see ModuleManager.run_proc
+    cancel_scopes = ()
+    # Cores granted to the running stage by the node's core broker
+    cores_granted = None
 
     def base_call(self, settings, job_data, manager, strict=False):
         """ Plugin wrapper """
@@ -110,40 +125,26 @@ class BasePlugin(object):
                                  stderr=subprocess.STDOUT,
                                  preexec_fn=os.setsid, **kwargs)
 
-            ## Module Logging Thread
-            q = Queue()
-            t = Thread(target=handle_output, args=(p.stdout, q))
-            t.daemon = True # thread dies with the program
-            t.start()
-
-            ## Poll for kill requests
-            while p.poll() is None:
-                if self.killed():
-                    os.killpg(p.pid, signal.SIGTERM)
-                    raise asmtypes.ArastUserInterrupt('Terminated by user')
-
-                ## Flush STDOUT to logs
-                while True:
-                    try:  line = q.get_nowait() # or q.get(timeout=.1)
-                    except Empty:
-                        break
-                    else: # got line
-                        logger.debug(line.strip())
-                        self.is_urgent_output(line)
-                        self.out_module.write(line)
-                time.sleep(5)
-
-            p.wait()
-
-            #Flush again
-            while True:
-                try:  line = q.get_nowait() # or q.get(timeout=.1)
-                except Empty:
-                    break
-                else: # got line
-                    logger.debug(line.strip())
-                    self.is_urgent_output(line)
-                    self.out_module.write(line)
+            ## Wait for output, exit, kill requests and cancellation together
+            proc = supervisor.Supervisor(p)
+            user, job_id = self.job_data['user'], self.job_data['job_id']
+            kill_switch = self.pmanager.kill_switch
+            if kill_switch:
+                kill_switch.watch(user, job_id, proc.waker)
+            for scope in self.cancel_scopes:
+                scope.watchers.append(proc.waker)
+            try:
+                ## Without a kill switch, kill requests are polled
+                proc.run(self.log_output, self.check_interrupts,
+                         poll=None if kill_switch else 5)
+            finally:
+                if kill_switch:
+                    kill_switch.unwatch(user, job_id, proc.waker)
+                for scope in self.cancel_scopes:
+                    scope.watchers.remove(proc.waker)
+            if proc.usage:
+                self.peak_memory = max(self.peak_memory, proc.usage.ru_maxrss * 1024)
+                self.cpu_time += proc.usage.ru_utime + proc.usage.ru_stime
 
             if p.returncode != 0:
                 logger.warn('Process failed with exit code: {}'.format(p.returncode))
@@ -158,6 +159,18 @@ class BasePlugin(object):
         except Exception as e:
             logger.error('Could not write to report: {} -- {}'.format(cmd_string, e))
 
+    def log_output(self, line):
+        self.is_urgent_output(line)
+        self.out_module.write(line)
+
+    def check_interrupts(self):
+        """ Raises if the job was killed or the stage cancelled """
+        if self.killed():
+            raise asmtypes.ArastUserInterrupt('Terminated by user')
+        cancelled = self.cancelled()
+        if cancelled:
+            raise asmtypes.ArastStageCancelled(cancelled)
+
     def is_urgent_output(self, line):
         """
         Plugins should override this if functionality depends on stdout.
@@ -172,26 +185,13 @@ class BasePlugin(object):
 
     def killed(self):
         """ Check the kill queue to see if job should be killed """
+        return self.pmanager.job_killed(self.job_data['user'], self.job_data['job_id'])
 
-        my_user = self.job_data['user']
-        my_jobid = self.job_data['job_id']
-
-        popped = False
-        self.pmanager.kill_list_lock.acquire()
-        try:
-            kl = self.pmanager.kill_list
-            for i,kr in enumerate(kl):
-                if my_user == kr['user'] and str(my_jobid) == kr['job_id']:
-                    kl.pop(i)
-                    popped = True
-        except:
-            logger.error("Unexpected error in removing executed job to be killed from kill_list")
-            raise
-        finally:
-            self.pmanager.kill_list_lock.release()
-
-        return popped
-
+    def cancelled(self):
+        """ Reason the stage was cancelled by a Wasp timeout or race, if it was """
+        for scope in self.cancel_scopes:
+            if scope.cancelled:
+                return scope.reason
 
     def create_directories(self, job_data):
         datapath = (job_data['datapath'] + '/' + str(job_data['job_id']) +
@@ -231,14 +231,17 @@ class BasePlugin(object):
     def init_settings(self, settings, job_data, manager):
         self.outpath = self.create_directories(job_data)
         self.pmanager = manager
+        self.peak_memory = 0
+        self.cpu_time = 0
         self.threads = 1
         self.process_cores = multiprocessing.cpu_count()
         self.arast_threads = int(manager.threads)
-        self.process_threads_allowed = str(self.process_cores / self.arast_threads)
+        self.process_threads_allowed = str(self.cores_granted or
+                                           max(1, self.process_cores / self.arast_threads))
         self.job_data = job_data
         self.tools = {'ins_from_sam': os.path.join(self.pmanager.module_bin_path, 'getinsertsize.py')}
         self.out_report = job_data['out_report'] #Job log file
-        self.out_module = open(os.path.join(self.outpath, '{}.out'.format(self.name)), 'w')
+        self.out_module = manager.stage_logs.open(os.path.join(self.outpath, '{}.out'.format(self.name)))
         job_data['logfiles'].append(self.out_module.name)
         for kv in settings:
             ## set absolute paths
@@ -262,22 +265,7 @@ class BasePlugin(object):
         self.plugin_engine = wasp.WaspEngine(self.pmanager, plugin_data)
         #### Get default outputs of last module and pass on persistent data
         job_data['wasp_chain']['outpath'] = self.outpath
-        if job_data['wasp_chain']['link']:
-            all_sets = []
-            for link in job_data['wasp_chain']['link']:
-                if not link:
-                    continue
-                if isinstance(link['default_output'], asmtypes.FileSet):
-                    all_sets.append(link['default_output']) # Single FileSet
-                elif type(link['default_output']) is list:
-                    all_sets += [fileset for fileset in link['default_output']]
-                elif not link['default_output']:
-                    raise Exception('"{}" stage failed to produce any output.'.format(link['module']))
-                else:
-                    raise Exception('Wasp Link Error')
-            self.data = asmtypes.FileSetContainer(all_sets)
-        else:
-            self.data = job_data.wasp_data()
+        self.data = link_data(job_data['wasp_chain'], job_data)
         self.initial_data = job_data['initial_data']
 
     def _save(self):
@@ -407,10 +395,15 @@ class BasePlugin(object):
         return insert_size, stdev
 
     def calculate_genome_size(self, fasta):
-        s = open(fasta).read()
-        s = re.sub(r'>[^\n\r]*', '', s)
-        s = re.sub(r'\s+', '', s)
-        return len(s)
+        return fasta_stats.total_length(fasta)
+
+    def memory_allowed(self):
+        """ Bytes of RAM the tool may use: what other jobs on the node have not reserved """
+        if self.pmanager.admission:
+            return self.pmanager.admission.memory_for(
+                '{}/{}'.format(self.job_data['user'], self.job_data['job_id']))
+        total, _ = admission.system_memory()
+        return total * int(self.process_threads_allowed) / self.process_cores
 
 class BaseAssembler(BasePlugin):
     """
@@ -616,34 +609,130 @@ class BaseAligner(BasePlugin):
         return
 
 
+class PluginRegistry:
+    """
+    Plugins of PLUGIN_PATH, with the lookups of a yapsy PluginManager.
+    Plugins stay loaded across jobs: refresh() stats the .asm-plugin
+    files and their modules, and loads only the plugins that are new or
+    changed.
+    """
+    def __init__(self, plugin_path):
+        self.plugin_path = plugin_path
+        self.plugins = {} # Name: yapsy PluginInfo
+        self.sources = {} # Config file: (name, module file, mtimes)
+        self.load(self.scan()[0])
+
+    def getPluginByName(self, name):
+        return self.plugins.get(name)
+
+    def getAllPlugins(self):
+        return self.plugins.values()
+
+    def mtimes(self, config, module_file=None):
+        stamps = []
+        for path in (config, module_file):
+            try:
+                stamps.append(os.stat(path).st_mtime if path else None)
+            except OSError:
+                stamps.append(None)
+        return stamps
+
+    def scan(self):
+        """ Config files of plugins that are new or changed since loaded,
+        and names of plugins that were removed """
+        configs = set(os.path.join(self.plugin_path, f) for f in os.listdir(self.plugin_path)
+                      if f.endswith('.asm-plugin'))
+        removed = []
+        for config in set(self.sources) - configs:
+            name = self.sources.pop(config)[0]
+            if self.plugins.pop(name, None):
+                removed.append(name)
+        changed = set()
+        for config in configs:
+            name, module_file, stamps = self.sources.get(config, (None, None, None))
+            if stamps != self.mtimes(config, module_file):
+                changed.add(config)
+        return changed, removed
+
+    def load(self, configs):
+        """ Loads the plugins of CONFIGS, returns them """
+        manager = PluginManager()
+        locator = manager.getPluginLocator()
+        locator.setPluginInfoExtension('asm-plugin')
+        manager.setPluginPlaces([ self.plugin_path ])
+        manager.locatePlugins()
+        candidates = {}
+        for candidate in manager.getPluginCandidates():
+            config = os.path.abspath(candidate[0])
+            if config in configs:
+                candidates[config] = candidate
+            else:
+                manager.removePluginCandidate(candidate)
+        manager.loadPlugins()
+        loaded = dict((p.name, p) for p in manager.getAllPlugins())
+        for config in configs:
+            candidate = candidates.get(config)
+            name = candidate[2].name if candidate else None
+            module_file = None
+            if candidate:
+                module_file = candidate[1] + '.py' if os.path.isfile(candidate[1] + '.py') else candidate[1]
+            ## Plugins that fail to load keep their previous version
+            if name in loaded:
+                self.plugins[name] = loaded[name]
+            else:
+                logger.error('Could not load plugin: {}'.format(name or config))
+            self.sources[config] = (name, module_file, self.mtimes(config, module_file))
+        return loaded.values()
+
+    def refresh(self):
+        """ Reloads changed plugins; returns them, or None if nothing changed """
+        changed, removed = self.scan()
+        if removed:
+            logger.info('Plugins removed: {}'.format(', '.join(sorted(removed))))
+        if not changed:
+            return [] if removed else None
+        logger.info('Reloading plugins: {}'.format(
+                ', '.join(sorted(os.path.basename(c) for c in changed))))
+        return self.load(changed)
+
+
 class ModuleManager():
-    def __init__(self, threads, kill_list, kill_list_lock, job_list, binpath, modulebin):
+    def __init__(self, threads, kill_list, kill_list_lock, job_list, binpath, modulebin,
+                 stage_cache=None, core_broker=None, admission=None, kill_switch=None,
+                 stage_logs=None):
         self.threads = threads
+        self.stage_logs = stage_logs or stage_log.StageLogs()
+        self.kill_switch = kill_switch
+        self.stage_cache = stage_cache
+        self.core_broker = core_broker
+        self.admission = admission
         self.kill_list = kill_list
         self.kill_list_lock = kill_list_lock
         self.job_list = job_list # Running jobs
+        self.killed_jobs = set() # Kill requests already popped by a stage
         self.binpath = binpath
         self.module_bin_path = modulebin
 
         self.root_path = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', '..'))
         self.plugin_path = os.path.join(self.root_path, "lib", "assembly", "plugins")
 
-        self.pmanager = PluginManager()
-        locator = self.pmanager.getPluginLocator()
-        locator.setPluginInfoExtension('asm-plugin')
-        self.pmanager.setPluginPlaces([ self.plugin_path ])
-        self.pmanager.collectPlugins()
-        self.pmanager.locatePlugins()
-        self.plugins = ['none']
-        num_plugins = len(self.pmanager.getAllPlugins())
+        self.pmanager = PluginRegistry(self.plugin_path)
+        self.binaries = {} # path: (exists, time checked)
+        self.executables = {}
+        self.load_plugins(self.pmanager.getAllPlugins(), strict=True)
+
+    def load_plugins(self, loaded, strict=False):
+        """ Registers the plugins LOADED (or reloaded) by the registry """
+        self.plugins = ['none'] + [plugin.name for plugin in self.pmanager.getAllPlugins()]
+        num_plugins = len(self.plugins) - 1
         if  num_plugins == 0:
             raise Exception("No Plugins Found!")
 
-        plugins = []
-        self.executables = {}
-        for plugin in self.pmanager.getAllPlugins():
-            plugin.threads = threads
-            self.plugins.append(plugin.name)
+        for name in list(self.executables):
+            if not name in self.plugins:
+                del self.executables[name]
+        for plugin in loaded:
+            plugin.threads = self.threads
             plugin.plugin_object.setname(plugin.name)
             ## Check for installed binaries
             try:
@@ -651,20 +740,62 @@ class ModuleManager():
                 executables = plugin.details.items('Executables')
                 full_execs = [(k, self.get_executable_path(v)) for k,v in executables]
                 for binary in full_execs:
-                    if not os.path.exists(binary[1]):
+                    if not self.binary_exists(binary[1]):
                         if float(version) < 1:
                             logger.warn('Third-party binary does not exist for beta plugin: {} (v{}) -- {}'.format(plugin.name, version, binary[1]))
-                        else:
+                        elif strict:
                             raise Exception('ERROR: Third-party binary does not exist for beta plugin: {} (v{}) -- {}'.format(plugin.name, version, binary[1]))
+                        else:
+                            logger.error('Third-party binary does not exist for plugin: {} (v{}) -- {}'.format(plugin.name, version, binary[1]))
                 self.executables[plugin.name] = full_execs
             except ConfigParser.NoSectionError: pass
-            plugins.append(plugin.name)
-        logger.info("Plugins found [{}]: {}".format(num_plugins, sorted(plugins)))
+        logger.info("Plugins found [{}]: {}".format(num_plugins, sorted(self.plugins[1:])))
+
+    def refresh(self):
+        """ Reloads the plugins changed on disk, between jobs """
+        loaded = self.pmanager.refresh()
+        if loaded is not None:
+            self.load_plugins(loaded)
+
+    def job_finished(self, my_user, my_jobid):
+        self.killed_jobs.discard((my_user, str(my_jobid)))
+
+    def binary_exists(self, path):
+        """ Whether PATH exists, checked at most every BINARY_CHECK_INTERVAL seconds """
+        now = time.time()
+        exists, checked = self.binaries.get(path, (None, 0))
+        if now - checked > BINARY_CHECK_INTERVAL:
+            exists = os.path.exists(path)
+            self.binaries[path] = (exists, now)
+        return exists
+
+    def job_killed(self, my_user, my_jobid):
+        """ Check the kill queue to see if a job should be killed """
+        if self.kill_switch:
+            return self.kill_switch.killed(my_user, my_jobid)
+        popped = False
+        self.kill_list_lock.acquire()
+        try:
+            kl = self.kill_list
+            for i,kr in enumerate(kl):
+                if my_user == kr['user'] and str(my_jobid) == kr['job_id']:
+                    kl.pop(i)
+                    popped = True
+        except:
+            logger.error("Unexpected error in removing executed job to be killed from kill_list")
+            raise
+        finally:
+            self.kill_list_lock.release()
 
+        ## Concurrent stages of the same job must all see the request
+        if popped:
+            self.killed_jobs.add((my_user, str(my_jobid)))
+        return (my_user, str(my_jobid)) in self.killed_jobs
 
-    def run_proc(self, module, wlink, job_data, parameters):
+    def run_proc(self, module, wlink, job_data, parameters, cancel_scopes=()):
         """ Run module adapter for wasp interpreter
         To support the Job_data mechanism, injects wlink
+        CANCEL_SCOPES (wasp.CancelScope) stop the stage when cancelled
         """
         if not self.has_plugin(module):
             raise Exception("No plugin named {}".format(module))
@@ -694,20 +825,108 @@ class ModuleManager():
                                 self.output_type(link['module']) in self.input_type(module))
                     except AssertionError:
                         raise Exception('{} and {} have mismatched input/output types'.format(module, link['module']))
+        #### Replay a stage completed before the job was interrupted
+        ## Stages with side effects on their inputs run again
+        output = None
+        replayed = False
+        checkpoint = job_data.get('checkpoint')
+        checkpoint_key = None
+        if checkpoint and plugin.plugin_object.cacheable:
+            inputs = link_data(wlink, job_data)
+            checkpoint_key = checkpoint.key(module, self.plugin_version(module), settings,
+                                            job_data['params'],
+                                            key_filesets(plugin.plugin_object, inputs, job_data))
+            replay = checkpoint.fetch(checkpoint_key) if checkpoint_key else None
+            if replay:
+                output, outpath = replay
+                replayed = True
+                logger.info('Resuming completed {} stage: {}'.format(module, outpath))
+                job_data['out_report'].write('Resumed from checkpoint: {}\n'.format(module))
+
+        #### Reuse output of an identical stage
+        cache_key = None
+        stage_output = None
+        if output is None and self.stage_cache and plugin.plugin_object.cacheable:
+            inputs = link_data(wlink, job_data)
+            cache_key = self.stage_cache.key(module, self.plugin_version(module), settings,
+                                             job_data['params'],
+                                             key_filesets(plugin.plugin_object, inputs, job_data))
+            if cache_key:
+                outpath = os.path.join(job_data['datapath'], str(job_data['job_id']),
+                                       '{}_{}'.format(module, uuid.uuid4()), '')
+                output = self.stage_cache.fetch(cache_key, outpath)
+            if output is not None:
+                logger.info('Reusing cached {} stage: {}'.format(module, cache_key))
+                job_data['out_report'].write('Reused cached output: {}\n'.format(module))
+                output['input_data'] = inputs.readfiles
+        if output is not None:
+            wlink['outpath'] = outpath
+            log = stage_log.find(outpath, module)
+            if log:
+                job_data['logfiles'].append(log)
+
         #### Run
-        job_data['wasp_chain'] = wlink
-        output = plugin.plugin_object.base_call(settings, job_data, self)
+        ## Stages may run concurrently (wasp branches): each call gets its
+        ## own plugin instance and its own view of job_data, the shared
+        ## job_data is never pointed at the link of one stage
+        else:
+            stage_data = copy.copy(job_data)
+            stage_data['wasp_chain'] = wlink
+            plugin_object = copy.copy(plugin.plugin_object)
+            plugin_object.cancel_scopes = cancel_scopes
+            grant = None
+            if self.core_broker:
+                grant, plugin_object.cores_granted = self.core_broker.acquire(
+                    self.plugin_threads(module), '{} (job {})'.format(module, job_data['job_id']))
+            start_time = time.time()
+            try:
+                output = plugin_object.base_call(settings, stage_data, self)
+            finally:
+                if grant:
+                    self.core_broker.release(grant)
+            outpath = plugin_object.outpath
+            stats = {'module': module,
+                     'version': self.plugin_version(module),
+                     'user': job_data['user'],
+                     'cores': plugin_object.cores_granted,
+                     'input_size': job_data.get('input_size'),
+                     'wall': time.time() - start_time,
+                     'peak_memory': plugin_object.peak_memory,
+                     'cpu_time': plugin_object.cpu_time,
+                     'scratch': utils.tree_size(outpath),
+                     'timestamp': time.time()}
+            job_data.setdefault('stage_stats', []).append(stats)
+            if cache_key:
+                stage_output = copy.deepcopy(output)
+                del stage_output['input_data']
         ot = self.output_type(module)
         wlink.insert_output(output, ot,
                             plugin.name)
         if not wlink.output:
             raise Exception('"{}" module failed to produce {}'.format(module, ot))
+        if stage_output is not None:
+            self.stage_cache.store(cache_key, outpath, stage_output, module)
+        if checkpoint_key and not replayed:
+            checkpoint.record(checkpoint_key, outpath, output, module)
 
         ### Store any output values in job_data
         data = {'module': module,
                 'module_output': output}
         job_data['plugin_output'].append(data)
 
+    def plugin_version(self, module):
+        try:
+            return self.pmanager.getPluginByName(module).details.get('Documentation', 'Version')
+        except ConfigParser.Error:
+            return None
+
+    def plugin_threads(self, module):
+        """ Threads a plugin can use: [Resources] threads of its config, None if undeclared """
+        try:
+            return self.pmanager.getPluginByName(module).details.get('Resources', 'threads')
+        except ConfigParser.Error:
+            return None
+
     def output_type(self, module):
         return self.pmanager.getPluginByName(module).plugin_object.OUTPUT
 
@@ -745,7 +964,7 @@ class ModuleManager():
     def get_executable_path(self, filename, verify=False):
         guess1 = os.path.join(self.module_bin_path, filename)
         guess2 = os.path.join(self.binpath, filename)
-        fullname = guess1 if os.path.exists(guess1) else guess2
+        fullname = guess1 if self.binary_exists(guess1) else guess2
         if verify: verify_file(fullname)
         return fullname
 
@@ -787,10 +1006,32 @@ class ModuleManager():
         return stages
 
 ##### Helper Functions ######
-def handle_output(out, q):
-    for line in iter(out.readline, b''):
-        q.put(line)
-    out.close()
+def link_data(wlink, job_data):
+    """ Returns the FileSetContainer a stage of WLINK consumes """
+    if not wlink['link']:
+        return job_data.wasp_data()
+    all_sets = []
+    for link in wlink['link']:
+        if not link:
+            continue
+        if isinstance(link['default_output'], asmtypes.FileSet):
+            all_sets.append(link['default_output']) # Single FileSet
+        elif type(link['default_output']) is list:
+            all_sets += [fileset for fileset in link['default_output']]
+        elif not link['default_output']:
+            raise Exception('"{}" stage failed to produce any output.'.format(link['module']))
+        else:
+            raise Exception('Wasp Link Error')
+    return asmtypes.FileSetContainer(all_sets)
+
+def key_filesets(plugin_object, inputs, job_data):
+    """ The FileSets a stage depends on: its INPUTS, the reference, and the
+    initial reads if the plugin reads them """
+    initial = job_data['initial_data']
+    filesets = inputs.filesets + initial.referencesets
+    if plugin_object.uses_initial_data:
+        filesets += initial.readsets
+    return filesets
 
 def update_settings(settings, new_dict):
     """
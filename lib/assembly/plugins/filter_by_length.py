@@ -7,6 +7,8 @@ from yapsy.IPlugin import IPlugin
 from assembly import get_qual_encoding
 
 class FilterByLengthPreprocessor(BasePreprocessor, IPlugin):
+    uses_initial_data = True # syncs pairs against the initial reads
+
     def run(self):
         """
         Build the command and run.
@@ -13,13 +13,8 @@ class KmergenieAnalyzer(BaseAnalyzer, IPlugin):
         if os.path.exists(report):
             output['report'] =  report
 
-        ### Get last line of log. Close, reopen for reading
-        logname = self.out_module.name
-        self.out_module.close()
-        with open(logname, 'r') as log:
-            for line in log:
-                last = line
-        self.out_module = open(logname, 'a')
+        ### Get last line of log
+        last = self.out_module.last_line
         output['best_k'] = last.split(' ')[-1].strip()
         return output
 
@@ -8,6 +8,8 @@ from yapsy.IPlugin import IPlugin
 logger = logging.getLogger(__name__)
 
 class MasurcaAssembler(BaseAssembler, IPlugin):
+    uses_initial_data = True # read lengths of the initial reads
+
     def run(self):
         """
         Build the command and run.
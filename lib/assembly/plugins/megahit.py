@@ -3,7 +3,6 @@ import os
 import subprocess
 from plugins import BaseAssembler
 from yapsy.IPlugin import IPlugin
-import multiprocessing
 
 logger = logging.getLogger(__name__)
 
@@ -33,13 +32,7 @@ class MegahitAssembler(BaseAssembler, IPlugin):
         command += ['-l', '512']
 
         # The metahit vendor recommends using 90% to 95% of the memory available.
-        system_memory = self.get_system_memory()
-        process_threads_allowed = int(self.process_threads_allowed)
-        total_threads = self.get_total_thread_count()
-
-        available_memory = system_memory / total_threads * process_threads_allowed
-
-        command += ['-m', str(available_memory)]
+        command += ['-m', str(self.memory_allowed())]
         command += ['--input-cmd']
 
         # quotes are not required because the argument will be passed to arast_popen,
@@ -57,23 +50,3 @@ class MegahitAssembler(BaseAssembler, IPlugin):
         contigs = os.path.join(self.outpath, 'megahit', 'final.contigs.fa')
 
         return {'contigs': contigs}
-
-    # TODO: this should be moved elsewhere
-    # because other classes may need this.
-    def get_system_memory(self):
-        # TODO: This could us psutil instead
-
-        with open('/proc/meminfo') as my_file:
-            for line in my_file:
-                tokens = line.split()
-                if len(tokens) == 3:
-                    [entry, value, units] = tokens
-
-                    if entry == "MemTotal:":
-                        return int(value) * 1024
-
-        # If the amount is unknown, return 4 GiB.
-        return 4 * 1024 * 1024 * 1024
-
-    def get_total_thread_count(self):
-        return multiprocessing.cpu_count()
@@ -10,6 +10,7 @@ logger = logging.getLogger(__name__)
 
 class QuastAssessment(BaseAssessment, IPlugin):
     new_version = True
+    cacheable = False # tags the input contig sets
 
     def run(self):
         contigsets = self.data.contigsets
@@ -10,6 +10,7 @@ logger = logging.getLogger(__name__)
 
 class SspaceScaffolder(BaseScaffolder, IPlugin):
     new_version = True
+    uses_initial_data = True # read lengths of the initial reads
 
     def run(self):
         """
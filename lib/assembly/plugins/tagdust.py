@@ -9,6 +9,8 @@ from assembly import get_qual_encoding
 logger = logging.getLogger(__name__)
 
 class TagdustPreprocessor(BasePreprocessor, IPlugin):
+    uses_initial_data = True # syncs pairs against the initial reads
+
     def run(self):
         """
         Build the command and run.
@@ -0,0 +1,182 @@
+"""
+Long-lived RabbitMQ publisher channels shared by the router's threads.
+"""
+
+import logging
+import Queue
+import socket
+import threading
+
+import pika
+
+logger = logging.getLogger(__name__)
+
+
+class PublishError(Exception):
+    pass
+
+
+class _Publisher:
+    """
+    One connection and transactional channel, used by one thread at a time.
+    Blocking channels wait for the confirm of each message in confirm mode,
+    while a transaction commits a whole batch with one round trip.
+    """
+    def __init__(self, params, max_priority=None):
+        self.connection = pika.BlockingConnection(params)
+        self.max_priority = max_priority
+        self.channel = self.connection.channel()
+        self.channel.tx_select()
+        self.queues = set()
+        self.exchanges = set()
+
+    def declare_queue(self, queue):
+        if queue not in self.queues:
+            arguments = None
+            if self.max_priority:
+                arguments = {'x-max-priority': self.max_priority}
+            self.channel.queue_declare(queue=queue, durable=True, arguments=arguments)
+            self.queues.add(queue)
+
+    def declare_exchange(self, exchange, exchange_type):
+        if exchange not in self.exchanges:
+            self.channel.exchange_declare(exchange=exchange, type=exchange_type)
+            self.exchanges.add(exchange)
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+
+class _Batch:
+    """ Messages of concurrent publishes, committed together """
+    def __init__(self):
+        self.messages = [] # (exchange, routing_key, queue, exchange_type, properties, body)
+        self.done = threading.Event()
+        self.error = None
+
+
+class PublisherPool:
+    """
+    Thread-safe pool of up to SIZE publisher connections.  Queues and
+    exchanges are declared once per connection, and lost connections are
+    replaced on the next publish.
+    Publishes are group committed: the first thread to publish takes a
+    connection, and the messages other threads publish meanwhile are sent
+    with its own and committed in the same transaction.  Each caller
+    returns once the broker has committed its messages.
+    Queues are declared with MAX_PRIORITY message priorities, if set.
+    """
+    def __init__(self, host, port, size=4, max_priority=None):
+        self.params = pika.ConnectionParameters(host=host, port=int(port))
+        self.size = size
+        self.max_priority = max_priority
+        self.idle = Queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.batch = None
+
+    def _acquire(self, fresh=False):
+        """ Returns an idle connection, or a new one if FRESH """
+        if not fresh:
+            try:
+                return self.idle.get_nowait()
+            except Queue.Empty:
+                pass
+        with self.lock:
+            create = fresh or self.created < self.size
+            if create:
+                self.created += 1
+        if not create:
+            return self.idle.get()
+        try:
+            return _Publisher(self.params, self.max_priority)
+        except:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def _discard(self, pub):
+        pub.close()
+        with self.lock:
+            self.created -= 1
+
+    def _discard_idle(self):
+        """ Closes the idle connections, likely as stale as one that failed """
+        while True:
+            try:
+                self._discard(self.idle.get_nowait())
+            except Queue.Empty:
+                return
+
+    def to_queue(self, queue, bodies, priority=None):
+        """ Publishes persistent messages BODIES on the durable QUEUE """
+        props = pika.BasicProperties(delivery_mode=2, # persistent message
+                                     priority=priority)
+        self._publish([('', queue, queue, None, props, body) for body in bodies])
+
+    def to_exchange(self, exchange, bodies, exchange_type='fanout'):
+        self._publish([(exchange, '', None, exchange_type, None, body) for body in bodies])
+
+    def _publish(self, messages):
+        """ Adds MESSAGES to the open batch, or opens and commits one """
+        with self.lock:
+            leader = self.batch is None
+            if leader:
+                self.batch = _Batch()
+            batch = self.batch
+            batch.messages.extend(messages)
+        if not leader:
+            batch.done.wait()
+            if batch.error:
+                raise batch.error
+            return
+        try:
+            self._commit(batch)
+        except Exception as e:
+            batch.error = e
+            raise
+        finally:
+            with self.lock:
+                if self.batch is batch:
+                    self.batch = None
+            batch.done.set()
+
+    def _commit(self, batch):
+        """ Publishes BATCH on one channel as a single transaction.  An
+        uncommitted batch delivers nothing, so it is retried whole, once,
+        on a new connection """
+        pub = self._acquire()
+        for attempt in range(2):
+            if not attempt:
+                with self.lock: # Later publishes go to the next batch
+                    self.batch = None
+            try:
+                for exchange, routing_key, queue, exchange_type, properties, body in batch.messages:
+                    if queue:
+                        pub.declare_queue(queue)
+                    if exchange_type:
+                        pub.declare_exchange(exchange, exchange_type)
+                    pub.channel.basic_publish(exchange=exchange,
+                                              routing_key=routing_key,
+                                              body=body,
+                                              properties=properties)
+                pub.channel.tx_commit()
+            except (pika.exceptions.AMQPError, socket.error) as e:
+                self._discard(pub)
+                if attempt:
+                    raise PublishError(e)
+                logger.warning('Publisher connection lost, reconnecting: {}'.format(e))
+                self._discard_idle()
+                try:
+                    pub = self._acquire(fresh=True)
+                except (pika.exceptions.AMQPError, socket.error) as e:
+                    raise PublishError(e)
+                continue
+            except:
+                self._discard(pub)
+                raise
+            self.idle.put(pub)
+            return
@@ -1,5 +1,7 @@
 import sys
 import os
+import hashlib
+import threading
 from ConfigParser import SafeConfigParser
 
 def parse(recipe):
@@ -46,7 +48,7 @@ def prefix_value(recipe, key, prefix):
         if word.find(':{}'.format(key)) != -1:
             return recipe.replace(words[i+1], '{}_{}'.format(prefix, words[i+1]))
 
-def load_recipes():
+def recipe_dir():
     rootpath = os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..', '..'))
     default_recipe_path = "lib/assembly/recipes"
 
@@ -59,21 +61,42 @@ def load_recipes():
 
     if not os.path.isabs(recipe_path):
         recipe_path = os.path.join(rootpath, recipe_path)
+    return recipe_path
 
+def load_recipes():
+    """ Loads new and changed recipe files, checked by mtime and size,
+    and keeps recipes whose content hash is unchanged """
+    recipe_path = recipe_dir()
     extension = ".lisp"
-    for recipe_file in os.listdir(recipe_path):
-        if recipe_file.endswith(extension):
-            recipe_name = recipe_file[:-len(extension)]
-            file_descriptor = open(recipe_path+ "/" + recipe_file)
-            content = file_descriptor.read()
-            file_descriptor.close()
-            recipes[recipe_name] = content
+    with lock:
+        present = set()
+        for recipe_file in os.listdir(recipe_path):
+            if recipe_file.endswith(extension):
+                recipe_name = recipe_file[:-len(extension)]
+                present.add(recipe_name)
+                st = os.stat(os.path.join(recipe_path, recipe_file))
+                stamp = (st.st_mtime, st.st_size)
+                if stamps.get(recipe_name, (None,))[:2] == stamp:
+                    continue
+                with open(os.path.join(recipe_path, recipe_file)) as f:
+                    content = f.read()
+                digest = hashlib.sha1(content).hexdigest()
+                if stamps.get(recipe_name, (None, None, None))[2] != digest:
+                    recipes[recipe_name] = content
+                stamps[recipe_name] = stamp + (digest,)
+        for recipe_name in set(stamps) - present:
+            del stamps[recipe_name]
+            recipes.pop(recipe_name, None)
+
+        set_alias('faster', 'rast_fast')
+        set_alias('fast', 'rast')
+        set_alias('smart', 'rast_slow')
 
-    set_alias('faster', 'rast_fast')
-    set_alias('fast', 'rast')
-    set_alias('smart', 'rast_slow')
+refresh = load_recipes
 
 recipes = {}
+stamps = {} # recipe name -> (mtime, size, sha1)
+lock = threading.Lock()
 
 # load recipes when the module is loaded.
 load_recipes()
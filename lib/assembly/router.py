@@ -8,6 +8,7 @@ import datetime
 import errno
 import json
 import logging
+import math
 import pika
 import pprint
 import os
@@ -28,7 +29,10 @@ from traceback import format_exc
 import asmtypes
 import recipes
 import metadata as meta
+import planner
 import shock
+from publisher import PublisherPool
+from token_cache import TokenCache, InvalidToken
 from nexus import client as nexusclient
 import client as ar_client
 from assembly import ignored
@@ -37,28 +41,19 @@ from assembly import ignored
 parser = None
 metadata = None
 rjobmon = None
+publisher = None
+catalog = None
+token_cache = TokenCache()
+nexus = None
+nexus_lock = threading.Lock()
 
 logger = logging.getLogger(__name__)
 
 
-def send_message(body, routingKey):
+def send_message(body, routingKey, priority=None):
     """ Place the job request on the correct job queue """
-
-    rmq_host = parser.get('assembly', 'rabbitmq_host')
-    rmq_port = parser.get('assembly', 'rabbitmq_port')
-
-    connection = pika.BlockingConnection(pika.ConnectionParameters(
-            host=rmq_host, port=int(rmq_port)))
-    channel = connection.channel()
-    channel.queue_declare(queue=routingKey, durable=True)
-    #channel.basic_qos(prefetch_count=1)
-    channel.basic_publish(exchange = '',
-                          routing_key=routingKey,
-                          body=body,
-                          properties=pika.BasicProperties(
-                          delivery_mode=2)) #persistant message
+    publisher.to_queue(routingKey, [body], priority)
     logger.info("Sent to queue: %r: %r" % (routingKey, body))
-    connection.close()
 
 
 def send_kill_message(user, job_id=None):
@@ -72,6 +67,7 @@ def send_kill_message(user, job_id=None):
         jobs = [metadata.get_job(user, job_id)]
 
     kill_status = ''
+    kills = []
     for job_doc in jobs:
         try:
             jid = job_doc['job_id']
@@ -85,10 +81,10 @@ def send_kill_message(user, job_id=None):
             metadata.update_job(uid, 'status', 'Terminated by user')
             metadata.rjob_remove(uid)
             kill_status += 'Job {}: Removed From Queue\n'.format(jid)
-            publish_kill_request(user, jid)
+            kills.append(jid)
 
         elif re.search(r"(Running|Stage|Data)", status):
-            publish_kill_request(user, jid)
+            kills.append(jid)
             kill_status += 'Job {}: Kill Request Sent\n'.format(jid)
 
         elif re.search(r"(Complete|Terminate)", status):
@@ -97,32 +93,87 @@ def send_kill_message(user, job_id=None):
         else:
             kill_status += 'Job {}: Unexpected error.\n'.format(jid)
 
+    if kills:
+        publish_kill_request(user, *kills)
     return kill_status.rstrip() or 'No jobs to be killed'
 
 
-def publish_kill_request(user, job_id):
-    msg = json.dumps({'user':user, 'job_id':str(job_id)})
-
-    rmq_host = parser.get('assembly', 'rabbitmq_host')
-    rmq_port = parser.get('assembly', 'rabbitmq_port')
+def publish_kill_request(user, *job_ids):
+    msgs = [json.dumps({'user':user, 'job_id':str(job_id)}) for job_id in job_ids]
+    publisher.to_exchange('kill', msgs)
+    logger.info("Sent to kill exchange: {}".format(', '.join(str(j) for j in job_ids)))
 
-    connection = pika.BlockingConnection(pika.ConnectionParameters(
-            host=rmq_host, port=int(rmq_port)))
-    channel = connection.channel()
-    channel.exchange_declare(exchange='kill',
-                             type='fanout')
-    channel.basic_publish(exchange='kill',
-                          routing_key='',
-                          body=msg,)
-    logger.info("Sent to kill exchange: {}".format(job_id))
-    connection.close()
 
+def determine_routing_key(plan, params):
+    """Depending on job submission, decide which queue to route to.
 
-def determine_routing_key(size, params):
-    """Depending on job submission, decide which queue to route to."""
+    A queue named by the client wins.  Otherwise jobs whose plan
+    (input size, estimated wall time and peak memory from the history of
+    their stages) is small go to the small job queue, and large ones to
+    the bigmem queue, when these are configured.
+    """
     routing_key = params.get('queue')
-    return routing_key or parser.get('rabbitmq','default_routing_key')
-
+    if routing_key:
+        return routing_key
+    size = plan.get('input_size')
+    estimate = plan.get('estimate') or {}
+    if parser.has_option('rabbitmq', 'bigmem_routing_key'):
+        if ((size or 0) >= config_size('bigmem_job_size', 50) or
+            (estimate.get('peak_memory') or 0) >= config_size('bigmem_job_memory', 64)):
+            return parser.get('rabbitmq', 'bigmem_routing_key')
+    if parser.has_option('rabbitmq', 'small_routing_key'):
+        small_wall = 3600
+        if parser.has_option('rabbitmq', 'small_job_wall'):
+            small_wall = float(parser.get('rabbitmq', 'small_job_wall'))
+        if (size is not None and size <= config_size('small_job_size', 1) and
+            (estimate.get('wall') or 0) <= small_wall):
+            return parser.get('rabbitmq', 'small_routing_key')
+    return parser.get('rabbitmq','default_routing_key')
+
+def config_size(option, default):
+    """ Bytes of a [rabbitmq] size option given in GB """
+    if parser.has_option('rabbitmq', option):
+        default = parser.get('rabbitmq', option)
+    return float(default) * 10**9
+
+
+def job_priority(user):
+    """Message priority of a new job of USER, from their fair share.
+
+    The load of a user is the number of their queued and running jobs plus
+    the core-hours their stages used in the last fair_share_window hours
+    (fair_share_core_hours count as one job), divided by their share in the
+    user list.  Priorities fall from max_priority by one each time the
+    load doubles, so a user with hundreds of queued jobs does not hold
+    back the first jobs of others.
+    """
+    if not parser.has_option('rabbitmq', 'max_priority'):
+        return None
+    max_priority = int(parser.get('rabbitmq', 'max_priority'))
+    window = 24
+    if parser.has_option('rabbitmq', 'fair_share_window'):
+        window = float(parser.get('rabbitmq', 'fair_share_window'))
+    core_hours = 24
+    if parser.has_option('rabbitmq', 'fair_share_core_hours'):
+        core_hours = float(parser.get('rabbitmq', 'fair_share_core_hours'))
+    share = float((user_entry(user) or {}).get('share', 1))
+    try:
+        usage = metadata.user_usage(user, time.time() - window * 3600) / 3600.0
+    except Exception as e:
+        logger.warning('Could not read usage of {}: {}'.format(user, e))
+        usage = 0
+    load = (len(rjobmon.user_jobs(user)) + usage / core_hours) / max(share, 0.01)
+    return max(0, max_priority - int(math.log(1 + load, 2)))
+
+def user_entry(user):
+    """ Entry of USER in the user list (job limit and share), or None """
+    path = parser.get('monitor', 'running_job_user_list')
+    if not os.path.isabs(path):
+        libpath = os.path.abspath(os.path.dirname( __file__ ))
+        path = os.path.join(libpath, path)
+    with open(path) as j:
+        user_list = json.load(j)
+    return next((u for u in user_list if u["user"] == user), None)
 
 def get_upload_url():
     global parser
@@ -140,12 +191,17 @@ def route_job(body):
     if not check_valid_client(body):
         return "Client too old, please upgrade"
     client_params = json.loads(body) #dict of params
-    routing_key = determine_routing_key (1, client_params)
+    plan = plan_job(client_params)
+    if plan['errors']:
+        raise cherrypy.HTTPError(400, 'Job rejected: {}'.format('; '.join(plan['errors'])))
+    routing_key = determine_routing_key(plan, client_params)
     job_id = metadata.get_next_job_id(client_params['ARASTUSER'])
     if not client_params['data_id']:
         data_id, _ = register_data(body)
         client_params['data_id'] = data_id
     client_params['job_id'] = job_id
+    client_params['queue'] = routing_key # Child jobs follow their parent
+    client_params['priority'] = job_priority(client_params['ARASTUSER'])
 
     ## Check that user queue limit is not reached
     uid = metadata.insert_job(client_params)
@@ -154,13 +210,34 @@ def route_job(body):
     metadata.update_job(uid, 'status', 'Queued')
     p = dict(client_params)
     metadata.update_job(uid, 'message', p['message'])
+    metadata.update_job(uid, 'plan', plan)
 
     msg = json.dumps(p)
-    send_message(msg, routing_key)
+    send_message(msg, routing_key, p['priority'])
     response = str(job_id)
     return response
 
 
+def plan_job(client_params):
+    """ Type checks the expression of a job request and estimates its
+    stages, see planner.plan """
+    params = dict(client_params)
+    params.setdefault('job_id', 0)
+    try:
+        exp = planner.job_expression(params)
+    except Exception as e:
+        raise cherrypy.HTTPError(400, 'Job rejected: {}'.format(e))
+    file_sets = (params.get('assembly_data') or {}).get('file_sets')
+    if file_sets is None and params.get('data_id'):
+        doc = metadata.get_data_docs(params['ARASTUSER'], params['data_id']) or {}
+        file_sets = doc.get('assembly_data', {}).get('file_sets')
+    size = planner.input_size(file_sets) if file_sets else None
+    try:
+        return planner.plan(exp, catalog.get(), size, metadata.stage_history)
+    except Exception as e:
+        raise cherrypy.HTTPError(400, 'Job rejected: {}'.format(e))
+
+
 def route_data(body):
     data_id, _ = register_data(body)
     return json.dumps({"data_id": data_id})
@@ -224,6 +301,16 @@ def sanitize_doc(doc):
     return doc
 
 
+def stream_json_list(docs):
+    """ Yields DOCS as a JSON list, one document at a time """
+    yield '['
+    sep = ''
+    for doc in docs:
+        yield sep + json.dumps(doc)
+        sep = ', '
+    yield ']'
+
+
 def authenticate_request():
     if cherrypy.request.method == 'OPTIONS':
         return 'OPTIONS'
@@ -231,20 +318,33 @@ def authenticate_request():
     if not token:
         logger.warning("Auth error")
         raise cherrypy.HTTPError(403)
+    try:
+        return token_cache.get(token, validate_token)
+    except InvalidToken as e:
+        logger.warning("Auth error: {}".format(e))
+        raise cherrypy.HTTPError(403, 'Failed Authorization')
+
+
+def check_token_user(token_user, userid):
+    """ Raises 403 unless the authenticated TOKEN_USER is USERID """
+    # user IDs can be in the email address format; somehow cherrypy converts @ and . to _
+    sanitized_token_user = token_user.replace('@', '_').replace('.', '_')
+    if not (userid == sanitized_token_user or userid.split('_rast')[0] == sanitized_token_user):
+        raise cherrypy.HTTPError(403)
 
+
+def validate_token(token):
+    """ Returns the user of TOKEN, checking with Globus if the stored
+    authorization is missing or older than 15 min """
     #parse out username
     r = re.compile('un=(.*?)\|')
     m = r.search(token)
     if m:
         user = m.group(1)
     else:
-        logger.warning("Auth error")
-        raise cherrypy.HTTPError(403, 'Bad Token')
+        raise InvalidToken('Bad Token')
     auth_info = metadata.get_auth_info(user)
 
-    self_path = os.path.join(os.path.dirname( __file__ ))
-    nexus_config_file = os.path.join(self_path, "nexus", "nexus.yml")
-
     #### Previous Authorization found
     if auth_info:
         # Check exp date
@@ -254,25 +354,29 @@ def authenticate_request():
         globus_user = user
         if (ctime - atime).seconds > 15*60: # 15 min auth token
             logger.warning('Token expired, reauthenticating with Globus')
-            nexus = nexusclient.NexusClient(config_file = nexus_config_file)
-            globus_user = nexus.authenticate_user(token)
+            globus_user = get_nexus().authenticate_user(token)
             metadata.update_auth_info(globus_user, token, str(ctime))
 
     #### Validate Token
     else:
-        nexus = nexusclient.NexusClient(config_file = nexus_config_file)
-        globus_user = nexus.authenticate_user(token)
+        globus_user = get_nexus().authenticate_user(token)
         if globus_user:
             metadata.insert_auth_info(globus_user, token,
                                       str(datetime.datetime.today()))
         else:
-            raise Exception ('problem authorizing with nexus')
-    try:
-        if globus_user is None:
-            return user
-        return globus_user
-    except:
-        raise cherrypy.HTTPError(403, 'Failed Authorization')
+            raise InvalidToken('Token rejected by Globus')
+    return globus_user or user
+
+
+def get_nexus():
+    """ Nexus client shared by the process """
+    global nexus
+    with nexus_lock:
+        if nexus is None:
+            self_path = os.path.join(os.path.dirname( __file__ ))
+            nexus_config_file = os.path.join(self_path, "nexus", "nexus.yml")
+            nexus = nexusclient.NexusClient(config_file = nexus_config_file)
+    return nexus
 
 
 def CORS():
@@ -284,7 +388,7 @@ def start(config_file, shock_url=None,
           mongo_host=None, mongo_port=None,
           rabbit_host=None, rabbit_port=None):
 
-    global parser, metadata, rjobmon
+    global parser, metadata, rjobmon, publisher, catalog
     # logging.basicConfig(level=logging.DEBUG)
 
     parser = SafeConfigParser()
@@ -293,6 +397,8 @@ def start(config_file, shock_url=None,
                    'auth': parser.get('meta', 'mongo.collection.auth'),
                    'data': parser.get('meta', 'mongo.collection.data'),
                    'running': parser.get('meta', 'mongo.collection.running')}
+    if parser.has_option('meta', 'mongo.collection.stats'):
+        collections['stats'] = parser.get('meta', 'mongo.collection.stats')
 
     # Config precedence: args > config file
 
@@ -312,6 +418,23 @@ def start(config_file, shock_url=None,
                                        parser.get('meta', 'mongo.db'),
                                        collections)
 
+    ##### Module catalog for job plans #####
+    path = parser.get('web', 'ar_modules')
+    if not os.path.isabs(path):
+        libpath = os.path.abspath(os.path.dirname( __file__ ))
+        path = os.path.join(libpath, path)
+    catalog = planner.Catalog(path)
+
+    ##### Job queue publisher #####
+    pool_size = 4
+    if parser.has_option('rabbitmq', 'publisher_pool_size'):
+        pool_size = int(parser.get('rabbitmq', 'publisher_pool_size'))
+    max_priority = None
+    if parser.has_option('rabbitmq', 'max_priority'):
+        max_priority = int(parser.get('rabbitmq', 'max_priority'))
+    publisher = PublisherPool(parser.get('assembly', 'rabbitmq_host'),
+                              parser.get('assembly', 'rabbitmq_port'), pool_size, max_priority)
+
     ##### Running Job Monitor #####
     rjobmon = RunningJobsMonitor(metadata)
     cherrypy.process.plugins.Monitor(cherrypy.engine, rjobmon.purge,
@@ -392,18 +515,9 @@ class JobResource:
         token_user = authenticate_request()
         if token_user == 'OPTIONS':
             return ('New Job Request') # To handle initial html OPTIONS requess
-        # user IDs can be in the email address format; somehow cherrypy converts @ and . to _
-        sanitized_token_user = token_user.replace('@', '_').replace('.', '_')
-        if not (userid == sanitized_token_user or userid.split('_rast')[0] == sanitized_token_user):
-            raise cherrypy.HTTPError(403)
+        check_token_user(token_user, userid)
 
-        path = parser.get('monitor', 'running_job_user_list')
-        if not os.path.isabs(path):
-            libpath = os.path.abspath(os.path.dirname( __file__ ))
-            path = os.path.join(libpath, path)
-        with open(path) as j:
-            user_list = json.load(j)
-        user = next((u for u in user_list if u["user"] == userid), None)
+        user = user_entry(userid)
         if user:
             if user["job_limit"] == -1:
                 pass
@@ -416,6 +530,17 @@ class JobResource:
         params['oauth_token'] = cherrypy.request.headers['Authorization']
         return route_job(json.dumps(params))
 
+    @cherrypy.expose
+    def plan(self, userid=None):
+        """ Dry run of a job request: returns its plan without submitting it """
+        token_user = authenticate_request()
+        if token_user == 'OPTIONS':
+            return ('New Plan Request') # To handle initial html OPTIONS requess
+        check_token_user(token_user, userid)
+        params = json.loads(cherrypy.request.body.read())
+        params['ARASTUSER'] = userid
+        return json.dumps(plan_job(params))
+
     @cherrypy.expose
     def kill(self, userid=None, job_id=None):
         if userid == 'OPTIONS':
@@ -503,8 +628,17 @@ class JobResource:
         ### List of Recent Jobs
         else:
             records = int(kwargs.get('records', 100))
+            before = kwargs.get('before') # job_id cursor for the next page
             detail = kwargs.get('detail')
-            docs = [sanitize_doc(d) for d in metadata.list_jobs(userid)]
+            if kwargs.get('format') == 'json':
+                docs = metadata.list_jobs(userid, records, before,
+                                          fields={'oauth_token': 0, '_id': 0, 'data': 0})
+                return stream_json_list(docs)
+            fields = ['job_id', 'data_id', 'status', 'computation_time', 'message']
+            if detail:
+                fields += ['pipeline', 'recipe', 'wasp']
+            docs = list(metadata.list_jobs(userid, records, before, fields=fields))
+            docs.reverse()
             columns = ["Job ID", "Data ID", "Status", "Run time", "Description"]
             if detail:
                 columns.append("Parameters")
@@ -512,9 +646,7 @@ class JobResource:
             if detail:
                 pt.align["Parameters"] = "l"
             if docs:
-                if kwargs.get('format') == 'json':
-                    return json.dumps(list(reversed(docs[-records:])));
-                for doc in docs[-records:]:
+                for doc in docs:
                     try:
                         stat_msg = doc.get('status')[:40]
                     except TypeError:
@@ -529,7 +661,7 @@ class JobResource:
                             row += ['']
                     pt.add_row(row)
                 return pt.get_string() + "\n"
-
+    status._cp_config = {'response.stream': True}
 
     def get_validated_job(self, user=None, job=None):
         if not job:  raise cherrypy.HTTPError(403, 'Undefined Job ID')
@@ -791,11 +923,7 @@ class ModuleResource:
     @cherrypy.expose
     def default(self, module_name="avail", *args, **kwargs):
         if module_name == 'avail' or module_name == 'all':
-            path = parser.get('web', 'ar_modules')
-            if not os.path.isabs(path):
-                libpath = os.path.abspath(os.path.dirname( __file__ ))
-                path = os.path.join(libpath, path)
-            with open(path) as outfile:
+            with open(catalog.path) as outfile:
                 return outfile.read()
         else: raise cherrypy.HTTPError(403)
 
@@ -803,7 +931,7 @@ class ModuleResource:
 class RecipeResource:
     @cherrypy.expose
     def default(self, module_name="avail", *args, **kwargs):
-        reload(recipes)
+        recipes.refresh()
         all = recipes.get_all()
         if module_name == 'avail' or module_name == 'all':
             return json.dumps(all)
@@ -1,19 +1,24 @@
 
 """ Module for shock """
 import errno
+import hashlib
 import json
 import logging
 import os
 import re
 import requests
+import shutil
 from requests_toolbelt import MultipartEncoder
 import copy
 import StringIO
 import subprocess
 import sys
+import threading
 import time
 import tempfile
+import urlparse
 
+import extract
 import utils
 
 
@@ -49,10 +54,10 @@ def get_handle(handle, token=None, ret=None):
     return {'text': r.text, 'json': r.json}.get(ret, r.content)
 
 
-def curl_download_url(url, outdir=None, filename=None, token=None, silent=False):
+def download_url(url, outdir=None, filename=None, token=None, size=None, md5=None,
+                 inflate=False):
     if outdir:
-        try: os.makedirs(outdir)
-        except OSError: pass
+        utils.verify_dir(outdir)
     else:
         outdir = os.getcwd()
 
@@ -61,26 +66,256 @@ def curl_download_url(url, outdir=None, filename=None, token=None, silent=False)
         filename = re.sub(r'\?download', '', filename)
         filename = re.sub(r'[?&]', '_', filename)
 
-    cmd = ['curl', '-k', '-X', 'GET',
-           '-o', filename, '"{}"'.format(url) ]
+    downloaded = os.path.join(outdir, filename)
+    sys.stderr.write("Downloading: {}\n".format(url))
+    downloaded = download(url, downloaded, token=token, size=size, md5=md5, inflate=inflate)
+    logger.info('File downloaded: {}'.format(downloaded))
+    return downloaded
 
-    if silent:
-        cmd += ['-s']
-    if token:
-        cmd += ['-H', '"Authorization: OAuth {}"'.format(token)]
 
-    sys.stderr.write("Downloading: {}\n".format(' '.join(cmd)))
-    logger.debug("curl_download_url: {}".format(' '.join(cmd)))
-    p = subprocess.Popen(' '.join(cmd), cwd=outdir, shell=True)
-    p.wait()
-    sys.stderr.write("\n")
+def get_node(shockurl, node_id, token=None):
+    """ Returns the data document of a Shock node """
+    url = '{}/node/{}'.format(shockurl, node_id)
+    try:
+        r = get_session(url).get(url, headers=token_to_req_headers(token))
+        return r.json()['data']
+    except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+        raise Error('Data transfer error: {}'.format(e))
+
+
+#### Transfer engine ####
+CHUNK_SIZE = 1 << 20        # Read/write block
+RANGE_SIZE = 64 << 20       # Bytes per ranged GET
+RANGE_THRESHOLD = 256 << 20 # Split downloads larger than this
+RANGE_THREADS = 4
+RETRIES = 3
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url):
+    """ Returns the pooled session for the host of URL (one per process) """
+    key = (os.getpid(),) + urlparse.urlsplit(url)[:2]
+    with _sessions_lock:
+        if key not in _sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=RANGE_THREADS * 2,
+                                                    max_retries=RETRIES)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[key] = session
+        return _sessions[key]
+
+
+def download(url, filename, token=None, size=None, md5=None, threads=RANGE_THREADS,
+             inflate=False):
+    """
+    Streams URL into FILENAME and returns the local path.
+    Downloads larger than RANGE_THRESHOLD are fetched as parallel ranged
+    GETs.  Data is written to FILENAME.part, so an interrupted transfer
+    resumes where it stopped.  If MD5 is given the file is verified.
+    With INFLATE, compressed files that can be read sequentially are
+    decompressed on the fly and the inflated path is returned instead.
+    Such downloads are a single sequential GET: a dropped connection is
+    resumed in-process, but there are no parallel ranges and a restarted
+    job downloads the archive again.
+    """
+    part = filename + '.part'
+    session = get_session(url)
+    headers = token_to_req_headers(token) or {}
+    if inflate and extract.streamable(filename):
+        return _download_inflate(session, url, filename, headers, md5)
+    ranged = False
+    if size and int(size) > RANGE_THRESHOLD and threads > 1:
+        try:
+            _download_ranges(session, url, part, headers, int(size), threads)
+            ranged = True
+        except RangeError as e:
+            logger.info('Ranged download not possible: {}'.format(e))
+            _remove(part)
+    if not ranged:
+        _download_stream(session, url, part, headers)
+    _remove(part + '.ranges')
+
+    if md5:
+        digest = file_md5(part)
+        if digest != md5:
+            _remove(part)
+            raise Error('Checksum mismatch for {}: {} != {}'.format(url, digest, md5))
+    os.rename(part, filename)
+    return filename
+
+
+def file_md5(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class RangeError(Exception):
+    pass
 
-    downloaded = os.path.join(outdir, filename)
-    if os.path.exists(downloaded):
-        logger.info('File downloaded: {}'.format(downloaded))
-        return downloaded
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _check_response(r):
+    if r.status_code not in (requests.codes.ok, requests.codes.partial_content):
+        raise Error("Transfer failed: {}: {}".format(r.status_code, r.reason))
+
+
+def _download_stream(session, url, part, headers):
+    """ Single GET, appending to an existing partial file """
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    req_headers = dict(headers)
+    if offset:
+        req_headers['Range'] = 'bytes={}-'.format(offset)
+    r = session.get(url, headers=req_headers, stream=True)
+    if offset and r.status_code == requests.codes.requested_range_not_satisfiable:
+        return # Already complete
+    _check_response(r)
+    mode = 'ab' if r.status_code == requests.codes.partial_content else 'wb'
+    with open(part, mode) as f:
+        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+            if chunk: # filter out keep-alive new chunks
+                f.write(chunk)
+
+
+def _download_inflate(session, url, filename, headers, md5):
+    """ Single GET decompressed as it arrives; the archive is never written """
+    reader = extract.ChunkReader(_resumed_chunks(session, url, headers))
+    target = extract.extracted_path(filename)
+    try:
+        inflated = extract.inflate_stream(reader, filename, os.path.dirname(filename))
+        reader.read() # Drain trailing bytes so the checksum covers the archive
+    except Exception as e:
+        _remove(target + '.part')
+        raise Error('Could not inflate {}: {}'.format(url, e))
+    if md5 and reader.md5.hexdigest() != md5:
+        if os.path.isdir(target):
+            shutil.rmtree(target, ignore_errors=True)
+        else:
+            _remove(target)
+        raise Error('Checksum mismatch for {}: {} != {}'.format(
+                url, reader.md5.hexdigest(), md5))
+    return inflated
+
+
+def _resumed_chunks(session, url, headers):
+    """
+    Chunks of URL from a single GET.  If the connection drops, the rest is
+    fetched from the bytes already read, with a ranged GET or by skipping
+    them if the server ignores the range.
+    """
+    offset = 0
+    failures = 0
+    while True:
+        req_headers = dict(headers)
+        if offset:
+            req_headers['Range'] = 'bytes={}-'.format(offset)
+        try:
+            r = session.get(url, headers=req_headers, stream=True)
+            if offset and r.status_code == requests.codes.requested_range_not_satisfiable:
+                return # Already complete
+            _check_response(r)
+            skip = offset if r.status_code == requests.codes.ok else 0
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                if skip:
+                    dropped = min(skip, len(chunk))
+                    chunk = chunk[dropped:]
+                    skip -= dropped
+                if chunk: # filter out keep-alive new chunks
+                    offset += len(chunk)
+                    yield chunk
+            return
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            failures += 1
+            if failures > RETRIES:
+                raise
+            logger.warning('Download of {} interrupted at {} bytes (attempt {}): {}'.format(
+                    url, offset, failures, e))
+
+
+def _download_ranges(session, url, part, headers, size, threads):
+    """ Parallel ranged GETs into a preallocated file """
+    progress = part + '.ranges'
+    done = set()
+    if os.path.exists(part) and os.path.getsize(part) == size:
+        try:
+            with open(progress) as f:
+                done = set(json.load(f))
+        except (IOError, ValueError):
+            pass
     else:
-        raise Error('Data does not exist')
+        with open(part, 'wb') as f:
+            f.truncate(size)
+    todo = [start for start in range(0, size, RANGE_SIZE) if start not in done]
+    if done:
+        logger.info('Resuming download: {}/{} ranges left'.format(
+                len(todo), len(todo) + len(done)))
+
+    lock = threading.Lock()
+    errors = []
+
+    def fetch_range(start):
+        end = min(start + RANGE_SIZE, size) - 1
+        req_headers = dict(headers)
+        req_headers['Range'] = 'bytes={}-{}'.format(start, end)
+        r = session.get(url, headers=req_headers, stream=True)
+        if r.status_code == requests.codes.ok:
+            raise RangeError('server ignored Range header')
+        _check_response(r)
+        with open(part, 'r+b') as f:
+            f.seek(start)
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                if chunk:
+                    f.write(chunk)
+            if f.tell() != end + 1:
+                raise Error('Short range {}-{}'.format(start, end))
+
+    def worker():
+        while True:
+            with lock:
+                if not todo or errors:
+                    return
+                start = todo.pop(0)
+            for attempt in range(RETRIES):
+                try:
+                    fetch_range(start)
+                    break
+                except RangeError as e:
+                    with lock:
+                        errors.append(e)
+                    return
+                except (Error, requests.exceptions.RequestException, IOError) as e:
+                    logger.warning('Range {} failed (attempt {}): {}'.format(start, attempt + 1, e))
+            else:
+                with lock:
+                    errors.append(Error('Could not download range {}'.format(start)))
+                return
+            with lock:
+                done.add(start)
+                with open(progress, 'w') as f:
+                    json.dump(sorted(done), f)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    for w in workers:
+        w.join()
+    if errors:
+        raise errors[0]
 
 
 class Error(Exception):
@@ -89,9 +324,13 @@ class Error(Exception):
 
 
 class Shock:
+    _validated = set()
+
     def __init__(self, shockurl, user, token):
 
-        self._validate_endpoint(shockurl)
+        if shockurl not in Shock._validated:
+            self._validate_endpoint(shockurl)
+            Shock._validated.add(shockurl)
         self.shockurl = shockurl
 
         self.posturl = '{}/node/'.format(shockurl)
@@ -108,7 +347,7 @@ class Shock:
         Otherwise, the endpoint will need to be started.
         """
         try:
-            request = requests.get(url)
+            request = get_session(url).get(url)
 
         except Exception, e:
             print("Error, service {} is not available.".format(url))
@@ -117,9 +356,7 @@ class Shock:
             raise e
 
     def check_anonymous_post_allowed(self):
-        cmd = ['curl', '-s', '-k', '-X', 'POST', self.posturl]
-        r = subprocess.check_output(' '.join(cmd), shell=True)
-        res = json.loads(r)
+        res = get_session(self.posturl).post(self.posturl).json()
         status = res.get("status", 0)
         self.auth = False if status == 200 else True
         self.auth_checked = True
@@ -154,47 +391,19 @@ class Shock:
     def upload_results(self, filename, curl=False, auth=False):
         return self.upload_file(filename, filetype='results', curl=curl, auth=auth)
 
-    def curl_download_file(self, node_id, outdir=None):
-        ## Authenticated download
-        cmd = ['curl', '-k',
-               '-X', 'GET', '{}/node/{}'.format(self.shockurl, node_id)]
-
-        cmd += ['-H', '"Authorization: OAuth {}"'.format(self.token)]
-
-        r = subprocess.check_output(' '.join(cmd), shell=True)
-        try:
-            filename = json.loads(r)['data']['file']['name']
-        except:
-            raise Error('Data transfer error: {}'.format(r))
+    def get_node(self, node_id):
+        return get_node(self.shockurl, node_id, self.token)
 
+    def download_file(self, node_id, outdir=None, filename=None, inflate=False):
+        """ Authenticated download, verified against the node's MD5 """
+        fileinfo = self.get_node(node_id).get('file') or {}
+        if not fileinfo.get('name'):
+            raise Error('Data transfer error: node {} has no file'.format(node_id))
         d_url = '{}/node/{}?download'.format(self.shockurl, node_id)
-        return curl_download_url(d_url, outdir, filename, self.token)
-
-
-    # see implementation in client.download_shock_handle
-    #
-    # def download_file(self, node_id, outdir=None):
-    #     r = requests.get('{}/node/{}'.format(self.shockurl, node_id))
-    #     filename = json.loads(r.content)['data']['file']['name'].split('/')[-1]
-    #     if outdir:
-    #         utils.verify_dir(outdir)
-    #     else:
-    #         outdir = os.getcwd()
-
-    #     d_url = '{}/node/{}?download'.format(self.shockurl, node_id)
-    #     downloaded = os.path.join(outdir, filename)
-    #     r = requests.get(d_url, stream=True)
-    #     with open(downloaded, 'wb') as f:
-    #         for chunk in r.iter_content(chunk_size=1024):
-    #             if chunk: # filter out keep-alive new chunks
-    #                 f.write(chunk)
-    #                 f.flush()
-
-    #     if os.path.exists(downloaded):
-    #         print "File downloaded: {}".format(downloaded)
-    #         return downloaded
-    #     else:
-    #         raise Error('Data does not exist')
+        return download_url(d_url, outdir, filename or fileinfo['name'], self.token,
+                            size=fileinfo.get('size'),
+                            md5=(fileinfo.get('checksum') or {}).get('md5'),
+                            inflate=inflate)
 
 
     ######## Internal Methods ##############
@@ -211,28 +420,29 @@ class Shock:
         return outjson
 
     def _post_file(self, filename, filetype='', auth=False):
-        """ Upload using requests """
+        """ Streaming multipart upload over the pooled session """
         tmp_attr = dict(self.attrs)
         tmp_attr['filetype'] = filetype
         attr_fd = self._create_attr_mem(tmp_attr)
         r = None
 
         try:
-            with open(filename) as f:
+            with open(filename, 'rb') as f:
 
                 multipart_data = MultipartEncoder(fields = {
                         'attributes': ('attributes', attr_fd),
-                        'upload': (filename, f)
+                        'upload': (os.path.basename(filename), f)
                         })
 
                 content_type = {'Content-Type': multipart_data.content_type}
-                my_headers = copy.deepcopy(self.headers)
+                my_headers = copy.deepcopy(self.headers) or {}
                 my_headers.update(content_type)
 
+                session = get_session(self.posturl)
                 if auth:
-                    r = requests.post(self.posturl, data=multipart_data, headers=my_headers)
+                    r = session.post(self.posturl, data=multipart_data, headers=my_headers)
                 else:
-                    r = requests.post(self.posturl, data=multipart_data, headers=content_type)
+                    r = session.post(self.posturl, data=multipart_data, headers=content_type)
 
         except requests.exceptions.RequestException as e:
             raise Error("python-requests error: {}. Try with --curl flag.".format(e))
@@ -255,12 +465,17 @@ class Shock:
 
         if silent:
             cmd += ['-s']
+        shown = ' '.join(cmd)
         if auth:
-            cmd += ['-H', '"Authorization: OAuth {}"'.format(self.token)]
+            cmd += ['-H', 'Authorization: OAuth {}'.format(self.token)]
 
-        sys.stderr.write("Uploading: {}\n".format(' '.join(cmd)))
-        logger.debug("curl_post_file: {}".format(' '.join(cmd)))
-        r = subprocess.check_output(' '.join(cmd), shell=True)
+        ## An argument list, no shell: file names and the token are not parsed
+        sys.stderr.write("Uploading: {}\n".format(shown))
+        logger.debug("curl_post_file: {}".format(shown))
+        try:
+            r = subprocess.check_output(cmd)
+        finally:
+            os.remove(attr_file)
         sys.stderr.write("\n")
 
         res = json.loads(r)
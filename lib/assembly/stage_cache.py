@@ -0,0 +1,217 @@
+"""
+Content-addressed cache of plugin stage outputs.
+
+Entries are keyed by plugin name and version, the effective settings and
+the content of the input FileSets.  An entry holds hard links to the files
+of a completed stage, so reusing it costs no extra disk space while the
+original job directory is still around.  The cache lives in the compute
+node's data path and is shared by all workers on the node.
+"""
+
+import copy
+import cPickle as pickle
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = '_stage_cache'
+OUTPUT_FILE = '_output.pkl'
+
+
+class StageCache:
+    def __init__(self, datapath, max_size):
+        """ MAX_SIZE is in GB; 0 disables caching """
+        self.path = utils.verify_dir(os.path.join(datapath, CACHE_DIR))
+        self.max_size = int(float(max_size) * 10**9)
+        self.index_file = os.path.join(self.path, 'index.json')
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def _index(self, write=True):
+        """ Locked access to the index shared by all workers on the node """
+        return utils.locked_json(self.index_file, {'entries': {}, 'hashes': {}}, write)
+
+    def file_hash(self, filename):
+        """ MD5 of FILENAME, memoized by inode, size and mtime """
+        st = os.stat(filename)
+        ident = '{}:{}:{}:{}'.format(st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        with self._index(write=False) as index:
+            digest = index['hashes'].get(ident)
+        if digest:
+            return digest
+        md5 = hashlib.md5()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+        digest = md5.hexdigest()
+        with self._index() as index:
+            index['hashes'][ident] = digest
+        return digest
+
+    def key(self, module, version, settings, params, filesets):
+        """ Returns the cache key of a stage, or None if it cannot be cached """
+        if not self.enabled:
+            return None
+        try:
+            inputs = []
+            for fs in filesets:
+                inputs.append({'type': fs['type'],
+                               'insert': fs.get('insert'),
+                               'stdev': fs.get('stdev'),
+                               'tags': sorted(fs['tags']),
+                               'files': [self.file_hash(f) for f in fs.files]})
+        except (TypeError, KeyError, AttributeError, OSError, IOError) as e:
+            logger.debug('Stage not cacheable: {}: {}'.format(module, e))
+            return None
+        desc = {'module': module,
+                'version': version,
+                'settings': sorted([list(kv) for kv in settings]),
+                'params': sorted([list(kv) for kv in params]),
+                'inputs': inputs}
+        return hashlib.sha1(json.dumps(desc, sort_keys=True)).hexdigest()
+
+    def fetch(self, key, outpath):
+        """ Links a cached stage into OUTPATH and returns its output dict """
+        with self._index() as index:
+            entry = index['entries'].get(key)
+            if not entry:
+                return None
+            entry['last_used'] = time.time()
+        entry_path = os.path.join(self.path, key, '')
+        try:
+            with open(os.path.join(entry_path, OUTPUT_FILE), 'rb') as f:
+                output = pickle.load(f)
+            link_tree(entry_path, outpath, skip=[OUTPUT_FILE])
+        except (IOError, OSError, pickle.UnpicklingError, EOFError) as e:
+            logger.warning('Stage cache entry {} unusable: {}'.format(key, e))
+            shutil.rmtree(outpath, ignore_errors=True)
+            self.remove(key)
+            return None
+        return relocate(output, entry_path, outpath)
+
+    def store(self, key, outpath, output, module):
+        """ Records a completed stage whose files all live in OUTPATH """
+        outpath = os.path.join(outpath, '')
+        if not contained(output, outpath):
+            logger.debug('Stage output outside of {}, not cached'.format(outpath))
+            return
+        entry_path = os.path.join(self.path, key)
+        tmp = os.path.join(self.path, '.{}.{}'.format(key, uuid.uuid4()))
+        try:
+            link_tree(outpath, tmp)
+            with open(os.path.join(tmp, OUTPUT_FILE), 'wb') as f:
+                pickle.dump(relocate(copy.deepcopy(output), outpath, os.path.join(entry_path, '')),
+                            f, pickle.HIGHEST_PROTOCOL)
+            size = utils.tree_size(tmp)
+            with self._index() as index:
+                if key in index['entries']:
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    return
+                shutil.rmtree(entry_path, ignore_errors=True)
+                os.rename(tmp, entry_path)
+                index['entries'][key] = {'module': module,
+                                         'size': size,
+                                         'last_used': time.time()}
+            logger.info('Stage cached: {} ({}, {} bytes)'.format(module, key, size))
+        except (IOError, OSError, pickle.PicklingError) as e:
+            logger.warning('Could not cache {} stage: {}'.format(module, e))
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self.evict(self.max_size)
+
+    def remove(self, key):
+        with self._index() as index:
+            index['entries'].pop(key, None)
+        shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+
+    def evict(self, max_size):
+        """ Removes least recently used entries until the cache fits MAX_SIZE """
+        while self.size() > max_size:
+            if not self.pop_lru():
+                break
+
+    def pop_lru(self):
+        """ Removes the least recently used entry, returns False if empty """
+        with self._index() as index:
+            entries = index['entries']
+            if not entries:
+                return False
+            key = min(entries, key=lambda k: entries[k]['last_used'])
+            entry = entries.pop(key)
+            ## Forget hashes of files that no longer exist
+            self._prune_hashes(index)
+        logger.info('Stage cache: evicting {} ({}, {} bytes)'.format(
+                key, entry['module'], entry['size']))
+        shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+        return True
+
+    def size(self):
+        with self._index(write=False) as index:
+            return sum(e['size'] for e in index['entries'].values())
+
+    def _prune_hashes(self, index):
+        if len(index['hashes']) < 10000:
+            return
+        live = set()
+        for root, _, files in os.walk(os.path.dirname(self.path)):
+            for f in files:
+                try:
+                    st = os.stat(os.path.join(root, f))
+                except OSError:
+                    continue
+                live.add('{}:{}:{}:{}'.format(st.st_dev, st.st_ino, st.st_size, st.st_mtime))
+        index['hashes'] = {k: v for k, v in index['hashes'].items() if k in live}
+
+
+##### Helper Functions ######
+def link_tree(src, dst, skip=()):
+    """ Recreates the tree SRC in DST using hard links """
+    src = os.path.join(src, '')
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        utils.verify_dir(target)
+        for f in files:
+            if root == src and f in skip:
+                continue
+            s = os.path.join(root, f)
+            d = os.path.join(target, f)
+            if os.path.islink(s):
+                os.symlink(os.readlink(s), d)
+                continue
+            try:
+                os.link(s, d)
+            except OSError:
+                shutil.copy2(s, d)
+
+def relocate(obj, old, new):
+    """ Rewrites paths under OLD to NEW in a nested output structure """
+    if isinstance(obj, basestring):
+        return new + obj[len(old):] if obj.startswith(old) else obj
+    elif isinstance(obj, dict):
+        for k, v in obj.items():
+            obj[k] = relocate(v, old, new)
+    elif isinstance(obj, list):
+        obj[:] = [relocate(v, old, new) for v in obj]
+    elif isinstance(obj, tuple):
+        return tuple(relocate(v, old, new) for v in obj)
+    return obj
+
+def contained(obj, path):
+    """ True if every existing file referenced in OBJ is inside PATH """
+    if isinstance(obj, basestring):
+        return not (os.path.isabs(obj) and os.path.exists(obj)) or obj.startswith(path)
+    elif isinstance(obj, dict):
+        return all(contained(v, path) for v in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return all(contained(v, path) for v in obj)
+    return True
@@ -0,0 +1,163 @@
+"""
+Bounded logs of plugin stages.
+
+The output of a stage is written straight to its log file up to a head
+size.  Beyond that, only the last lines up to a tail size are kept in
+memory, and written after a truncation marker when the log is closed,
+so a stage that prints gigabytes costs neither memory nor report space.
+Logs can be gzip compressed.
+
+The job report is assembled from the logs as a stream, and ends with an
+index of the section of each stage log in it.
+"""
+
+import collections
+import gzip
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+TRUNCATED = '\n[... {} bytes in {} lines truncated ...]\n\n'
+
+
+class StageLogs:
+    """ Opens the logs of stages, with limits in MB """
+    def __init__(self, head_size=1, tail_size=1, compress=False):
+        self.head_size = int(float(head_size) * MB)
+        self.tail_size = int(float(tail_size) * MB)
+        self.compress = compress
+
+    def open(self, path):
+        """ Log at PATH, or PATH.gz if compressed """
+        if self.compress:
+            path += '.gz'
+        return StageLog(path, self.head_size, self.tail_size)
+
+
+class StageLog(object):
+    """ Write-only log file with head/tail truncation """
+    def __init__(self, path, head_size, tail_size):
+        self.name = path
+        self.head_size = head_size
+        self.tail_size = tail_size
+        if path.endswith('.gz'):
+            self.file = gzip.open(path, 'wb')
+        else:
+            self.file = open(path, 'w')
+        self.written = 0
+        self.tail = collections.deque()
+        self.tail_bytes = 0
+        self.dropped_bytes = 0
+        self.dropped_lines = 0
+        self.last_line = None
+        self.closed = False
+
+    def write(self, data):
+        if not data:
+            return
+        data = str(data)
+        self.last_line = data
+        if not self.tail and self.written + len(data) <= self.head_size:
+            self.file.write(data)
+            self.written += len(data)
+            return
+        if len(data) > self.tail_size:
+            self.dropped_bytes += len(data) - self.tail_size
+            data = data[-self.tail_size:]
+        self.tail.append(data)
+        self.tail_bytes += len(data)
+        while self.tail_bytes > self.tail_size:
+            line = self.tail.popleft()
+            self.tail_bytes -= len(line)
+            self.dropped_bytes += len(line)
+            self.dropped_lines += 1
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self.file.flush()
+
+    @property
+    def truncated(self):
+        return self.dropped_bytes
+
+    def close(self):
+        if self.closed:
+            return
+        if self.dropped_bytes:
+            self.file.write(TRUNCATED.format(self.dropped_bytes, self.dropped_lines))
+        for line in self.tail:
+            self.file.write(line)
+        self.tail.clear()
+        self.file.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def find(outpath, module):
+    """ Log of MODULE in OUTPATH, compressed or not, or None """
+    log = os.path.join(outpath, '{}.out'.format(module))
+    for path in (log, log + '.gz'):
+        if os.path.exists(path):
+            return path
+
+def open_log(path):
+    """ Opens a stage log for reading """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path)
+
+
+class ReportWriter:
+    """ Writes a report to OUT as a stream of sections, indexed by byte offset """
+    def __init__(self, out):
+        self.out = out
+        self.offset = 0
+        self.index = []
+
+    def write(self, data):
+        self.out.write(data)
+        self.offset += len(data)
+
+    def copy(self, src):
+        """ Streams the open file SRC into the report """
+        while True:
+            chunk = src.read(MB)
+            if not chunk:
+                return
+            self.write(chunk)
+
+    def add_log(self, path):
+        """ Appends the stage log at PATH as an indexed section """
+        name = os.path.basename(path)
+        if name.endswith('.gz'):
+            name = name[:-3]
+        self.write('\n{1} {0} {1}\n'.format(name, '='*20))
+        start = self.offset
+        try:
+            with open_log(path) as log:
+                self.copy(log)
+        except (IOError, OSError) as e:
+            logger.error('Could not add log {} to report: {}'.format(path, e))
+            self.write('Log unavailable: {}\n'.format(e))
+        self.index.append({'log': name,
+                           'path': path,
+                           'offset': start,
+                           'length': self.offset - start})
+
+    def write_index(self):
+        """ Ends the report with the index of its logs """
+        self.write('\n{0} LOG INDEX {0}\n'.format('='*20))
+        self.write(json.dumps(self.index, indent=1))
+        self.write('\n')
+        return self.index
@@ -0,0 +1,226 @@
+"""
+Child jobs of a running job.
+
+(gather exp*) hands its expressions to SubJobs.  Each expression that
+does not refer to local definitions becomes a child job on the job
+queue.  It has the parent's data_id, so a worker on the same node
+reuses the staged input files.  Local definitions of plugin stages,
+the stages pipelines share, are evaluated in the parent: their output
+is uploaded and bound to the same names in the child jobs.  Job documents are claimed before a
+child runs: while the parent waits, it claims and runs the children no
+worker has taken yet, so a job never waits on an idle queue.  It
+downloads the results of the children other workers ran.
+"""
+
+import copy
+import json
+import logging
+import os
+import threading
+import time
+
+import asmtypes
+import utils
+import wasp
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 5
+WORKER = 'queue' # Claim of a child taken from the job queue
+
+
+class SubJobs:
+    def __init__(self, metadata, publisher, params, routing_key, download, upload, killed):
+        """
+        PARAMS are the job parameters of the parent, ROUTING_KEY its queue.
+        DOWNLOAD(file_info, outdir) returns the local copy of a result file,
+        UPLOAD(path) the FileInfo of a file stored in Shock, and KILLED() is
+        true once the parent is killed.
+        """
+        self.metadata = metadata
+        self.publisher = publisher
+        self.params = params
+        self.routing_key = routing_key
+        self.download = download
+        self.upload = upload
+        self.killed = killed
+        self.user = params['ARASTUSER']
+        self.job_id = params['job_id']
+        self.owner = 'job {}'.format(self.job_id)
+        self.count = 0
+        self.uploaded = {} # id of a shared WaspLink: its filesets, uploaded
+        self.lock = threading.Lock()
+
+    def gather(self, exps, env):
+        """ Values of EXPS, see wasp.gather """
+        with self.lock:
+            first = self.count
+            self.count += len(exps)
+        ## Children submitted before the parent was interrupted are reused
+        existing = {doc.get('subjob'): doc for doc in self.metadata.list_subjobs(self.user, self.job_id)}
+        values = [None] * len(exps)
+        local = []
+        children = {}
+        for i, exp in enumerate(exps):
+            links = self.shared_links(exp, env)
+            if links is None:
+                local.append(i)
+                continue
+            doc = existing.get(first + i)
+            if not doc or doc.get('wasp') != [wasp.to_string(exp)]:
+                doc = self.submit(first + i, exp, links)
+            children[i] = doc
+        logger.info('Job {}: {} branches in child jobs, {} here'.format(
+                self.job_id, len(children), len(local)))
+        scopes = wasp.cancel_scopes()
+        try:
+            while local or children:
+                self.check(scopes)
+                if local:
+                    i = local.pop(0)
+                    values[i] = wasp.try_eval(exps[i], env)
+                    continue
+                docs = {doc['_id']: doc for doc in self.metadata.list_subjobs(self.user, self.job_id)}
+                progress = False
+                for i, child in children.items():
+                    doc = docs.get(child['_id'], child)
+                    owner = doc.get('claimed_by')
+                    if owner in (None, self.owner) and self.metadata.claim_job(doc['_id'], self.owner):
+                        values[i] = self.run_here(doc, exps[i], env)
+                        del children[i]
+                        progress = True
+                        break
+                    elif owner == WORKER and finished(doc):
+                        values[i] = self.collect(doc, env)
+                        del children[i]
+                        progress = True
+                if not progress:
+                    time.sleep(POLL_INTERVAL)
+        except BaseException:
+            self.cancel(children.values())
+            raise
+        return values
+
+    def shared_links(self, exp, env):
+        """
+        {name: WaspLink} of the local definitions EXP uses, evaluated here,
+        or None if one is not the output of plugin stages, so EXP cannot
+        run in another job.
+        """
+        links = {}
+        for var, e in wasp.local_symbols(exp, env).items():
+            value = wasp.force(e[var], env)
+            if not isinstance(value, wasp.WaspLink):
+                return None
+            output = value.get('default_output')
+            outputs = output if isinstance(output, list) else [output]
+            if not outputs or not all(isinstance(fs, asmtypes.FileSet) for fs in outputs):
+                return None
+            links[var] = value
+        return links
+
+    def shipped(self, link):
+        """ The output filesets of LINK as job data, uploaded once """
+        with self.lock:
+            if id(link) in self.uploaded:
+                return self.uploaded[id(link)]
+        output = link['default_output']
+        filesets = []
+        for fs in output if isinstance(output, list) else [output]:
+            doc = dict(fs)
+            doc['file_infos'] = [self.upload(f) for f in fs.files]
+            filesets.append(doc)
+        with self.lock:
+            self.uploaded[id(link)] = filesets
+        return filesets
+
+    def submit(self, index, exp, links):
+        """ Queues EXP as a child job, with the shared stage outputs LINKS
+        bound by name, returns its job document """
+        source = wasp.to_string(exp)
+        child = copy.deepcopy(self.params)
+        for key in ['_id', 'claimed_by']:
+            child.pop(key, None)
+        child.update({'job_id': self.metadata.get_next_job_id(self.user),
+                      'pipeline': None,
+                      'recipe': None,
+                      'wasp': [source],
+                      'bindings': {var: self.shipped(link) for var, link in links.items()},
+                      'parent': self.job_id,
+                      'subjob': index,
+                      'status': 'Queued',
+                      'message': 'Job {} branch {}: {}'.format(self.job_id, index + 1, source)})
+        self.metadata.insert_job(child)
+        self.publisher.to_queue(self.routing_key, [json.dumps(child)], child.get('priority'))
+        logger.info('Submitted child job {}: {}'.format(child['job_id'], source))
+        return child
+
+    def run_here(self, doc, exp, env):
+        """ Evaluates the expression of a claimed child in the parent """
+        logger.info('Running child job {} in job {}'.format(doc['job_id'], self.job_id))
+        self.metadata.update_job(doc['_id'], 'status', 'Running in job {}'.format(self.job_id))
+        value = wasp.try_eval(exp, env)
+        status = 'Complete' if value is not None else '[FAIL]'
+        self.metadata.update_job(doc['_id'], 'status', '{} in job {}'.format(status, self.job_id))
+        return value
+
+    def collect(self, doc, env):
+        """ WaspLink of the results of a child run by another worker """
+        if not doc['status'].startswith('Complete'):
+            error = Exception('Child job {} ({}): {}'.format(doc['job_id'], doc['wasp'][0], doc['status']))
+            logger.warn(error)
+            env.errors.append(error)
+            return None
+        outdir = utils.verify_dir(os.path.join(env.outpath, 'job_{}'.format(doc['job_id'])))
+        results = [fs for fs in doc.get('result_data') or [] if fs['type'] != 'report']
+        wlink = fileset_link('job_{}'.format(doc['job_id']), results, self.download, outdir)
+        logger.info('Collected child job {}: {}'.format(doc['job_id'], doc['wasp'][0]))
+        return wlink
+
+    def check(self, scopes):
+        if self.killed():
+            raise asmtypes.ArastUserInterrupt('Terminated by user')
+        wasp.check_cancelled(scopes)
+
+    def cancel(self, children):
+        """ Withdraws queued CHILDREN and sends kill requests to running ones """
+        kills = []
+        for child in children:
+            try:
+                if self.metadata.claim_job(child['_id'], self.owner):
+                    self.metadata.update_job(child['_id'], 'status',
+                                             'Cancelled with job {}'.format(self.job_id))
+                else:
+                    kills.append(json.dumps({'user': self.user, 'job_id': str(child['job_id'])}))
+            except Exception as e:
+                logger.error('Could not cancel child job {}: {}'.format(child['job_id'], e))
+        if kills:
+            try:
+                self.publisher.to_exchange('kill', kills)
+            except Exception as e:
+                logger.error('Could not send kill requests to child jobs: {}'.format(e))
+
+
+def fileset_link(module, filesets, download, outdir):
+    """ WaspLink of MODULE whose output is FILESETS, job data downloaded to OUTDIR """
+    sets = []
+    for fs in filesets:
+        files = [download(fi, outdir) for fi in fs['file_infos']]
+        fields = {k: v for k, v in fs.items() if k not in ('type', 'file_infos', 'tags')}
+        fields['tags'] = [t for t in fs.get('tags', []) if not t.startswith('rank-')]
+        sets.append(asmtypes.set_factory(fs['type'], files, **fields))
+    wlink = wasp.WaspLink(module, [])
+    wlink['outpath'] = outdir
+    wlink['default_output'] = sets[0] if len(sets) == 1 else sets
+    return wlink
+
+def bound_links(bindings, download, outdir):
+    """ {name: WaspLink} of the BINDINGS a parent job handed to a child """
+    return {var: fileset_link(var, filesets, download,
+                              utils.verify_dir(os.path.join(outdir, var)))
+            for var, filesets in bindings.items()}
+
+def finished(doc):
+    status = doc.get('status') or ''
+    return (status.startswith('Complete') or status.startswith('[FAIL]') or
+            status.startswith('Terminated'))
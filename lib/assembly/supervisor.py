@@ -0,0 +1,216 @@
+"""
+Event-driven supervision of plugin commands.
+
+A Supervisor waits in select() on the output of a command and on a
+Waker, a pipe that other threads write to: the thread that reaps the
+command with wait4(), the KillSwitch of the worker when the job is
+killed, and the Wasp cancel scopes of the stage.  A command returns as
+soon as it exits, and is stopped as soon as it is killed or cancelled.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+import threading
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 64 * 1024
+
+
+class Waker:
+    """
+    A pipe that wakes a select() from other threads.  Once closed, set()
+    does nothing: the numbers of its fds may already be reused by other
+    files of the worker.
+    """
+    def __init__(self):
+        self.fd, self.write_fd = os.pipe()
+        ## set() never blocks, under the lock clear() needs
+        flags = fcntl.fcntl(self.write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def set(self):
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                os.write(self.write_fd, 'x')
+            except OSError:
+                pass # Full: the reader is awake anyway
+
+    def clear(self):
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                os.read(self.fd, READ_SIZE)
+            except OSError:
+                pass
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            for fd in (self.fd, self.write_fd):
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+
+
+class KillSwitch:
+    """
+    Kill requests of the jobs running in a worker.  Requests are kept
+    from start(user, job_id) to finish(user, job_id), so all concurrent
+    stages of a job see them, and wake the wakers watching the job.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {} # (user, job_id): [killed, watchers]
+
+    def start(self, user, job_id):
+        with self.lock:
+            self.jobs.setdefault((user, str(job_id)), [False, []])
+
+    def finish(self, user, job_id):
+        with self.lock:
+            self.jobs.pop((user, str(job_id)), None)
+
+    def kill(self, user, job_id):
+        """ Returns False if the job does not run here """
+        with self.lock:
+            job = self.jobs.get((user, str(job_id)))
+            if not job:
+                return False
+            job[0] = True
+            watchers = list(job[1])
+        for waker in watchers:
+            waker.set()
+        return True
+
+    def killed(self, user, job_id):
+        with self.lock:
+            job = self.jobs.get((user, str(job_id)))
+            return bool(job and job[0])
+
+    def watch(self, user, job_id, waker):
+        with self.lock:
+            job = self.jobs.get((user, str(job_id)))
+            if job:
+                job[1].append(waker)
+
+    def unwatch(self, user, job_id, waker):
+        with self.lock:
+            job = self.jobs.get((user, str(job_id)))
+            if job and waker in job[1]:
+                job[1].remove(waker)
+
+
+class Supervisor:
+    """
+    Supervises the subprocess.Popen P, started in its own process group
+    with its output on a pipe.  Its exit status and resource usage are
+    collected by a thread blocked in wait4().
+    """
+    def __init__(self, p):
+        self.p = p
+        self.waker = Waker()
+        self.usage = None
+        self.lock = threading.Lock()
+        self.closed = False
+        self.exited = threading.Event()
+        self.reaper = threading.Thread(target=self._reap)
+        self.reaper.daemon = True
+        self.reaper.start()
+
+    def _reap(self):
+        try:
+            while True:
+                try:
+                    _, status, self.usage = os.wait4(self.p.pid, 0)
+                    break
+                except OSError as e:
+                    if e.errno != errno.EINTR:
+                        logger.warning('Could not wait for process {}: {}'.format(self.p.pid, e))
+                        self.p.poll()
+                        return
+            if os.WIFSIGNALED(status):
+                self.p.returncode = -os.WTERMSIG(status)
+            else:
+                self.p.returncode = os.WEXITSTATUS(status)
+        finally:
+            with self.lock:
+                self.exited.set()
+                ## The pipe is closed here if run() has returned
+                if self.closed:
+                    self.waker.close()
+                else:
+                    self.waker.set()
+
+    def run(self, on_line, check, poll=None):
+        """
+        Passes each line of output to ON_LINE until the process exits,
+        and returns its exit code.  CHECK() is called whenever the waker
+        is set (or every POLL seconds) and raises to stop the process.
+        """
+        out = self.p.stdout.fileno()
+        fds = [out, self.waker.fd]
+        partial = ''
+        try:
+            while not self.exited.is_set():
+                check()
+                try:
+                    ready, _, _ = select.select(fds, [], [], poll)
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if self.waker.fd in ready:
+                    self.waker.clear()
+                if out in ready:
+                    partial = self._read(out, partial, on_line, fds)
+            check()
+            ## Output left in the pipe; descendants may still hold it open
+            while out in fds and select.select([out], [], [], 0)[0]:
+                partial = self._read(out, partial, on_line, fds)
+            if partial:
+                on_line(partial)
+        except BaseException:
+            self.stop()
+            raise
+        finally:
+            self.p.stdout.close()
+            with self.lock:
+                self.closed = True
+                if self.exited.is_set():
+                    self.waker.close()
+        return self.p.returncode
+
+    def _read(self, fd, partial, on_line, fds):
+        data = os.read(fd, READ_SIZE)
+        if not data:
+            fds.remove(fd)
+            return partial
+        lines = (partial + data).split('\n')
+        for line in lines[:-1]:
+            on_line(line + '\n')
+        ## Output without newlines (e.g. progress bars) is passed in chunks
+        if len(lines[-1]) > READ_SIZE:
+            on_line(lines[-1])
+            return ''
+        return lines[-1]
+
+    def stop(self):
+        """ Terminates the process group of a running process """
+        if not self.exited.is_set():
+            try:
+                os.killpg(self.p.pid, signal.SIGTERM)
+            except OSError:
+                pass
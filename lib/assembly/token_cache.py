@@ -0,0 +1,64 @@
+"""
+Process-local cache of validated authentication tokens.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class TokenCache:
+    """
+    Maps token hashes to users.  Entries expire after TTL seconds, or
+    NEGATIVE_TTL for rejected tokens, and the least recently used go
+    first beyond MAX_SIZE.  Concurrent lookups of a token that is not
+    cached share a single validation.
+    """
+    def __init__(self, ttl=15*60, negative_ttl=60, max_size=10000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.entries = OrderedDict() # key -> (expiration, user or None)
+        self.pending = {}            # key -> Event set when validated
+        self.lock = threading.Lock()
+
+    def get(self, token, validate):
+        """ Returns the user of TOKEN, calling VALIDATE(token) on a miss.
+        VALIDATE raises InvalidToken for tokens that must be rejected. """
+        key = hashlib.sha256(token).hexdigest()
+        while True:
+            with self.lock:
+                entry = self.entries.pop(key, None)
+                if entry and entry[0] > time.time():
+                    self.entries[key] = entry # Most recently used
+                    if entry[1] is None:
+                        raise InvalidToken('Rejected token')
+                    return entry[1]
+                waiting = self.pending.get(key)
+                if not waiting:
+                    self.pending[key] = threading.Event()
+            if not waiting:
+                break
+            waiting.wait()
+
+        try:
+            user = validate(token)
+            self._put(key, user, self.ttl)
+            return user
+        except InvalidToken:
+            self._put(key, None, self.negative_ttl)
+            raise
+        finally:
+            with self.lock:
+                self.pending.pop(key).set()
+
+    def _put(self, key, user, ttl):
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, user)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
@@ -1,7 +1,9 @@
 import errno
+import fcntl
 import json
 import os
 import re
+from contextlib import contextmanager
 
 class Error(Exception):
     """Base class for exceptions in this module"""
@@ -69,6 +71,48 @@ def load_json_from_file(json_file):
     return doc
 
 
+@contextmanager
+def locked_json(json_file, default, write=True):
+    """ Exclusive access to a JSON document shared by the processes of a node.
+    Yields the loaded document (or DEFAULT), written back on exit if WRITE. """
+    with open(json_file + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(json_file) as f:
+                    doc = json.load(f)
+            except (IOError, ValueError):
+                doc = default
+            yield doc
+            if write:
+                tmp = '{}.{}'.format(json_file, os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump(doc, f)
+                os.rename(tmp, json_file)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def tree_size(path):
+    """ Bytes used by the files under PATH """
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def pid_alive(pid):
+    """ True if process PID still exists """
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError as e:
+        return e.errno == errno.EPERM
+
 def is_non_zero_file(fpath):
     return True if os.path.isfile(fpath) and os.path.getsize(fpath) > 0 else False
 
@@ -3,10 +3,16 @@
 ################ Symbol, Env classes
 
 import os
-import itertools
+import hashlib
+import multiprocessing
+import Queue
+import re
+import threading
+import time
 import uuid
 import logging
 import traceback, sys
+from collections import OrderedDict
 
 #### Arast Libraries
 import assembly as utils
@@ -17,13 +23,19 @@ logger = logging.getLogger(__name__)
 
 Symbol = str
 
+class Global(Symbol):
+    "A symbol no expression binds, looked up directly in the root Env."
+    __slots__ = ()
+
 class Env(dict):
     "An environment: a dict of {'var':val} pairs, with an outer Env."
     def __init__(self, parms=(), args=(), outer=None, meta=None, job_data=None):
         self.update(zip(parms,args))
         self.outer = outer
         if outer is not None:
+            self.root = outer.root
             self.emissions = outer.emissions
+            self.thunks = outer.thunks
             self.uid = outer.uid
             self.meta = outer.meta
             self.global_data = outer.global_data
@@ -32,12 +44,16 @@ class Env(dict):
             self.errors = outer.errors
             self.outpath = outer.outpath
         else:
+            self.root = self
             self.emissions = []
+            self.thunks = []
             self.uid = job_data['uid']
             self.outpath = os.path.join(job_data['datapath'], str(job_data['job_id']))
             self.meta = meta
             self.global_data = {'stage': 1,
-                                'stages': 0}
+                                'stages': 0,
+                                'branches': 1,
+                                'stage_lock': threading.Lock()}
 
             self.plugins = []
             self.exceptions = []
@@ -53,12 +69,15 @@ class Env(dict):
     def next_stage(self, module=''):
         "Increment the stage and update the status"
         if module in self.plugins:
+            ## Concurrent branches each take their own stage number
+            with self.global_data['stage_lock']:
+                stage = self.global_data['stage']
+                self.global_data['stage'] += 1
             try:
                 self.meta.update_job(self.uid, 'status',
-                                     'Stage {}/{}: {}'.format(self.global_data['stage'],
+                                     'Stage {}/{}: {}'.format(stage,
                                                               self.global_data['stages']
                                                               , module))
-                self.global_data['stage'] += 1
             except: pass
 
 def add_globals(env):
@@ -75,12 +94,20 @@ def add_globals(env):
       'slice': lambda x,begin,end: x[begin:end]})
     return env
 
+## Data functions of wasp_functions available to expressions
+functions = {'arast_score': wf.arast_score,
+             'has_paired': wf.has_paired,
+             'has_short_reads_only': wf.has_short_reads_only,
+             'n50': wf.n50}
+
 isa = isinstance
 
 def eval(x, env):
     "Evaluate an expression in an environment."
     if isa(x, Symbol):             # variable reference
         try:
+            if type(x) is Global:
+                return env.root[x]
             return env.find(x)[x]
         except:
             raise Exception('Module "{}" not found'.format(x))
@@ -96,7 +123,7 @@ def eval(x, env):
         eval_files = []
         try:
             for exp in x[1:]:
-                eval_files += eval(exp, env).files
+                eval_files += force(eval(exp, env), env).files
             wlink['default_output'] = asmtypes.set_factory(x[0], eval_files,
                                                            name='{}_override'.format(x[0]))
         except Exception as e:
@@ -110,7 +137,7 @@ def eval(x, env):
         elif len(x) == 3:
             (_, test, conseq) = x
             alt = None
-        if eval(test, env):
+        if force(eval(test, env), env):
             return eval(conseq, env)
         elif alt:
             return eval(alt, env)
@@ -121,11 +148,15 @@ def eval(x, env):
     elif x[0] == 'setparam':
         (_, param, value) = x
         try:
-            env.parameters[param] = env.find(value)[value]
+            value = env.find(value)[value]
         except:
-            env.parameters[param] = value
+            pass
+        env.parameters[param] = force(value, env)
     elif x[0] == 'define':         # (define var exp)
         (_, var, exp) = x
+        if not mutates_env(exp):
+            env[var] = Thunk(var, exp, env)
+            return
         try:
             env[var] = eval(exp, env)
         except Exception as e:
@@ -133,7 +164,7 @@ def eval(x, env):
             logger.debug(traceback.format_exc())
             env[var] = None
     elif x[0] == 'sort':
-        seq = [link for link in eval(x[1], env) if link is not None and link.output]
+        seq = [link for link in force(eval(x[1], env), env) if link is not None and link.output]
         logger.debug(seq)
         if len(seq) == 1: return seq
         try: pred = x[2]
@@ -142,11 +173,11 @@ def eval(x, env):
             k = x[3]
             assert k == ':key'
             lam = x[4]
-            eval(['define', 'sort_func', lam], env)
+            env['sort_func'] = eval(lam, env)
         except: lam = None
         rev = pred == '>'
         if lam:
-            l = sorted(seq, key=lambda n: eval(['sort_func', n], env), reverse=rev)
+            l = sorted(seq, key=lambda n: force(eval(['sort_func', n], env), env), reverse=rev)
         else:
             l = sorted(seq, reverse=rev)
         return l
@@ -156,7 +187,7 @@ def eval(x, env):
     elif x[0] == 'upload':          # (upload exp) Store each intermediate for return
         (_,  exp) = x
         try:
-            val = eval(exp, env)
+            val = force(eval(exp, env), env)
             results = val
         except Exception as e:
             logger.warn('Failed to evaluate upload of "{}": {}'. format(to_string(exp), e))
@@ -173,7 +204,7 @@ def eval(x, env):
 
     elif x[0] == 'get':
         (_, key, exp) = x
-        chain = eval(exp, env)
+        chain = force(eval(exp, env), env)
         assert type(chain) is WaspLink
         val = chain.get_value(key)
         if isinstance(val, asmtypes.FileSet):
@@ -183,7 +214,7 @@ def eval(x, env):
             return val
     elif x[0] == 'all_files': ## Gets all data from module directory
         (_, exp) = x
-        chain = eval(exp, env)
+        chain = force(eval(exp, env), env)
         assert type(chain) is WaspLink
         all_files = utils.ls_recursive(chain['outpath'])
         module = chain['module']
@@ -193,7 +224,7 @@ def eval(x, env):
         return chain
     elif x[0] == 'tar': ## Tar outputs from WaspLink(s)
         bare_exp, kwargs = extract_kwargs(x)
-        wlinks = [eval(exp, env) for exp in bare_exp[1:]]
+        wlinks = force([eval(exp, env) for exp in bare_exp[1:]], env)
 
         ### Format tarball name
         if 'name' in kwargs:
@@ -215,51 +246,384 @@ def eval(x, env):
             name=tar_name, keep_name=True, tags=tags)
         return chain
 
+    elif x[0] == 'with-timeout':   # (with-timeout seconds exp [fallback])
+        seconds = force(eval(x[1], env), env)
+        finished = eval_cancellable(x[2:3], 1, env, timeout=float(seconds))
+        if finished:
+            return finished[0]
+        logger.warning('No value within {} s: {}'.format(seconds, to_string(x[2])))
+        if len(x) > 3:
+            return eval(x[3], env)
+
+    elif x[0] == 'race':           # (race n exp*) First N values to finish
+        n = force(eval(x[1], env), env)
+        return eval_cancellable(x[2:], int(n), env)
+
+    elif x[0] == 'gather':         # (gather exp*) Values of EXPs, run as child jobs when possible
+        return gather(x[1:], env)
+
     elif x[0] == 'begin':          # (begin exp*) Return each intermediate
-        inner_env = Env(outer=env)
-        val = []
-        for exp in x[1:]:
-            try:
-                ret = eval(exp, inner_env)
-                if ret:val.append(ret)
-            except Exception as e:
-                if list(e):
-                    logger.warning('Failed to eval "{}": {}'.format(to_string(exp), e))
-                    logger.debug(traceback.format_exc())
-                    env.errors.append(e)
-                    env.exceptions.append(traceback.format_exc())
-        if val:
-            return val if len(val) > 1 else val[0]
+        return eval_sequence(x[1:], Env(outer=env))
 
     elif x[0] == 'print':
         for exp in x[1:]:
-            print eval(exp, env)
+            print force(eval(exp, env), env)
 
     elif x[0] == 'prog':          # same as begin, but use same env
-        val = []
-        for exp in x[1:]:
-            try:
-                ret = eval(exp, env)
-                if ret: val.append(ret)
-            except Exception as e:
-                if list(e):
-                    logger.warning('Failed to eval "{}": {}'.format(to_string(exp), e))
-                    logger.debug(traceback.format_exc())
-                    env.errors.append(e)
-                    env.exceptions.append(traceback.format_exc())
-        if val:
-            return val if len(val) > 1 else val[0]
-
+        return eval_sequence(x[1:], env)
 
     else:                          # (proc exp*)
-        exps = [eval(exp, env) for exp in x]
-        proc = exps.pop(0)
+        proc = force(eval(x[0], env), env)
+        if can_branch(x[1:], env):
+            exps = []
+            for val, exc in eval_branches(x[1:], env):
+                if exc:
+                    raise exc[0], exc[1], exc[2]
+                exps.append(val)
+        else:
+            exps = [eval(exp, env) for exp in x[1:]]
+        name = x[0] if isa(x[0], Symbol) else None
+        if name in TYPE_PREDICATES and exps and all(is_pending_link(v, env) for v in exps):
+            return False
+        if name in STRUCTURAL:
+            forced = STRUCTURAL[name]
+            exps = [force(v, env, deep=False) if i in forced else v for i, v in enumerate(exps)]
+        else:
+            exps = force(exps, env)
         env.next_stage(x[0])
         try: ## Assembly functions
             return proc(*exps, env=env)
         except TypeError as e: ## Built-in functions
             logger.debug(traceback.format_exc())
             return proc(*exps)
+
+################ Child jobs
+
+def gather(exps, env):
+    """
+    Values of independent EXPS; an expression that fails gives None.
+    With a dispatcher (subjobs.SubJobs) they run as child jobs on the
+    job queue, otherwise as concurrent branches of this job.
+    """
+    dispatcher = env.global_data.get('subjobs')
+    if dispatcher is not None:
+        return dispatcher.gather(exps, env)
+    if can_branch(exps, env):
+        outcomes = eval_branches(exps, env)
+    else:
+        outcomes = [(try_eval(exp, env), None) for exp in exps]
+    values = []
+    for exp, (val, exc) in zip(exps, outcomes):
+        if exc and not issubclass(exc[0], Exception):
+            raise exc[0], exc[1], exc[2]
+        elif exc:
+            record_failure(exp, exc, env)
+        values.append(val)
+    return values
+
+def try_eval(exp, env):
+    "Value of EXP, or None if it fails.  Interrupts are not caught."
+    try:
+        return eval(exp, env)
+    except Exception:
+        record_failure(exp, sys.exc_info(), env)
+
+def record_failure(exp, exc, env):
+    logger.warn('Failed to evaluate "{}": {}'.format(to_string(exp), exc[1]))
+    env.errors.append(exc[1])
+    env.exceptions.append(''.join(traceback.format_exception(*exc)))
+
+def is_closed(exp, env):
+    "True if EXP refers to no local bindings of ENV, so another job can run it."
+    return not local_symbols(exp, env)
+
+def local_symbols(exp, env):
+    "The symbols of EXP bound in ENV or its outer Envs below the root, with their Env."
+    bound = {}
+    for var in symbols(exp):
+        if type(var) is Global:
+            continue
+        e = env
+        while e is not None and var not in e:
+            e = e.outer
+        if e is not None and e is not env.root:
+            bound[var] = e
+    return bound
+
+################ Lazy definitions
+
+## Builtins that need only some of their arguments (by position) evaluated
+STRUCTURAL = {'list': (), 'cons': (1,), 'append': (0, 1), 'car': (0,), 'cdr': (0,),
+              'slice': (0,), 'length': (0,)}
+## Builtins answered without running a definition that calls a plugin
+TYPE_PREDICATES = set(['symbol?', 'list?', 'null?'])
+
+class Thunk(object):
+    """
+    A definition, evaluated the first time its value is needed.  It sees
+    the bindings and parameters of its Env as they were when defined.
+    """
+    def __init__(self, name, exp, env):
+        self.name = name
+        self.exp = exp
+        bound = {}
+        for var in symbols(exp):
+            if type(var) is not Global:
+                try: bound[var] = env.find(var)[var]
+                except AttributeError: pass
+        self.env = Env(bound.keys(), bound.values(), outer=env)
+        self.env.parameters = dict(env.parameters)
+        self.forced = False
+        self.value = None
+        self.lock = threading.Lock()
+        env.thunks.append(self)
+
+    def force(self):
+        with self.lock:
+            if not self.forced:
+                logger.debug('Evaluating definition of "{}"'.format(self.name))
+                try:
+                    self.value = eval(self.exp, self.env)
+                except Exception as e:
+                    logger.warning('Failed to evaluate definition of "{}": {}'.format(self.name, e))
+                    logger.debug(traceback.format_exc())
+                    self.value = None
+                self.forced = True
+            return self.value
+
+def force(value, env, deep=True):
+    """
+    VALUE with its definitions replaced by their values, running those
+    not yet evaluated; independent ones with plugin stages run
+    concurrently.  Unless DEEP, list elements are left as they are.
+    """
+    while True:
+        pending = unforced(value, deep)
+        if not pending:
+            return forced_value(value, deep)
+        if len(pending) > 1 and can_branch([t.exp for t in pending], env):
+            run_branches([t.force for t in pending])
+        else:
+            for t in pending:
+                t.force()
+
+def unforced(value, deep, found=None):
+    "Definitions in VALUE that have not been evaluated."
+    if found is None:
+        found = []
+    if isa(value, Thunk):
+        if not value.forced:
+            if value not in found:
+                found.append(value)
+        else:
+            unforced(value.value, deep, found)
+    elif deep and isa(value, list):
+        for v in value:
+            unforced(v, deep, found)
+    return found
+
+def forced_value(value, deep):
+    if isa(value, Thunk):
+        return forced_value(value.value, deep)
+    elif deep and isa(value, list):
+        return [forced_value(v, deep) for v in value]
+    return value
+
+def is_pending_link(value, env):
+    "True for an unevaluated plugin call, whose value is a WaspLink or None."
+    return (isa(value, Thunk) and not value.forced and isa(value.exp, list)
+            and bool(value.exp) and value.exp[0] in env.plugins)
+
+################ Branch evaluation
+
+def eval_sequence(body, env):
+    "Evaluate a begin/prog body, returning the values of its expressions."
+    val = []
+    for exp in body:
+        try:
+            ret = eval(exp, env)
+        except Exception as e:
+            if list(e):
+                logger.warning('Failed to eval "{}": {}'.format(to_string(exp), e))
+                logger.debug(traceback.format_exc())
+                env.errors.append(e)
+                env.exceptions.append(traceback.format_exc())
+            continue
+        if ret:
+            val.append(ret)
+    if val:
+        return val if len(val) > 1 else val[0]
+
+def symbols(x):
+    "All symbols referenced in expression X."
+    if isa(x, Symbol):
+        return set([x])
+    elif isa(x, list):
+        return set().union(*[symbols(e) for e in x])
+    return set()
+
+def mutates_env(x, local=False):
+    "True if evaluating X may rebind names or parameters of the enclosing Env."
+    if not isa(x, list) or not x:
+        return False
+    if x[0] == 'set!':
+        return True
+    if x[0] in ['define', 'setparam'] and not local:
+        return True
+    local = local or x[0] in ['begin', 'lambda']
+    return any(mutates_env(e, local) for e in x[1:])
+
+def has_stage(x, env):
+    "True if expression X calls a plugin."
+    if not isa(x, list) or not x:
+        return False
+    if isa(x[0], Symbol) and x[0] in env.plugins:
+        return True
+    return any(has_stage(e, env) for e in x)
+
+def can_branch(exps, env):
+    """
+    Worth running EXPS concurrently: more than one of them runs plugins.
+    EXPS that rebind names or parameters of ENV, which the other branches
+    share, are evaluated in order.
+    """
+    if env.global_data['branches'] < 2:
+        return False
+    if any(mutates_env(e) for e in exps):
+        return False
+    return len([e for e in exps if has_stage(e, env)]) > 1
+
+def eval_branches(exps, env):
+    """
+    Evaluate independent expressions in their own threads.
+    Returns a (value, exc_info) pair per expression, in order.
+    Plugin stages are throttled by the engine's stage slots.
+    """
+    return run_branches([lambda exp=exp: eval(exp, env) for exp in exps])
+
+def run_branches(funcs):
+    "Call FUNCS in their own threads, see eval_branches."
+    outcomes = [(None, None)] * len(funcs)
+    scopes = cancel_scopes()
+    def branch(i, func):
+        local.cancel_scopes = scopes
+        try:
+            outcomes[i] = (func(), None)
+        except BaseException:
+            outcomes[i] = (None, sys.exc_info())
+    logger.info('Evaluating {} branches concurrently'.format(len(funcs)))
+    threads = [threading.Thread(target=branch, args=(i, func)) for i, func in enumerate(funcs)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    ## Interrupts (ArastUserInterrupt) are not caught by callers
+    for _, exc in outcomes:
+        if exc and not isinstance(exc[1], Exception):
+            raise exc[0], exc[1], exc[2]
+    return outcomes
+
+################ Deadlines and races
+
+local = threading.local()
+
+class CancelScope(object):
+    "Cancels the plugin stages started under it, waking the supervisors of their commands."
+    def __init__(self):
+        self.event = threading.Event()
+        self.reason = None
+        self.watchers = []
+
+    def cancel(self, reason):
+        self.reason = reason
+        self.event.set()
+        for waker in list(self.watchers):
+            waker.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+def cancel_scopes():
+    "Cancel scopes of the expression the current thread evaluates."
+    return getattr(local, 'cancel_scopes', ())
+
+def check_cancelled(scopes):
+    for scope in scopes:
+        if scope.cancelled:
+            raise asmtypes.ArastStageCancelled(scope.reason)
+
+def eval_cancellable(exps, n, env, timeout=None):
+    """
+    Evaluate EXPS concurrently, each under its own CancelScope, and
+    return the first N values to finish, in order of completion.  The
+    other expressions are cancelled, and all of them are when TIMEOUT
+    seconds pass first.  Failed expressions are recorded as errors.
+    """
+    parent = cancel_scopes()
+    scopes = [CancelScope() for _ in exps]
+    done = Queue.Queue()
+    def branch(i, exp):
+        local.cancel_scopes = parent + (scopes[i],)
+        try:
+            done.put((i, force(eval(exp, env), env), None))
+        except BaseException:
+            done.put((i, None, sys.exc_info()))
+    threads = [threading.Thread(target=branch, args=(i, exp)) for i, exp in enumerate(exps)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    deadline = time.time() + timeout if timeout is not None else None
+    values = []
+    outcomes = []
+    try:
+        while len(outcomes) < len(exps) and len(values) < n:
+            try:
+                if deadline is None:
+                    ## Without a timeout, get() does not see signals
+                    outcome = done.get(timeout=60 * 60 * 24 * 365)
+                else:
+                    outcome = done.get(timeout=max(0, deadline - time.time()))
+            except Queue.Empty:
+                break
+            outcomes.append(outcome)
+            i, val, exc = outcome
+            if not exc and val is not None:
+                values.append(val)
+    finally:
+        for scope in scopes:
+            if not scope.cancelled:
+                scope.cancel('Cancelled' if deadline is None else 'Timed out after {} s'.format(timeout))
+        for t in threads:
+            t.join()
+    while not done.empty():
+        outcomes.append(done.get())
+
+    check_cancelled(parent)
+    for i, val, exc in outcomes:
+        if not exc or isinstance(exc[1], asmtypes.ArastStageCancelled):
+            continue
+        if not isinstance(exc[1], Exception): # Interrupts
+            raise exc[0], exc[1], exc[2]
+        logger.warning('Failed to eval "{}": {}'.format(to_string(exps[i]), exc[1]))
+        env.errors.append(exc[1])
+        env.exceptions.append(''.join(traceback.format_exception(*exc)))
+    return values
+
+def stage_slots(workers):
+    """
+    Number of plugin stages a job may run at once: its worker's share
+    of the cores currently idle on the node.
+    """
+    cores = multiprocessing.cpu_count()
+    try:
+        idle = cores - os.getloadavg()[0]
+    except OSError:
+        idle = cores
+    return max(1, int(idle / max(1, int(workers))))
+
 ################ parse, read, and user interaction
 
 def extract_kwargs(exp):
@@ -284,25 +648,31 @@ def read(s):
 
 parse = read
 
+token_re = re.compile(r'[()]|[^\s()]+')
+
 def tokenize(s):
     "Convert a string into a list of tokens."
-    return s.replace('(',' ( ').replace(')',' ) ').split()
+    return token_re.findall(s)
 
 def read_from(tokens):
-    "Read an expression from a sequence of tokens."
-    if len(tokens) == 0:
-        raise SyntaxError('unexpected EOF while reading')
-    token = tokens.pop(0)
-    if '(' == token:
-        L = []
-        while tokens[0] != ')':
-            L.append(read_from(tokens))
-        tokens.pop(0) # pop off ')'
-        return L
-    elif ')' == token:
-        raise SyntaxError('unexpected )')
-    else:
-        return atom(token)
+    "Read an expression from a sequence of tokens, consuming them."
+    stack = []
+    for i, token in enumerate(tokens):
+        if '(' == token:
+            stack.append([])
+            continue
+        elif ')' == token:
+            if not stack:
+                raise SyntaxError('unexpected )')
+            exp = stack.pop()
+        else:
+            exp = atom(token)
+        if stack:
+            stack[-1].append(exp)
+        else:
+            del tokens[:i+1]
+            return exp
+    raise SyntaxError('unexpected EOF while reading')
 
 def atom(token):
     "Numbers become numbers; every other token is a symbol."
@@ -324,11 +694,92 @@ def repl(prompt='lis.py> '):
             print to_string(val)
 
 def run(exp, env):
-    stages = 0
-    for plugin in env.plugins:
-        stages += exp.count(plugin)
-    env.global_data['stages'] = stages
-    return eval(parse(exp), env=env)
+    "Evaluate EXP, Wasp source or a compiled expression."
+    if isa(exp, basestring):
+        exp = compile(exp)
+    env.global_data['stages'] = count_stages(exp, env.plugins)
+    return eval(exp, env=env)
+
+def count_stages(x, plugins):
+    if isa(x, list):
+        return sum(count_stages(e, plugins) for e in x)
+    return 1 if isa(x, Symbol) and x in plugins else 0
+
+################ Compilation
+
+SPECIAL_FORMS = set(['quote', 'contigs', 'paired', 'single', 'reference', 'if', 'set!',
+                     'setparam', 'define', 'sort', 'lambda', 'upload', 'get', 'all_files',
+                     'tar', 'with-timeout', 'race', 'gather', 'begin', 'print', 'prog'])
+COMPILE_CACHE_SIZE = 256
+compiled = OrderedDict()
+compiled_lock = threading.Lock()
+
+def compile(s):
+    """
+    Parse Wasp source S and resolve its free symbols to the root Env.
+    Results are cached by content hash and shared: evaluation never
+    modifies an expression.
+    """
+    key = hashlib.sha1(s.encode('utf-8') if isa(s, unicode) else s).hexdigest()
+    with compiled_lock:
+        exp = compiled.pop(key, None)
+        if exp is not None:
+            compiled[key] = exp
+            return exp
+    exp = resolve(parse(s))
+    with compiled_lock:
+        compiled[key] = exp
+        while len(compiled) > COMPILE_CACHE_SIZE:
+            compiled.popitem(last=False)
+    return exp
+
+def resolve(x):
+    "Mark the symbols of X that nothing in X binds as Globals."
+    bound = set(['sort_func'])
+    def binders(x):
+        if not isa(x, list) or not x:
+            return
+        if x[0] == 'define' and len(x) > 1 and isa(x[1], Symbol):
+            bound.add(x[1])
+        elif x[0] == 'lambda' and len(x) > 1 and isa(x[1], list):
+            bound.update(x[1])
+        for e in x:
+            binders(e)
+    def walk(x, head=False):
+        if isa(x, list):
+            if x and x[0] == 'quote':
+                return x
+            return [walk(e, i == 0) for i, e in enumerate(x)]
+        if (type(x) is Symbol and x not in bound and not x.startswith(':')
+            and not (head and x in SPECIAL_FORMS)):
+            return Global(x)
+        return x
+    binders(x)
+    return walk(x)
+
+def prefix_name(exp, prefix, key='name'):
+    """
+    Copy of EXP with the value of its first :KEY keyword prefixed,
+    e.g. (... :name analysis) -> (... :name 42_analysis)
+    """
+    def find(x):
+        if isa(x, list):
+            for i, e in enumerate(x):
+                if e == ':' + key and i + 1 < len(x) and not isa(x[i+1], list):
+                    return x[i+1]
+                found = find(e)
+                if found is not None:
+                    return found
+        return None
+    value = find(exp)
+    if value is None:
+        return exp
+    new_value = Symbol('{}_{}'.format(prefix, value))
+    def walk(x):
+        if isa(x, list):
+            return [walk(e) for e in x]
+        return new_value if isa(x, Symbol) and x == value else x
+    return walk(exp)
 
 
 class WaspLink(dict):
@@ -409,11 +860,17 @@ class WaspLink(dict):
             return wlink.find_module(module)
 
 class WaspEngine():
-    def __init__(self, plugin_manager, job_data, meta=None):
+    def __init__(self, plugin_manager, job_data, meta=None, subjobs=None, bindings=None):
+        """ SUBJOBS (subjobs.SubJobs) runs the branches of (gather ...) as child jobs.
+        BINDINGS are WaspLinks bound by name, the shared stages of a parent job """
         self.constants_reads = 'READS'
         self.constants_contigs = 'CONTIGS'
         self.pmanager = plugin_manager
         self.assembly_env = add_globals(Env(job_data=job_data, meta=meta))
+        branches = stage_slots(self.pmanager.threads)
+        self.assembly_env.global_data['branches'] = branches
+        self.assembly_env.global_data['subjobs'] = subjobs
+        self.stage_slots = threading.BoundedSemaphore(branches)
         self.assembly_env.update({k:self.get_wasp_func(k, job_data) for k in self.pmanager.plugins})
         self.assembly_env.plugins = self.pmanager.plugins
         self.job_data = job_data
@@ -428,17 +885,22 @@ class WaspEngine():
 
         self.assembly_env.update({self.constants_reads: reads_link})
         self.assembly_env.update({self.constants_contigs: contigs_link})
-        self.assembly_env.update({'arast_score': wf.arast_score,
-                                  'has_paired': wf.has_paired,
-                                  'has_short_reads_only': wf.has_short_reads_only,
-                                  'n50': wf.n50})
+        self.assembly_env.update(functions)
+        self.assembly_env.update(bindings or {})
 
     def run_expression(self, exp, job_data=None):
         if not job_data:
             job_data = self.job_data
         ## Run Wasp expression
-        if type(exp) is str or type(exp) is unicode:
-            w_chain = run(exp, self.assembly_env)
+        w_chain = force(run(exp, self.assembly_env), self.assembly_env)
+        skipped = [t.name for t in self.assembly_env.thunks if not t.forced]
+        if skipped:
+            logger.info('Skipped unused definitions: {}'.format(', '.join(skipped)))
+            job_data['skipped'] = skipped
+            try:
+                job_data['out_report'].write('Skipped unused definitions: {}\n'.format(', '.join(skipped)))
+            except Exception as e:
+                logger.error('Could not write to report: {}'.format(e))
         ## Record results into job_data
         if type(w_chain) is not list: # Single
             w_chain = [w_chain]
@@ -447,6 +909,9 @@ class WaspEngine():
                 job_data.add_results(w['default_output'])
             except:
                 logger.warn('Output not added: {}'.format(w))
+        ## The final chain, for the job report
+        if isinstance(w_chain[0], WaspLink):
+            job_data['wasp_chain'] = w_chain[0]
         job_data['tracebacks'] = [str(e) for e in self.assembly_env.exceptions]
         job_data['errors'] = [str(e) for e in self.assembly_env.errors]
         return w_chain[0]
@@ -463,19 +928,28 @@ class WaspEngine():
                  else:
                      links.append(link)
              wlink = WaspLink(module, links)
-             self.pmanager.run_proc(module, wlink, job_data, env.parameters)
+             scopes = cancel_scopes()
+             with self.stage_slots:
+                 check_cancelled(scopes)
+                 self.pmanager.run_proc(module, wlink, job_data, env.parameters, scopes)
              return wlink
          return run_module
 
 ###### Utility
 
-def pipelines_to_exp(pipes, job_id):
+def pipelines_to_exp(pipes, job_id, subjobs=False):
     """
     Convert pipeline mode into Wasp expression
+    With SUBJOBS, the pipelines are gathered from child jobs
     """
     # Assume that these modules will use initial reads
     add_reads = ['sspace', 'reapr', 'bwa', 'bowtie2']
 
+    def with_params(exp, params):
+        if not params:
+            return exp
+        return ['begin'] + [['setparam', k, atom(v)] for k, v in params] + [exp]
+
     all_pipes = []
     for pipe in pipes:
         exp = 'READS'
@@ -484,72 +958,75 @@ def pipelines_to_exp(pipes, job_id):
             if m[0] == '?':
                 params.append(m[1:].split('='))
             else:
-                if params:
-                    setparams = ' '.join(['(setparam {} {})'.format(p[0], p[1]) for p in params])
-                    exp = '(begin {} {})'.format(setparams, exp)
-                    params = []
+                exp = with_params(exp, params)
+                params = []
                 if m in add_reads:
-                    exp = '({} {} READS)'.format(m, exp)
+                    exp = [m, exp, 'READS']
                 else:
-                    exp = '({} {})'.format(m, exp)
+                    exp = [m, exp]
+        all_pipes.append(with_params(exp, params))
 
-        #### Flush params
-        if params:
-            setparams = ' '.join(['(setparam {} {})'.format(p[0], p[1]) for p in params])
-            exp = '(begin {} {})'.format(setparams, exp)
-            params = []
+    defs, all_pipes = share_stages(all_pipes)
+    if subjobs and len(all_pipes) > 1:
+        ## Shared stages run once in this job, and their results are
+        ## handed to the child jobs of the pipelines using them
+        candidates = ['gather'] + all_pipes
+    else:
+        candidates = ['list'] + all_pipes
 
-        #exp = '(upload {})'.format(exp)
-        #all_pipes.append(exp)
-        all_pipes.append(exp)
+    #### Form final expression
+    ranked_upload = ['upload', ['sort', candidates, '>',
+                                ':key', ['lambda', ['c'], ['arast_score', 'c']]]]
+    final_exp = ['begin'] + defs + [['tar', ['all_files', ['quast', ranked_upload]],
+                                     ':name', '{}_analysis'.format(job_id), ':tag', 'quast']]
+    return resolve(final_exp)
 
+def share_stages(exps, prefix='val'):
+    """
+    Hash-cons the stages of EXPS, plugin calls with the (setparam ...)
+    that wrap them: identical stages become one node, and nodes used
+    by more than one stage or expression are bound once by a define.
+    Returns the defines and the distinct rewritten expressions.
+    """
+    nodes = OrderedDict() # key -> stage, its input stages replaced by keys
+    users = {}            # key -> keys of the stages using it, None for EXPS
 
-    #### Check for duplicates and redefine
-    val_num = 0
-    replacements = []
-    defs = []
-    reversed_pairs = set()
-    lces = set()
-
-    for pipe1, pipe2 in itertools.permutations(all_pipes, 2):
-        reversed_pairs.add((pipe2, pipe1))
-        if not (pipe1, pipe2) in reversed_pairs:
-            for n in get_orphans(pipe1):
-                for m in get_orphans(pipe2):
-                    if n == m and to_string(n) not in lces:
-                        lce = to_string(n)
-                        lces.add(lce)
-                        replacements.append((lce.strip(), 'val{}'.format(val_num)))
-                        defs.append('(define val{} {})'.format(val_num, lce.strip()))
-                        val_num += 1
-
-    #### Replace defined expressions
-    for replacement in replacements:
-        for i, pipe in enumerate(all_pipes):
-            all_pipes[i] = pipe.replace(*replacement)
+    def intern(x):
+        if not isa(x, list):
+            return x
+        call = x[-1] if x[0] == 'begin' else x
+        call = call[:1] + [intern(e) for e in call[1:]]
+        node = x[:-1] + [call] if x[0] == 'begin' else call
+        key = to_string(node)
+        if key not in nodes:
+            nodes[key] = node
+            users[key] = set()
+            for e in call[1:]:
+                if e in nodes:
+                    users[e].add(key)
+        return key
 
-    #### Form final expression
-    ranked_upload = '(upload (sort (list {}) > :key (lambda (c) (arast_score c))))'.format(' '.join(all_pipes))
-    final_exp = '(begin {} (tar (all_files (quast {})) :name {}_analysis :tag quast))'.format(' '.join(defs), ranked_upload, job_id)
-    return final_exp
+    def build(key):
+        if key in names:
+            return names[key]
+        node = nodes[key]
+        call = node[-1] if node[0] == 'begin' else node
+        call = call[:1] + [build(e) if e in nodes else e for e in call[1:]]
+        return node[:-1] + [call] if node[0] == 'begin' else call
 
+    keys = []
+    for exp in exps:
+        key = intern(exp)
+        if key in nodes:
+            users[key].add(None)
+        if key not in keys:
+            keys.append(key)
 
-def _has_sibling(exp_list, exp):
-    if not exp_list:
-        return False
-    siblings = 0
-    for e in exp_list:
-        if type(e) is list:
-            siblings += 1
-    return exp in exp_list and siblings > 1
-
-def orphans(exp_list, parent=None):
-    for i,l in enumerate(exp_list):
-        if type(l) is list:
-            for e in orphans(l, parent=exp_list):
-                yield e
-        elif i == 0 and not _has_sibling(parent, exp_list):
-            yield exp_list
-
-def get_orphans(pipe_string):
-    return [o for o in orphans(read_from(tokenize(pipe_string)))]
+    names = {}
+    defs = []
+    for key in nodes: # Inputs are interned before the stages using them
+        if len(users[key]) > 1:
+            name = '{}{}'.format(prefix, len(defs))
+            defs.append(['define', name, build(key)])
+            names[key] = name
+    return defs, [build(key) if key in nodes else key for key in keys]
@@ -2,8 +2,8 @@ import logging
 import os
 
 import asmtypes
+import fasta_stats
 import wasp
-from Bio import SeqIO
 
 
 logger = logging.getLogger(__name__)
@@ -47,44 +47,15 @@ def wasp_filesets(func):
 ###### Raw data Functions
 @wasp_contigs
 def n50(contigs):
-    ''' https://code.google.com/p/biopyscripts '''
-    contig = contigs[0]
-    contigsLength = []
-    sum = 0
-    for seq_record in SeqIO.parse(open(contig), "fasta"):
-        sum += len(seq_record.seq)
-        contigsLength.append(len(seq_record.seq))
-
-    teoN50 = sum / 2.0
-    contigsLength.sort()
-    contigsLength.reverse()
-
-    #checking N50
-    testSum = 0
-    N50 = 0
-    for con in contigsLength:
-        testSum += con
-        if teoN50 < testSum:
-            N50 = con
-            break
-    logger.info('N50 = {}: {}'.format(N50, contig))
+    N50 = fasta_stats.n50(contigs[0])
+    logger.info('N50 = {}: {}'.format(N50, contigs[0]))
     return N50
 
 
 @wasp_contigs
 def ambig_ratio(contigs):
     """Number of N's per 100 Kbp"""
-    total = 0
-    ambig = 0
-    ratio = 0
-    for seq_record in SeqIO.parse(open(contigs[0]), "fasta"):
-        ambig = ambig + seq_record.seq.count('N')
-        total = total + len(seq_record.seq)
-    try:
-        ratio = 100000.0 * ambig / total
-    except ZeroDivisionError, e:
-        pass
-    return ratio
+    return fasta_stats.ambig_ratio(contigs[0])
 
 
 def arast_score(*wasplinks):
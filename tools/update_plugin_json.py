@@ -1,13 +1,54 @@
 #! /usr/bin/env python
 
 from ConfigParser import SafeConfigParser
+import ast
 import os
 import json
 import re
 
 PLUGIN_DIR = '../lib/assembly/plugins/'
+BASE_PLUGINS = '../lib/assembly/plugins.py'
 OUT_JSON = 'ar_modules.json'
 
+
+def class_types(source):
+    """ {class name: (bases, {'INPUT': .., 'OUTPUT': ..})} of a module source """
+    classes = {}
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.ClassDef):
+            types = {}
+            for stmt in node.body:
+                if isinstance(stmt, ast.Assign):
+                    for target in stmt.targets:
+                        if isinstance(target, ast.Name) and target.id in ('INPUT', 'OUTPUT'):
+                            types[target.id] = ast.literal_eval(stmt.value)
+            classes[node.name] = ([b.id for b in node.bases if isinstance(b, ast.Name)], types)
+    return classes
+
+def resolve_types(name, classes):
+    """ INPUT/OUTPUT of class NAME, following its bases """
+    bases, types = classes.get(name, ([], {}))
+    resolved = {}
+    for base in reversed(bases):
+        resolved.update(resolve_types(base, classes))
+    resolved.update(types)
+    return resolved
+
+def plugin_types(module, base_classes):
+    """ Input and output types of a plugin, read statically from its source """
+    with open(os.path.join(PLUGIN_DIR, module + '.py')) as f:
+        classes = class_types(f.read())
+    all_classes = dict(base_classes, **classes)
+    for name in classes:
+        types = resolve_types(name, all_classes)
+        if 'OUTPUT' in types:
+            return types
+    return {}
+
+
+with open(BASE_PLUGINS) as f:
+    base_classes = class_types(f.read())
+
 plugin_configs = [p for p in sorted(os.listdir(PLUGIN_DIR))
                   if re.search('-plugin', p)]
 
@@ -20,6 +61,12 @@ for plugin_config in plugin_configs:
               dict(parser.items('Settings')).items() +
               dict({'parameters' : dict(parser.items('Parameters')).items()}).items() +
               dict(parser.items('Documentation')).items())
+    if parser.has_section('Resources'):
+        pd.update(parser.items('Resources'))
+    types = plugin_types(parser.get('Core', 'Module'), base_classes)
+    if types:
+        pd['input_type'] = types.get('INPUT')
+        pd['output_type'] = types.get('OUTPUT')
 
     plugins_data.append(pd)
 